@@ -1,10 +1,40 @@
 __version__ = "0.1.0"
 
-from typing import Type, TypeVar
+from typing import Callable, Optional, Type, TypeVar, Union, overload
 
 
 T = TypeVar("T")
 
+# A str field whose values repeat, such as a language code. Equal values
+# share one string in memory and are returned as the same interned str.
+Interned = str
 
+# Numbers stored as the Rust type of the same name. Values that do not fit
+# raise when loading or setting the field. BigInt holds ints of any size,
+# storing those that fit in 64 bits as a plain i64.
+i64 = i32 = i16 = i8 = u64 = u32 = u16 = u8 = BigInt = int
+f64 = f32 = float
+
+
+@overload
 def abserde(c: Type[T]) -> Type[T]:
+    ...
+
+
+@overload
+def abserde(
+    *, lazy: bool = False, compact: bool = False, skip_defaults: bool = False
+) -> Callable[[Type[T]], Type[T]]:
+    ...
+
+
+def abserde(
+    c: Optional[Type[T]] = None,
+    *,
+    lazy: bool = False,
+    compact: bool = False,
+    skip_defaults: bool = False,
+) -> Union[Type[T], Callable[[Type[T]], Type[T]]]:
+    if c is None:
+        return lambda c: c
     return c
@@ -0,0 +1,426 @@
+"""Synthetic payloads and timings for `abserde bench`.
+
+Payloads are generated from the class definitions in a stub, so every stub
+can be benchmarked without sample data. The report is plain JSON, meant to
+be kept and compared against the report of a later build.
+"""
+import gc
+import importlib
+import json
+import os
+import platform
+import random
+import statistics
+import string
+import subprocess
+import sys
+import time
+from ast import AnnAssign
+from ast import AST
+from ast import ClassDef
+from ast import Constant
+from ast import literal_eval
+from ast import Name
+from ast import parse
+from ast import Subscript
+from ast import Tuple as Tuple_
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import replace
+from types import ModuleType
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from abserde import __version__
+from abserde.gen_lib import class_options
+from abserde.gen_lib import ClassGatherer
+
+
+@dataclass(frozen=True)
+class Shape:
+    """How the generated documents look"""
+
+    # items in a List or Dict field
+    list_len: int = 4
+    dict_len: int = 4
+    str_len: int = 12
+    # nesting and width of the values generated for Any fields
+    any_depth: int = 2
+    any_width: int = 3
+    # chance of an Optional field being None
+    none_rate: float = 0.2
+    # how deep classes that contain themselves are nested
+    max_depth: int = 4
+
+
+SHAPES = {
+    "default": Shape(),
+    "deep": Shape(any_depth=8, any_width=2, max_depth=16),
+    "wide": Shape(dict_len=64, any_depth=1, any_width=64),
+    "long": Shape(list_len=256),
+    "any": Shape(any_depth=4, any_width=6),
+    "sparse": Shape(none_rate=0.9),
+}
+
+INT_RANGES = {
+    "int": (-(10 ** 9), 10 ** 9),
+    "i64": (-(2 ** 63), 2 ** 63 - 1),
+    "i32": (-(2 ** 31), 2 ** 31 - 1),
+    "i16": (-(2 ** 15), 2 ** 15 - 1),
+    "i8": (-(2 ** 7), 2 ** 7 - 1),
+    "u64": (0, 2 ** 64 - 1),
+    "u32": (0, 2 ** 32 - 1),
+    "u16": (0, 2 ** 16 - 1),
+    "u8": (0, 2 ** 8 - 1),
+    "BigInt": (-(10 ** 30), 10 ** 30),
+}
+
+# Interned fields are meant for a few distinct values
+INTERNED_VALUES = 8
+
+
+def scaled(shape: Shape, scale: float) -> Shape:
+    """shape with its lengths multiplied by scale"""
+    return replace(
+        shape,
+        list_len=max(1, round(shape.list_len * scale)),
+        dict_len=max(1, round(shape.dict_len * scale)),
+        str_len=max(1, round(shape.str_len * scale)),
+    )
+
+
+class PayloadGenerator:
+    """Random documents matching the classes of a stub"""
+
+    def __init__(self, src: str, shape: Shape, seed: int = 0):
+        mod = parse(src)
+        gatherer = ClassGatherer()
+        gatherer.run(mod)
+        self.enums = gatherer.enums
+        self.fields: Dict[str, List[Tuple[str, AST]]] = {}
+        for n in mod.body:
+            if isinstance(n, ClassDef) and class_options(n) is not None:
+                self.fields[n.name] = [
+                    (item.target.id, item.annotation)
+                    for item in n.body
+                    if isinstance(item, AnnAssign) and isinstance(item.target, Name)
+                ]
+        self.shape = shape
+        self.random = random.Random(seed)
+
+    def root(self) -> str:
+        """The last class that no other class contains, which is usually the document"""
+        used = {
+            node.id
+            for fields in self.fields.values()
+            for _, annotation in fields
+            for node in walk(annotation)
+            if isinstance(node, Name)
+        }
+        roots = [cls for cls in self.fields if cls not in used]
+        return (roots or list(self.fields))[-1]
+
+    def document(self, cls: str, depth: int = 0) -> Dict[str, Any]:
+        return {name: self.value(typ, depth + 1) for name, typ in self.fields[cls]}
+
+    def value(self, n: AST, depth: int) -> Any:
+        r = self.random
+        if isinstance(n, Constant) and n.value is None:
+            return None
+        if isinstance(n, Name):
+            typ = n.id
+            if typ in self.fields:
+                return self.document(typ, depth)
+            if typ in self.enums:
+                return r.choice(self.enums[typ])
+            if typ in INT_RANGES:
+                return r.randint(*INT_RANGES[typ])
+            if typ in ("float", "f64", "f32"):
+                return round(r.uniform(-1e6, 1e6), 3)
+            if typ == "bool":
+                return r.random() < 0.5
+            if typ == "str":
+                return self.text()
+            if typ == "Interned":
+                return f"value{r.randrange(INTERNED_VALUES)}"
+            if typ == "Any":
+                return self.any(self.shape.any_depth)
+            if typ == "None":
+                return None
+            raise ValueError(f"Cannot generate values of type {typ}")
+        assert isinstance(n, Subscript) and isinstance(n.value, Name)
+        container = n.value.id
+        inner = n.slice.value  # type: ignore
+        args = inner.elts if isinstance(inner, Tuple_) else [inner]
+        # stop classes that contain themselves from nesting forever
+        deep = depth >= self.shape.max_depth
+        if container == "Optional":
+            if deep or r.random() < self.shape.none_rate:
+                return None
+            return self.value(inner, depth)
+        if container == "List":
+            return [self.value(inner, depth) for _ in range(0 if deep else self.shape.list_len)]
+        if container in ("Dict", "Mapping"):
+            count = 0 if deep else self.shape.dict_len
+            return {f"key{i}": self.value(args[1], depth) for i in range(count)}
+        if container == "Tuple":
+            return [self.value(arg, depth) for arg in args]
+        if container == "Literal":
+            return r.choice([literal_eval(arg) for arg in args])
+        if container == "Union":
+            return self.value(r.choice(args), depth)
+        raise ValueError(f"Cannot generate values of type {container}")
+
+    def text(self) -> str:
+        return "".join(self.random.choices(string.ascii_letters, k=self.shape.str_len))
+
+    def any(self, depth: int) -> Any:
+        """A JSON value nested depth levels deep"""
+        r = self.random
+        if depth <= 0:
+            return r.choice([r.randint(-1000, 1000), r.random(), self.text(), True, None])
+        width = self.shape.any_width
+        if r.random() < 0.5:
+            return [self.any(depth - 1) for _ in range(width)]
+        return {f"k{i}": self.any(depth - 1) for i in range(width)}
+
+
+def walk(n: AST) -> List[AST]:
+    """n and the nodes under it"""
+    nodes = [n]
+    if isinstance(n, Subscript):
+        inner = n.slice.value  # type: ignore
+        for arg in inner.elts if isinstance(inner, Tuple_) else [inner]:
+            nodes.extend(walk(arg))
+    return nodes
+
+
+@contextmanager
+def gc_disabled() -> Iterator[None]:
+    """Collect garbage, then keep the collector off, so every timing runs in the same state"""
+    gc_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def time_per_call(
+    fn: Callable[[], Any], repeat: int = 5, budget: float = 0.05
+) -> Dict[str, float]:
+    """Microseconds per call of fn, timed in loops of about budget seconds"""
+    number = 1
+    with gc_disabled():
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            elapsed = time.perf_counter() - start
+            if elapsed >= budget or number >= 1 << 20:
+                break
+            number *= 2
+        times = [elapsed / number]
+        for _ in range(repeat - 1):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append((time.perf_counter() - start) / number)
+    return {
+        "median_us": statistics.median(times) * 1e6,
+        "min_us": min(times) * 1e6,
+    }
+
+
+def docs_per_second(fn: Callable[[], Any], docs: List[str]) -> Dict[str, float]:
+    """Throughput of fn, which loads all of docs"""
+    megabytes = sum(len(d.encode()) for d in docs) / 1e6
+    with gc_disabled():
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+    return {"docs_per_s": len(docs) / elapsed, "mb_per_s": megabytes / elapsed}
+
+
+def rss() -> Optional[int]:
+    """The memory this process has resident, in bytes, if it can be found out"""
+    try:
+        import psutil  # type: ignore
+    except ImportError:
+        pass
+    else:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def rss_child() -> None:
+    """Load the documents given on stdin and print how much the RSS grew.
+
+    Runs in a fresh interpreter for each library, so memory one library's
+    allocator kept is not reused by the next.
+    """
+    job = json.load(sys.stdin)
+    loads = importlib.import_module(job["module"])
+    if job["class"] is not None:
+        loads = getattr(loads, job["class"])
+    loads = loads.loads
+    docs = job["docs"]
+    gc.collect()
+    before = rss()
+    result = [loads(s) for s in docs]
+    gc.collect()
+    after = rss()
+    del result
+    print(json.dumps(None if before is None or after is None else after - before))
+
+
+def rss_per_doc(module: str, cls: Optional[str], docs: List[str]) -> Optional[float]:
+    """Growth of the RSS when module (or its class cls) loads docs, per document, or None
+    without psutil on platforms other than Linux.
+
+    Unlike tracemalloc this counts memory from every allocator, including
+    the Rust heap abserde keeps objects on.
+    """
+    job = json.dumps({"module": module, "class": cls, "docs": docs})
+    child = subprocess.run(
+        [sys.executable, "-c", "from abserde.bench import rss_child; rss_child()"],
+        input=job.encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    grown = json.loads(child.stdout)
+    return None if grown is None else grown / len(docs)
+
+
+def json_libraries() -> Dict[str, ModuleType]:
+    """json, and ujson and orjson if they are installed"""
+    libraries = {"json": json}
+    for name in ("ujson", "orjson"):
+        try:
+            libraries[name] = importlib.import_module(name)
+        except ImportError:
+            pass
+    return libraries
+
+
+def run(
+    module: str, cls: Any, docs: List[str], fields: List[str]
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Time cls from module against the json libraries on docs, one result per benchmark
+    and library.
+
+    batch loads the documents one after another for every library, and
+    batch_parallel with abserde's loads_many, which spreads them over threads.
+    """
+    results: Dict[str, Dict[str, Dict[str, float]]] = {
+        "loads": {}, "dumps": {}, "access": {}, "batch": {}, "batch_parallel": {}, "memory": {}
+    }
+    doc = docs[0]
+    obj = cls.loads(doc)
+    results["loads"]["abserde"] = time_per_call(lambda: cls.loads(doc))
+    results["dumps"]["abserde"] = time_per_call(obj.dumps)
+    results["access"]["abserde"] = time_per_call(lambda: [getattr(obj, f) for f in fields])
+    results["batch"]["abserde"] = docs_per_second(lambda: [cls.loads(s) for s in docs], docs)
+    results["batch_parallel"]["abserde"] = docs_per_second(lambda: cls.loads_many(docs), docs)
+    memory = rss_per_doc(module, cls.__name__, docs)
+    if memory is not None:
+        results["memory"]["abserde"] = {"rss_bytes_per_doc": memory}
+    for name, lib in json_libraries().items():
+        d = lib.loads(doc)
+        results["loads"][name] = time_per_call(lambda: lib.loads(doc))
+        results["dumps"][name] = time_per_call(lambda: lib.dumps(d))
+        results["access"][name] = time_per_call(lambda: [d.get(f) for f in fields])
+        results["batch"][name] = docs_per_second(lambda: [lib.loads(s) for s in docs], docs)
+        memory = rss_per_doc(name, None, docs)
+        if memory is not None:
+            results["memory"][name] = {"rss_bytes_per_doc": memory}
+    return results
+
+
+def bench(
+    stub: str,
+    cls_name: Optional[str] = None,
+    shape: str = "default",
+    scale: float = 1.0,
+    count: int = 1000,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Benchmark the built module for stub, returning the report"""
+    with open(stub) as f:
+        src = f.read()
+    generator = PayloadGenerator(src, scaled(SHAPES[shape], scale), seed)
+    cls_name = cls_name or generator.root()
+    if cls_name not in generator.fields:
+        raise ValueError(f"{stub} has no abserde class {cls_name}")
+    module_name = stub.replace("\\", "/").rsplit("/", 1)[-1].rsplit(".", 1)[0]
+    module = importlib.import_module(module_name)
+    docs = [json.dumps(generator.document(cls_name)) for _ in range(count)]
+    fields = [name for name, _ in generator.fields[cls_name]]
+    return {
+        "abserde": __version__,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "stub": stub,
+        "class": cls_name,
+        "shape": shape,
+        "scale": scale,
+        "docs": count,
+        "seed": seed,
+        "mean_doc_bytes": sum(len(d.encode()) for d in docs) / count,
+        "results": run(module_name, getattr(module, cls_name), docs, fields),
+    }
+
+
+# metrics where a larger value is better; for the others smaller is better
+HIGHER_IS_BETTER = {"docs_per_s", "mb_per_s"}
+
+
+def compare(
+    old: Dict[str, Any], new: Dict[str, Any], threshold: float
+) -> List[Tuple[str, float, bool]]:
+    """The relative change of each abserde metric between two reports.
+
+    Each entry is (name, change, regressed), where change is positive when
+    new is better, and regressed marks changes worse than threshold.
+    """
+    changes = []
+    for benchmark, libraries in new["results"].items():
+        before = old["results"].get(benchmark, {}).get("abserde", {})
+        for metric, value in libraries.get("abserde", {}).items():
+            if not before.get(metric) or not value:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = value / before[metric] - 1
+            else:
+                change = before[metric] / value - 1
+            changes.append((f"{benchmark}.{metric}", change, change < -threshold))
+    return changes
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """A table of the results, one row per benchmark and metric"""
+    libraries = list(report["results"]["loads"])
+    lines = [
+        f"{report['stub']} {report['class']}: {report['docs']} {report['shape']} documents, "
+        f"{report['mean_doc_bytes']:.0f} bytes each",
+        f"{'':<28}" + "".join(f"{name:>12}" for name in libraries),
+    ]
+    for benchmark, results in report["results"].items():
+        for metric in results.get("abserde", {}):
+            cells = "".join(
+                f"{results[name][metric]:>12.1f}" if name in results else f"{'':>12}"
+                for name in libraries
+            )
+            lines.append(f"{benchmark + '.' + metric:<28}{cells}")
+    return "\n".join(lines)
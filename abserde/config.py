@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Tuple
 
 
 @dataclass
@@ -7,3 +8,12 @@ class Config:
     debug: bool
     name: str
     email: str
+    lazy: bool = False
+    compact: bool = False
+    force: bool = False
+    skip_defaults: bool = False
+    stats: bool = False
+    # extra formats to generate loads_<format> and dumps_<format> for
+    formats: Tuple[str, ...] = ()
+    # "serde_json", or "simd" to parse with simd-json where it can
+    parser: str = "serde_json"
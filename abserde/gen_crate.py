@@ -1,42 +1,151 @@
+import hashlib
 import os
+import shutil
 import subprocess
 import sys
 from distutils.dir_util import copy_tree
 from pathlib import Path
+from typing import Dict
+from typing import List
 
+from abserde import __version__
 from abserde.config import Config
 
 
-def generate_crate(mod: str, config: Config) -> None:
+def write_if_changed(path: Path, text: str) -> bool:
+    """Write text to path unless it already holds it, so cargo sees an unchanged mtime"""
+    if path.exists() and path.read_text() == text:
+        return False
+    path.write_text(text)
+    return True
+
+
+def tool_versions(cwd: Path, env: Dict[str, str]) -> str:
+    """The versions of rustc and maturin a build in cwd would use, or "" for a missing one"""
+    versions = []
+    for cmd in (["rustc", "-vV"], ["maturin", "--version"]):
+        try:
+            p = subprocess.run(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd, env=env
+            )
+        except OSError:
+            versions.append("")
+        else:
+            versions.append(p.stdout.decode(errors="replace"))
+    return "\n".join(versions)
+
+
+def crate_files(crate_dir: Path) -> str:
+    """The path and contents of every file of the crate in crate_dir, leaving out build output"""
+    files = []
+    for path in sorted(crate_dir.rglob("*")):
+        rel = path.relative_to(crate_dir)
+        if path.is_file() and rel.parts[0] != "target":
+            files.append(f"{rel.as_posix()}\n{path.read_text(errors='replace')}")
+    return "\0".join(files)
+
+
+def build_hash(
+    cargo_toml: str, lib: str, runtime: str, cmd: List[str], env: Dict[str, str], tools: str
+) -> str:
+    """Hash everything that goes into a wheel: the crates, the command, the flags and the
+    versions of abserde and of the tools building it"""
+    h = hashlib.sha256()
+    parts = (
+        cargo_toml,
+        lib,
+        runtime,
+        " ".join(cmd),
+        env.get("RUSTFLAGS", ""),
+        sys.version,
+        __version__,
+        tools,
+    )
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def generate_crate(mod: str, config: Config, slot: int = 0) -> str:
+    """Build the wheel for mod, returning "built", "cached" or "failed".
+
+    Builds running at the same time must use different slots: cargo locks its
+    target directory, so each slot gets its own.
+    """
     dir = Path.cwd() / "build" / "abserde"
     template_dir = Path(__file__).parent / "template_crate"
+    # generated crates depend on this by path, see runtime_crate/src/lib.rs
+    runtime_dir = Path(__file__).parent / "runtime_crate"
     crate_name = config.filename
     crate_dir = dir / crate_name
-    copy_tree(str(template_dir), str(crate_dir))
-    with open(crate_dir / "Cargo.toml.in") as c:
+    (crate_dir / "src").mkdir(parents=True, exist_ok=True)
+    with open(template_dir / "Cargo.toml.in") as c:
         src = c.read()
-        formatted = src.format(file=crate_name, name=config.name, email=config.email)
+        formatted = src.format(
+            file=crate_name,
+            name=config.name,
+            email=config.email,
+            runtime=runtime_dir.resolve().as_posix(),
+            runtime_features=', features = ["simd"]' if config.parser == "simd" else "",
+        )
         if config.debug:
             print("Cargo.toml:")
             print(formatted)
-    with open(crate_dir / "Cargo.toml", "w") as w:
-        w.write(formatted)
+    write_if_changed(crate_dir / "Cargo.toml", formatted)
+    write_if_changed(crate_dir / "src" / "lib.rs", mod)
 
-    with open(crate_dir / "src" / "lib.rs", "w+") as lib:
-        lib.write(mod)
+    wheelhouse = crate_dir / "wheels"
     cmd = ["maturin", "build", "-i", sys.executable, "--manylinux", "1-unchecked"]
+    cmd += ["--out", str(wheelhouse)]
     env = os.environ.copy()
     if not config.debug:
         cmd.append("--release")
-        env['RUSTFLAGS'] = "-C target-cpu=native"
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=crate_dir, env=env)
-    sys.stdout.buffer.write(p.stdout)
-    sys.stdout.buffer.write(b'\n')
-    sys.stderr.buffer.write(p.stderr)
-    sys.stderr.buffer.write(b'\n')
-    wheelhouse = crate_dir / "target" / "wheels"
+        # simd-json detects the CPU's instructions at runtime, so its wheels
+        # are built to run on any CPU of the architecture
+        if config.parser != "simd":
+            env['RUSTFLAGS'] = "-C target-cpu=native"
+    # share one target directory between stubs, so dependencies are compiled once
+    env.setdefault("CARGO_TARGET_DIR", str(dir / "target"))
+    if slot:
+        env["CARGO_TARGET_DIR"] += f"-{slot}"
+    # the runtime's Cargo.toml picks its dependencies and features, so it counts too
+    runtime = crate_files(runtime_dir)
+    digest = build_hash(formatted, mod, runtime, cmd, env, tool_versions(crate_dir, env))
+    stamp = crate_dir / "abserde.hash"
+    cached = (
+        not config.force
+        and stamp.exists()
+        and stamp.read_text() == digest
+        and wheelhouse.exists()
+        and any(wheelhouse.iterdir())
+    )
+    if cached:
+        status = "cached"
+        if config.debug:
+            print(f"{crate_name} is unchanged, reusing the previous wheel")
+    else:
+        if wheelhouse.exists():
+            shutil.rmtree(wheelhouse)
+        if stamp.exists():
+            stamp.unlink()
+        p = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=crate_dir, env=env
+        )
+        sys.stdout.buffer.write(p.stdout)
+        sys.stdout.buffer.write(b'\n')
+        sys.stderr.buffer.write(p.stderr)
+        sys.stderr.buffer.write(b'\n')
+        if p.returncode != 0:
+            return "failed"
+        if not wheelhouse.exists() or not any(wheelhouse.iterdir()):
+            print(f"maturin built no wheel for {crate_name}", file=sys.stderr)
+            return "failed"
+        stamp.write_text(digest)
+        status = "built"
     if config.debug:
         print("Generated wheel")
-        print(*wheelhouse.iterdir())
+        print(*sorted(wheelhouse.iterdir()))
     built_wheel = Path.cwd() / "dist"
     copy_tree(str(wheelhouse), str(built_wheel))
+    return status
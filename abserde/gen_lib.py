@@ -1,11 +1,23 @@
+import json
+import re
 from ast import AnnAssign
+from ast import Assign
 from ast import AST
+from ast import Attribute
+from ast import Call
 from ast import ClassDef
+from ast import Constant
+from ast import Ellipsis as Ellipsis_
+from ast import literal_eval
 from ast import Module
 from ast import Name
 from ast import NodeVisitor
 from ast import parse
 from ast import Subscript
+from ast import Tuple as Tuple_
+from ast import walk
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import NoReturn
 from typing import Optional
@@ -21,23 +33,27 @@ LIB_USES = """
 use pyo3::prelude::*;
 use pyo3::wrap_pyfunction;
 use pyo3::exceptions;
-use pyo3::PyObjectProtocol;
-use pyo3::types::{PyBytes, PyType, IntoPyDict, PyString, PyAny};
 use pyo3::create_exception;
+use pyo3::PyObjectProtocol;
+use pyo3::types::{PyType, PyAny};
 use pyo3::PyMappingProtocol;
-use pyo3::ffi::Py_TYPE;
-use pyo3::AsPyPointer;
+use pyo3::PyNativeType;
 use pyo3::types::PyDict;
 use pyo3::class::basic::CompareOp;
+use pyo3::gc::{PyGCProtocol, PyTraverseError, PyVisit};
+use pyo3::pycell::PyCell;
 
+use abserde_runtime::*;
 use serde::{Deserialize, Serialize};
 #[allow(unused_imports)]
 use std::ops::Deref;
 use std::fmt;
+use serde_json::value::RawValue;
+use std::sync::Arc;
 """
 
 STRUCT_PREFIX = """
-#[pyclass(dict)]
+{pyclass}
 #[derive(Serialize, Deserialize, Clone, PartialEq)]
 pub struct {name} {{
 """
@@ -46,31 +62,468 @@ PYCLASS_PREFIX = """
 #[pymethods]
 impl {name} {{
     fn dumps(&self) -> PyResult<String> {{
-        dumps_impl(self)
+        let gil = GILGuard::acquire();
+        {dumps_timer}let result = dumps_impl(gil.python(), self, {release});
+        {dumps_finish}result
+    }}
+
+    /// dumps_bytes()
+    /// --
+    ///
+    /// Dump to bytes, without building a str first.
+    fn dumps_bytes(&self) -> PyResult<PyObject> {{
+        let gil = GILGuard::acquire();
+        {dumps_timer}let result = dumps_bytes_impl(gil.python(), self, {release});
+        {dumps_bytes_finish}result
     }}
 
+    /// to_binary()
+    /// --
+    ///
+    /// Encode to a compact binary format (packed CBOR), decoded by from_binary.
+    /// Pickling uses the same encoding.
+    fn to_binary(&self) -> PyResult<PyObject> {{
+        let gil = GILGuard::acquire();
+        {dumps_timer}let result = to_binary_impl(gil.python(), self);
+        {dumps_bytes_finish}result
+    }}
+
+    /// from_binary(data)
+    /// --
+    ///
+    /// Decode the output of to_binary from bytes or any other buffer.
     #[classmethod]
-    fn loads(_cls: &PyType, s: &PyString) -> PyResult<Self> {{
-        match serde_json::from_str::<{name}>(&s.to_string_lossy()) {{
-            Ok(v) => Ok(v),
-            Err(e) => Err(JSONParseError::py_err(e.to_string())),
-        }}
+    fn from_binary(_cls: &PyType, data: &PyAny) -> PyResult<Self> {{
+        {loads_timer}let result = from_binary_impl::<{name}>(data);
+        {from_binary_finish}result
+    }}
+
+    fn __reduce__(&self) -> PyResult<(PyObject, (PyObject,))> {{
+        let gil = GILGuard::acquire();
+        let py = gil.python();
+        let from_binary = py.get_type::<{name}>().getattr("from_binary")?.to_object(py);
+        Ok((from_binary, (to_binary_impl(py, self)?,)))
+    }}
+
+    /// dump(fp)
+    /// --
+    ///
+    /// Write the JSON to a binary file object, in chunks, without building
+    /// the whole output in memory.
+    fn dump(&self, fp: PyObject) -> PyResult<()> {{
+        let gil = GILGuard::acquire();
+        {dumps_timer}let result = dump_impl(gil.python(), self, fp);
+        {dump_finish}result.map(|_| ())
+    }}
+
+    /// dump_to_path(path)
+    /// --
+    ///
+    /// Write the JSON to the file at path, with the GIL released.
+    fn dump_to_path(&self, path: &PyAny) -> PyResult<()> {{
+        {dumps_timer}let result = dump_to_path_impl(path.py(), self, path);
+        {dump_finish}result.map(|_| ())
+    }}
+
+{loads}
+    /// loads_columns(payloads)
+    /// --
+    ///
+    /// Decode a list of payloads, or a buffer of JSON Lines, into a dict of
+    /// NumPy arrays, one per int, float and bool field. Optional fields give
+    /// masked arrays. No Python object is created per record.
+    #[classmethod]
+    fn loads_columns(_cls: &PyType, payloads: &PyAny) -> PyResult<PyObject> {{
+        let rows = load_rows::<Abserde{name}Scalars>(payloads, {loads_columns_stats})?;
+        Abserde{name}Scalars::columns(payloads.py(), &rows)
+    }}
+
+    /// loads_many(payloads, threads=None)
+    /// --
+    ///
+    /// Parse every payload in an iterable on a native thread pool, returning a list.
+    /// threads defaults to one worker per core.
+    #[classmethod]
+    #[args(threads = "None")]
+    fn loads_many(
+        _cls: &PyType, payloads: &PyAny, threads: Option<usize>
+    ) -> PyResult<Vec<Self>> {{
+        loads_many_impl::<{name}>(payloads, threads, {loads_many_stats})
+    }}
+
+    /// iter_lines(source, batch_size=None)
+    /// --
+    ///
+    /// Iterate over a JSON Lines file object or path, yielding one {name} per line,
+    /// or lists of up to batch_size of them.
+    #[classmethod]
+    #[args(batch_size = "None")]
+    fn iter_lines(
+        _cls: &PyType, source: &PyAny, batch_size: Option<usize>
+    ) -> PyResult<LineReader> {{
+        LineReader::new(source, batch_size, parse_lines::<{name}>, {iter_lines_stats})
+    }}
+
+    /// iter_array(source=None, *, path=None, keys=None)
+    /// --
+    ///
+    /// Iterate over a JSON array of {name} objects read from source, a file object,
+    /// bytes or buffer, or from the file at path, decoding one element at a time.
+    /// If keys is given (e.g. "data.items"), the array is found under those keys
+    /// instead of at the top level.
+    #[classmethod]
+    #[args(source = "None", "*", path = "None", keys = "None")]
+    fn iter_array(
+        cls: &PyType, source: Option<&PyAny>, path: Option<&PyAny>, keys: Option<&str>
+    ) -> PyResult<ArrayReader> {{
+        iter_array_impl::<{name}>(cls.py(), source, path, keys, {iter_array_stats})
+    }}
+"""
+
+# the formats besides JSON that a module can be built to read and write, by their
+# name in loads_<format> and dumps_<format>
+BINARY_FORMATS = {"msgpack": "MessagePack", "cbor": "CBOR"}
+
+# the batch and streaming loads that stats() counts separately from loads
+BATCH_OPS = ("loads_many", "loads_columns", "iter_lines", "iter_array")
+
+BINARY_METHODS = """
+    /// dumps_{format}()
+    /// --
+    ///
+    /// Encode to {title} bytes, serializing straight into the returned object.
+    fn dumps_{format}(&self) -> PyResult<PyObject> {{
+        let gil = GILGuard::acquire();
+        {dumps_timer}let result = dumps_{format}_impl(gil.python(), self);
+        {dumps_bytes_finish}result
+    }}
+
+    /// loads_{format}(s)
+    /// --
+    ///
+    /// Decode {title} from bytes or any other buffer.
+    #[classmethod]
+    fn loads_{format}(_cls: &PyType, s: &PyAny) -> PyResult<Self> {{
+        {loads_timer}let result =
+            with_input_bytes(s, |bytes, _| {format}_from_slice::<{name}>(bytes));
+        {loads_finish}result
     }}
 """
 
 IMPL_NEW_PREFIX = """
     #[new]
-    fn new({args}) -> Self {{
-        {{
-            {name} {{
+{defaults}    fn new({args}) -> PyResult<Self> {{
+        {gil}Ok({name} {{
 """
 
-IMPL_NEW_SUFFIX = """
-            }
-        }
+IMPL_NEW_SUFFIX = """        })
     }
 """
 
+LOADS = """
+    /// loads(s)
+    /// --
+    ///
+    /// Parse a JSON document.
+    #[classmethod]
+    fn loads(_cls: &PyType, s: &PyAny) -> PyResult<Self> {{
+        {loads_timer}let result = loads_impl::<{name}>(s);
+        {loads_finish}result
+    }}
+"""
+
+# only= is for lazy classes, which can leave fields out; an eager class holds a value
+# for every field
+LAZY_LOADS = """
+    /// loads(s, only=None)
+    /// --
+    ///
+    /// Parse a JSON document. only limits the object to the listed fields;
+    /// the rest are skipped without being indexed or parsed, and not kept.
+    #[classmethod]
+    #[args(only = "None")]
+    fn loads(_cls: &PyType, s: &PyAny, only: Option<Vec<String>>) -> PyResult<Self> {{
+        {loads_timer}let result = match only {{
+            None => loads_impl::<{name}>(s),
+            Some(only) => {name}::loads_only(s, &only),
+        }};
+        {loads_finish}result
+    }}
+"""
+
+DEFAULTS_IMPL = """
+impl {name} {{
+{functions}}}
+"""
+
+SCALARS_STRUCT = """
+/// The int, float and bool fields of {name}, read by loads_columns.
+#[derive(Deserialize)]
+struct Abserde{name}Scalars {{
+{fields}}}
+
+impl Abserde{name}Scalars {{
+    fn columns(py: Python, rows: &[Self]) -> PyResult<PyObject> {{
+        let numpy = py.import("numpy")?;
+        let columns = PyDict::new(py);
+{columns}        Ok(columns.into())
+    }}
+}}
+"""
+
+LAZY_STRUCT_PREFIX = """
+{pyclass}
+#[derive(Clone)]
+pub struct {name} {{
+    source: Option<Arc<Box<RawValue>>>,
+    dirty: bool,
+    projected: bool,
+"""
+
+LAZY_STRUCT_SUFFIX = """}}
+
+impl {name} {{
+    const FIELDS: [&'static str; {len}] = [{names}];
+    const REQUIRED: [bool; {len}] = [{required}];
+
+    fn from_source(source: Box<RawValue>) -> serde_json::Result<Self> {{
+        let spans = index_fields(source.get(), &Self::FIELDS, &Self::REQUIRED, None)?;
+        Ok({name}::from_spans(source, &spans, None))
+    }}
+
+    /// only marks which fields were indexed; the others are skipped.
+    fn from_spans(
+        source: Box<RawValue>, spans: &[Option<(usize, usize)>], only: Option<&[bool]>
+    ) -> Self {{
+        {name} {{
+{from_spans}            source: Some(Arc::new(source)),
+            dirty: false,
+            projected: only.is_some(),
+        }}
+    }}
+
+    fn loads_only(s: &PyAny, only: &[String]) -> PyResult<Self> {{
+        let only = field_mask(&Self::FIELDS, only)?;
+        // only the listed fields are copied out of s
+        let (source, spans) = loads_projected(s, &Self::FIELDS, &Self::REQUIRED, &only)?;
+        Ok({name}::from_spans(source, &spans, Some(&only)))
+    }}
+
+    /// Whether dumps can copy the source text out unchanged.
+    fn pristine(&self) -> bool {{
+        self.source.is_some() && !self.dirty && !self.projected{handed_out}
+    }}
+}}
+
+impl<'de> Deserialize<'de> for {name} {{
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where D: serde::Deserializer<'de>
+    {{
+        if !deserializer.is_human_readable() {{
+            // binary formats have no JSON text to index, so every field is
+            // decoded up front
+            return deserializer.deserialize_map(Abserde{name}Visitor);
+        }}
+        let source = Box::<RawValue>::deserialize(deserializer)?;
+        {name}::from_source(source).map_err(serde::de::Error::custom)
+    }}
+}}
+
+/// Decodes a map of {name}'s fields, keyed by name or by index, from a binary
+/// format.
+struct Abserde{name}Visitor;
+
+impl<'de> serde::de::Visitor<'de> for Abserde{name}Visitor {{
+    type Value = {name};
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {{
+        f.write_str("a map of {name} fields")
+    }}
+
+    fn visit_map<A>(self, mut map: A) -> Result<{name}, A::Error>
+    where A: serde::de::MapAccess<'de>
+    {{
+        // fields missing from the map are read as null or their default, as
+        // they are when indexed
+        let spans: [Option<(usize, usize)>; {len}] = [None; {len}];
+        let only: Option<&[bool]> = None;
+        let mut value = {name} {{
+{from_spans}            source: None,
+            dirty: false,
+            projected: false,
+        }};
+        let mut seen = [false; {len}];
+        while let Some(key) = map.next_key_seed(FieldKey(&{name}::FIELDS))? {{
+            match key {{
+{decode_fields}                _ => {{
+                    map.next_value::<serde::de::IgnoredAny>()?;
+                    continue;
+                }}
+            }}
+            seen[key.unwrap()] = true;
+        }}
+        for (i, &found) in seen.iter().enumerate() {{
+            if !found && {name}::REQUIRED[i] {{
+                return Err(serde::de::Error::missing_field({name}::FIELDS[i]));
+            }}
+        }}
+        Ok(value)
+    }}
+}}
+
+impl Serialize for {name} {{
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {{
+        use serde::ser::{{Error, SerializeStruct}};
+        // binary formats write each field, like an eager class would
+        if let (true, true, Some(source)) =
+            (serializer.is_human_readable(), self.pristine(), &self.source)
+        {{
+            return (**source).serialize(serializer);
+        }}
+        let mut s = serializer.serialize_struct("{name}", {len})?;
+{serialize_fields}        s.end()
+    }}
+}}
+
+impl PartialEq for {name} {{
+    fn eq(&self, other: &Self) -> bool {{
+        {eq}
+    }}
+}}
+"""
+
+LAZY_ACCESSORS = """
+    #[getter]
+    fn get_{pyname}(&self) -> PyResult<PyObject> {{
+        {timer}if self.{name}.is_skipped() {{
+            return Err(exceptions::AttributeError::py_err("{pyname} was not loaded, see only="));
+        }}
+        let gil = GILGuard::acquire();
+        let py = gil.python();
+        match self.{name}.get(&self.source) {{
+            Ok(v) => Ok({to_py}),
+            Err(e) => Err(JSONParseError::py_err(e.to_string())),
+        }}
+    }}
+
+    #[setter]
+    fn set_{pyname}(&mut self, value: PyObject) -> PyResult<()> {{
+        let gil = GILGuard::acquire();
+        let py = gil.python();
+        self.{name} = Lazy::from_value({from_py});
+        self.dirty = true;
+        Ok(())
+    }}
+"""
+
+SERIALIZE_FROM_PY = """
+impl SharedValue for {name} {{
+    fn is_instance(ob: &PyAny) -> bool {{
+        ob.downcast::<PyCell<{name}>>().is_ok()
+    }}
+
+    fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {{
+        // borrow the instance rather than copying it out
+        let cell = ob.downcast::<PyCell<{name}>>()
+            .map_err(|_| serde::ser::Error::custom("expected {name}"))?;
+        let value = cell.try_borrow()
+            .map_err(|_| serde::ser::Error::custom("{name} is being changed"))?;
+        value.serialize(serializer)
+    }}
+}}
+"""
+
+GC_IMPL = """
+#[pyproto]
+impl PyGCProtocol for {name} {{
+    fn __traverse__(&self, visit: PyVisit) -> Result<(), PyTraverseError> {{
+{traverse}        Ok(())
+    }}
+
+    fn __clear__(&mut self) {{
+{clear}    }}
+}}
+"""
+
+IMPL_NEW_GIL = """let gil = GILGuard::acquire();
+        let py = gil.python();
+        """
+
+SHARED_ACCESSORS = """
+    #[getter]
+    fn get_{pyname}(&self) -> PyResult<PyObject> {{
+        {timer}let gil = GILGuard::acquire();
+        Ok(self.{name}.get(gil.python()))
+    }}
+
+    #[setter]
+    fn set_{pyname}(&mut self, value: PyObject) -> PyResult<()> {{
+        let gil = GILGuard::acquire();
+        self.{name}.set(gil.python(), value)
+    }}
+"""
+
+STATS_ACCESSORS = """
+    #[getter]
+    fn get_{pyname}(&self) -> PyResult<PyObject> {{
+        {timer}let gil = GILGuard::acquire();
+        Ok(self.{name}.clone().into_py(gil.python()))
+    }}
+
+    #[setter]
+    fn set_{pyname}(&mut self, value: {typ}) -> PyResult<()> {{
+        self.{name} = value;
+        Ok(())
+    }}
+"""
+
+STATS_DECL = """
+static {stats}: ClassStats = ClassStats::new("{name}", &[{fields}]);
+"""
+
+# counters of the module level functions, which stats() lists under "<module>"
+MODULE_STATS_DECL = """
+static MODULE_COUNTERS: ClassStats = ClassStats::new("<module>", &[]);
+"""
+
+STATS_IMPL = """
+#[global_allocator]
+static ALLOCATOR: CountingAlloc = CountingAlloc;
+
+static CLASS_STATS: [&ClassStats; {len}] = [{classes}];
+
+/// stats()
+/// --
+///
+/// Counters for each class since the module was loaded or reset_stats() was
+/// called: calls, errors, bytes, time and allocations of loads, dumps, the
+/// batch and streaming loads, and reading each field. The module level
+/// functions are counted under "<module>".
+#[pyfunction]
+fn stats(py: Python) -> PyResult<PyObject> {{
+    let stats = PyDict::new(py);
+    for class in CLASS_STATS.iter() {{
+        stats.set_item(class.name(), class.to_dict(py)?)?;
+    }}
+    Ok(stats.into())
+}}
+
+/// reset_stats()
+/// --
+///
+/// Set every counter back to zero.
+#[pyfunction]
+fn reset_stats() {{
+    for class in CLASS_STATS.iter() {{
+        class.reset();
+    }}
+}}
+"""
+
 OBJECT_PROTO = """
 #[allow(unused)]
 #[pyproto]
@@ -78,22 +531,17 @@ impl<'p> PyObjectProtocol<'p> for {name} {{
 """
 
 DUNDER_STR = """
-    fn __str__(&self) -> PyResult<String> {
-        match serde_json::to_string(&self) {
-            Ok(v) => Ok(v),
-            Err(e) => Err(exceptions::ValueError::py_err(e.to_string()))
-        }
-    }
+    fn __str__(&self) -> PyResult<String> {{
+        let gil = GILGuard::acquire();
+        dumps_impl(gil.python(), self, {release})
+    }}
 """
 
 DUNDER_BYTES = """
-    fn __bytes__(&self) -> PyResult<PyObject> {
+    fn __bytes__(&self) -> PyResult<PyObject> {{
         let gil = GILGuard::acquire();
-        match serde_json::to_vec(&self) {
-            Ok(v) => Ok(PyBytes::new(gil.python(), &v).into()),
-            Err(e) => Err(exceptions::ValueError::py_err(e.to_string()))
-        }
-    }
+        dumps_bytes_impl(gil.python(), self, {release})
+    }}
 """
 
 DUNDER_RICHCMP = """
@@ -150,6 +598,58 @@ impl<'p> PyMappingProtocol<'p> for {name} {{
 }}
 """
 
+LITERAL_ENUM = """
+#[allow(non_camel_case_types)]
+#[derive(Clone, Copy, PartialEq)]
+pub enum {name} {{
+{variants}}}
+
+impl {name} {{
+    fn as_str(&self) -> &'static str {{
+        match self {{
+{as_str}        }}
+    }}
+}}
+
+impl Serialize for {name} {{
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {{
+        serializer.serialize_str(self.as_str())
+    }}
+}}
+
+impl<'de> Deserialize<'de> for {name} {{
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where D: serde::Deserializer<'de>
+    {{
+        deserialize_literal(deserializer, &[{values_json}], &[{variant_paths}])
+    }}
+}}
+
+impl fmt::Debug for {name} {{
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {{
+        write!(f, "{{:?}}", self.as_str())
+    }}
+}}
+
+impl IntoPy<PyObject> for {name} {{
+    fn into_py(self, py: Python) -> PyObject {{
+        intern_static(py, self.as_str())
+    }}
+}}
+
+impl<'source> pyo3::FromPyObject<'source> for {name} {{
+    fn extract(ob: &'source PyAny) -> PyResult<{name}> {{
+        match ob.extract::<&str>()? {{
+{from_str}            other => Err(exceptions::ValueError::py_err(
+                format!("{{:?}} is not one of {{}}", other, {values})
+            )),
+        }}
+    }}
+}}
+"""
+
 ENUM_IMPL_PREFIX = """
 impl IntoPy<PyObject> for {name} {{
     fn into_py(self, py: Python) -> PyObject {{
@@ -171,9 +671,8 @@ ENUM_DECL = """
 }}
 
 
-#[derive(Serialize, Deserialize, Clone)]
-#[serde(untagged)]
-pub enum {name} {{
+#[derive({derives})]
+{attrs}pub enum {name} {{
 """
 
 ENUM_IMPL_DEBUG_PREFIX = """
@@ -189,150 +688,217 @@ ENUM_IMPL_DEBUG_SUFFIX = """
 """
 
 DUMPS_IMPL_PREFIX = """
-fn dumps_impl<T>(c: &T) -> PyResult<String>
-where T: Serialize
-{
-    match serde_json::to_string(c) {
-        Ok(v) => Ok(v),
-        Err(e) => Err(exceptions::ValueError::py_err(e.to_string()))
-    }
-}
-
 /// dumps(s, /)
 /// --
 ///
 /// Dump abserde class s into a str.
 /// For bytes, call bytes() on the object.
 #[pyfunction]
-pub fn dumps(c: PyObject, py: Python) -> PyResult<String> {
-"""
-DUMPS_FOR_CLS = """
-    if let Ok(o) = c.extract::<{cls}>(py) {{
-        dumps_impl(&o)
+pub fn dumps(c: PyObject, py: Python) -> PyResult<String> {{
+    {timer}let result = """
+DUMPS_FOR_CLS = """if let Ok(o) = c.extract::<{cls}>(py) {{
+        dumps_impl(py, &o, {release})
     }}"""
 DUMPS_IMPL_SUFFIX = """
-    else {
+    else {{
         Err(exceptions::ValueError::py_err("Invalid type for dumps"))
-    }
-}
+    }};
+    {finish}result
+}}
 """
 
-MODULE_PREFIX = """
-/// loads(s, /)
-/// --
-///
-/// Parse s into an abserde class.
-/// s can be a str, byte, or bytearray.
-#[pyfunction]
-pub fn loads<'a>(s: PyObject, py: Python) -> PyResult<Classes> {{
-    let bytes = if let Ok(string) = s.cast_as::<PyString>(py) {{
-        string.as_bytes()
-    }} else if let Ok(bytes) = s.cast_as::<PyBytes>(py) {{
-        Ok(bytes.as_bytes())
-    }} else {{
-        let ty = unsafe {{
-            let p = s.as_ptr();
-            let tp = Py_TYPE(p);
-            PyType::from_type_ptr(py, tp)
-        }};
-        if ty.name() == "bytearray" {{
-            let locals = [("bytesobj", s)].into_py_dict(py);
-            let bytes = py.eval("bytes(bytesobj)", None, Some(&locals))?.downcast::<PyBytes>()?;
-            Ok(bytes.as_bytes())
-        }} else {{
-            Err(exceptions::ValueError::py_err(format!("loads() takes only str, bytes, or bytearray, got {{}}", ty)))
+DISPATCH_PREFIX = """
+const REQUIRED_KEYS: [u32; {count}] = [{required}];
+
+/// Counts, for every class, how many of its required keys a top-level JSON
+/// object contains. Keys are matched straight from the input buffer and values
+/// are skipped with IgnoredAny, so nothing is allocated. A key repeated in the
+/// object is only counted once.
+struct KeyCounter<'a> {{
+    seen: &'a mut [u32; {count}],
+    keys: &'a mut [bool; {keys}],
+}}
+
+impl<'de, 'a> serde::de::DeserializeSeed<'de> for KeyCounter<'a> {{
+    type Value = ();
+
+    fn deserialize<D>(self, deserializer: D) -> Result<(), D::Error>
+    where D: serde::Deserializer<'de>
+    {{
+        deserializer.deserialize_str(self)
+    }}
+}}
+
+impl<'de, 'a> serde::de::Visitor<'de> for KeyCounter<'a> {{
+    type Value = ();
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {{
+        f.write_str("an object key")
+    }}
+
+    #[allow(unused_variables)]
+    fn visit_str<E>(self, key: &str) -> Result<(), E>
+    where E: serde::de::Error
+    {{
+        let (seen, keys) = (self.seen, self.keys);
+        match key {{
+"""
+
+DISPATCH_SUFFIX = """            _ => {{}}
         }}
-    }}?;
-    match serde_json::from_slice::<Classes>(bytes) {{
-        Ok(v) => Ok(v),
-        Err(e) => Err(JSONParseError::py_err(e.to_string())),
+        Ok(())
     }}
 }}
 
-#[derive(Serialize, Deserialize, Clone, PartialEq)]
-#[serde(transparent)]
-pub struct JsonValue(serde_json::Value);
+/// The indices into Classes that a document may decode as: the classes with
+/// all of their required keys present, the most specific (the class with the
+/// most required keys) first, then in declaration order.
+struct Discriminant(Vec<usize>);
 
-impl fmt::Debug for JsonValue {{
-    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {{
-        write!(f, "{{}}", self.0)
+impl<'de> Deserialize<'de> for Discriminant {{
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where D: serde::Deserializer<'de>
+    {{
+        deserializer.deserialize_map(DiscriminantVisitor)
     }}
 }}
 
-impl IntoPy<PyObject> for JsonValue {{
-    fn into_py(self, py: Python) -> PyObject {{
-        match self.0 {{
-            serde_json::Value::Null => py.None(),
-            serde_json::Value::Bool(b) => b.into_py(py),
-            serde_json::Value::Number(n) => {{
-                if n.is_i64() {{
-                    // should never fail since we just checked it
-                    n.as_i64().unwrap().into_py(py)
-                }} else {{
-                    // should never fail since it isn't an integer?
-                    n.as_f64().unwrap().into_py(py)
-                }}
-            }},
-            serde_json::Value::String(s) => s.into_py(py),
-            serde_json::Value::Array(v) => {{
-                let vec: Vec<JsonValue> = v.iter().map(|i| JsonValue(i.clone()).into_py(py)).collect();
-                vec.into_py(py)
-            }},
-            serde_json::Value::Object(m) => {{
-                let d = PyDict::new(py);
-                for (k, v) in m.iter() {{
-                    let key = PyString::new(py, &*k);
-                    let value: PyObject = JsonValue(v.clone()).into_py(py);
-                    d.set_item(key, value).unwrap();
-                }}
-                d.into_py(py)
-            }}
+struct DiscriminantVisitor;
+
+impl<'de> serde::de::Visitor<'de> for DiscriminantVisitor {{
+    type Value = Discriminant;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {{
+        f.write_str("a JSON object")
+    }}
+
+    fn visit_map<A>(self, mut map: A) -> Result<Discriminant, A::Error>
+    where A: serde::de::MapAccess<'de>
+    {{
+        let mut seen = [0u32; {count}];
+        let mut keys = [false; {keys}];
+        while let Some(()) =
+            map.next_key_seed(KeyCounter {{ seen: &mut seen, keys: &mut keys }})?
+        {{
+            map.next_value::<serde::de::IgnoredAny>()?;
         }}
+        let mut candidates: Vec<usize> =
+            (0..{count}).filter(|&i| seen[i] == REQUIRED_KEYS[i]).collect();
+        // a stable sort, so classes with as many keys stay in declaration order
+        candidates.sort_by_key(|&i| std::cmp::Reverse(REQUIRED_KEYS[i]));
+        Ok(Discriminant(candidates))
     }}
 }}
 
-impl<'source> pyo3::FromPyObject<'source> for JsonValue {{
-    fn extract(ob: &'source PyAny) -> pyo3::PyResult<JsonValue> {{
-        if let Ok(s) = ob.extract::<String>() {{
-            Ok(JsonValue(serde_json::Value::String(s)))
-        }} else if let Ok(n) = ob.extract::<i64>() {{
-            Ok(JsonValue(serde_json::Value::Number(n.into())))
-        }} else if let Ok(f) = ob.extract::<f64>() {{
-            let flt = match serde_json::Number::from_f64(f) {{
-                Some(v) => Ok(v),
-                None => Err(exceptions::ValueError::py_err("Cannot convert NaN or inf to JSON")),
-            }};
-            Ok(JsonValue(serde_json::Value::Number(flt?)))
-        }} else if let Ok(b) = ob.extract::<bool>() {{
-            Ok(JsonValue(serde_json::Value::Bool(b)))
-        }} else if let Ok(l) = ob.extract::<Vec<JsonValue>>() {{
-            Ok(JsonValue(serde_json::Value::Array(l.into_iter().map(|i| i.0).collect())))
-        }} else if let Ok(d) = ob.extract::<&PyDict>() {{
-            let mut m = serde_json::Map::with_capacity(d.len());
-            for (k, v) in d.iter() {{
-                let key: String = k.extract()?;
-                let value: JsonValue = v.extract()?;
-                m.insert(key, value.0);
+/// Decode as each candidate in turn, like an untagged enum would, since
+/// classes can share their required keys. Returns the first success, or the
+/// error of the most specific candidate.
+fn first_match<F, E>(candidates: Vec<usize>, decode: F, no_match: E) -> PyResult<Classes>
+where
+    F: Fn(usize) -> PyResult<Classes>,
+    E: FnOnce() -> PyErr,
+{{
+    let mut first_error = None;
+    for i in candidates {{
+        match decode(i) {{
+            Ok(value) => return Ok(value),
+            Err(e) => {{
+                first_error.get_or_insert(e);
             }}
-            Ok(JsonValue(serde_json::Value::Object(m)))
-        }} else if ob.extract::<PyObject>()?.is_none() {{
-            Ok(JsonValue(serde_json::Value::Null))
-        }} else {{
-            Err(exceptions::ValueError::py_err("Could not convert object to JSON"))
         }}
     }}
+    Err(first_error.unwrap_or_else(no_match))
 }}
 
+/// Pick the candidate classes from a cheap scan of the top-level keys, then
+/// parse the document as each of them until one succeeds.
+fn classes_from_slice(py: Python, bytes: &[u8], frozen: bool) -> PyResult<Classes> {{
+    let candidates = from_slice_impl::<Discriminant>(py, bytes, frozen)?.0;
+    let decode = |i| match i {{"""
+
+DISPATCH_FOR_CLS = """
+        {index} => Ok(Classes::{cls}Type(from_slice_impl::<{cls}>(py, bytes, frozen)?)),"""
+
+DISPATCH_END = """
+        _ => unreachable!(),
+    }};
+    first_match(candidates, decode, || {{
+        JSONParseError::py_err("JSON object does not match any of {types}")
+    }})
+}}
+"""
+
+BINARY_MODULE_PREFIX = """
+/// loads_{format}(s, /)
+/// --
+///
+/// Decode {title} from bytes or any other buffer into an abserde class,
+/// picked by its keys like loads.
+#[pyfunction]
+pub fn loads_{format}(s: &PyAny) -> PyResult<Classes> {{
+    {loads_timer}let result = with_input_bytes(s, |bytes, _| {{
+        let candidates = {format}_from_slice::<Discriminant>(bytes)?.0;
+        let decode = |i| match i {{"""
+
+BINARY_MODULE_FOR_CLS = """
+            {index} => Ok(Classes::{cls}Type({format}_from_slice::<{cls}>(bytes)?)),"""
+
+BINARY_MODULE_SUFFIX = """
+            _ => unreachable!(),
+        }};
+        first_match(candidates, decode, || {{
+            exceptions::ValueError::py_err("{title} map does not match any of {types}")
+        }})
+    }});
+    {loads_finish}result
+}}
+
+/// dumps_{format}(c, /)
+/// --
+///
+/// Encode abserde class c as {title} bytes.
+#[pyfunction]
+pub fn dumps_{format}(c: PyObject, py: Python) -> PyResult<PyObject> {{
+    {dumps_timer}let result = {dumps}
+    else {{
+        Err(exceptions::ValueError::py_err("Invalid type for dumps_{format}"))
+    }};
+    {dumps_finish}result
+}}
+"""
+
+SIMD_PARSE_IMPL = """
+impl SimdParse for {name} {{
+    fn simd() -> bool {{
+        true
+    }}
+}}
+"""
+
+MODULE_PREFIX = """
 create_exception!({module}, JSONParseError, exceptions::ValueError);
 
+/// loads(s, /)
+/// --
+///
+/// Parse s into an abserde class.
+/// s can be a str, bytes, bytearray, memoryview, or any other buffer.
+#[pyfunction]
+pub fn loads(s: &PyAny) -> PyResult<Classes> {{
+    {timer}let result =
+        with_input_bytes(s, |bytes, frozen| classes_from_slice(s.py(), bytes, frozen));
+    {finish}result
+}}
+
 #[pymodule]
 fn {module}(py: Python, m: &PyModule) -> PyResult<()> {{
-"""  # noqa
+"""
 
 MODULE_SUFFIX = """
     m.add_wrapped(wrap_pyfunction!(loads))?;
     m.add_wrapped(wrap_pyfunction!(dumps))?;
     m.add("JSONParseError", py.get_type::<JSONParseError>())?;
+    set_parse_error(|msg| JSONParseError::py_err(msg));
     Ok(())
 }
 """
@@ -342,11 +908,33 @@ SIMPLE_TYPE_MAP = {
     "int": "i64",
     "bool": "bool",
     "float": "f64",
-    "Any": "JsonValue"
+    "Any": "JsonValue",
+    "Interned": "Interned",
+    "BigInt": "BigInt",
+    # fixed width numbers, named after the Rust type they are stored as
+    "i64": "i64",
+    "i32": "i32",
+    "i16": "i16",
+    "i8": "i8",
+    "u64": "u64",
+    "u32": "u32",
+    "u16": "u16",
+    "u8": "u8",
+    "f64": "f64",
+    "f32": "f32",
 }
 
 CONTAINER_TYPE_MAP = {"List": "Vec", "Optional": "Option"}
 
+NUMBER_TYPES = ["i64", "i32", "i16", "i8", "u64", "u32", "u16", "u8", "f64", "f32"]
+
+FLAT_TYPES = {
+    *NUMBER_TYPES,
+    "bool",
+    *(f"Option<{typ}>" for typ in NUMBER_TYPES),
+    "Option<bool>",
+}
+
 
 RUST_KEYWORDS = [
     'abstract',
@@ -407,6 +995,12 @@ class InvalidTypeError(Exception):
     pass
 
 
+# generated helpers for a class are named after it with this prefix (e.g. the struct
+# loads_columns decodes, Abserde<class>Scalars, or the enum for a Literal field), so
+# classes and Enums may not use it
+RESERVED_PREFIX = "Abserde"
+
+
 def invalid_type(typ: str, container: Optional[str] = None) -> NoReturn:
     if container is not None:
         msg = f"The type {container}[{typ}] is not valid."
@@ -415,15 +1009,80 @@ def invalid_type(typ: str, container: Optional[str] = None) -> NoReturn:
     raise InvalidTypeError(msg)
 
 
+def is_ellipsis(n: AST) -> bool:
+    """Whether n is ..., an Ellipsis node before Python 3.8 and a Constant since"""
+    return isinstance(n, Ellipsis_) or (isinstance(n, Constant) and n.value is Ellipsis)
+
+
+def rust_str(s: str) -> str:
+    """A Rust string literal holding s"""
+    escapes = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+    return '"' + "".join(
+        escapes.get(c, c if c.isprintable() else f"\\u{{{ord(c):x}}}") for c in s
+    ) + '"'
+
+
+def int_fits(value: int, typ: str) -> bool:
+    """Whether value is in the range of the Rust integer type typ, e.g. u8 or i64"""
+    bits = int(typ[1:])
+    if typ.startswith("u"):
+        return 0 <= value < 2 ** bits
+    return -(2 ** (bits - 1)) <= value < 2 ** (bits - 1)
+
+
+def invalid_default(cls: str, field: str) -> NoReturn:
+    raise InvalidTypeError(f"The default value of {cls}.{field} is not valid for its type.")
+
+
+def class_options(n: ClassDef) -> Optional[Dict[str, Any]]:
+    """The options passed to @abserde, or None if n is not an abserde class"""
+    decorators = n.decorator_list
+    if len(decorators) != 1:
+        return None
+    dec = decorators[0]
+    if isinstance(dec, Name) and dec.id == "abserde":
+        return {}
+    if isinstance(dec, Call) and isinstance(dec.func, Name) and dec.func.id == "abserde":
+        # kw.arg is None for **options, which a stub cannot spell out
+        return {kw.arg: literal_eval(kw.value) for kw in dec.keywords if kw.arg is not None}
+    return None
+
+
+def is_enum(n: ClassDef) -> bool:
+    return any(
+        isinstance(base, Name) and base.id == "Enum"
+        or isinstance(base, Attribute) and base.attr == "Enum"
+        for base in n.bases
+    )
+
+
 class ClassGatherer(NodeVisitor):
     classes: List[str]
     unions: Set[Tuple[str, ...]]
+    # the values of each Enum class, which are compiled to Rust enums
+    enums: Dict[str, List[str]]
 
-    def __init__(self):
+    def __init__(self) -> None:
         self.classes = []
         self.unions = set()
+        self.enums = {}
 
     def visit_ClassDef(self, n: ClassDef) -> None:
+        if n.name.startswith(RESERVED_PREFIX):
+            raise InvalidTypeError(
+                f"The class name {n.name} is not valid: names starting with "
+                f"{RESERVED_PREFIX} are reserved."
+            )
+        if is_enum(n):
+            values = []
+            for item in n.body:
+                if isinstance(item, Assign):
+                    value = literal_eval(item.value)
+                    if not isinstance(value, str):
+                        invalid_type(repr(value), n.name)
+                    values.append(value)
+            self.enums[n.name] = values
+            return
         self.classes.append(n.name)
         for item in n.body:
             if isinstance(item, AnnAssign):
@@ -438,10 +1097,29 @@ class ClassGatherer(NodeVisitor):
 
 
 class StubVisitor(NodeVisitor):
-    def __init__(self, config: Config, classes: List[str], unions: Set[Tuple[str, ...]]):
+    def __init__(
+        self,
+        config: Config,
+        classes: List[str],
+        unions: Set[Tuple[str, ...]],
+        enums: Optional[Dict[str, List[str]]] = None,
+    ):
         self.config = config
         self.unions = unions
         self.classes = classes
+        self.enums = enums or {}
+        # classes with counters, when the module is built with stats
+        self.stats_classes: List[str] = []
+        # the classes each class refers to, or None for those simd-json cannot read
+        self.simd_refs: Dict[str, Optional[Set[str]]] = {}
+        # Rust enums written for Literal annotations, by their values
+        self.literals: Dict[Tuple[str, ...], str] = {}
+        # the class and field being converted, used to name Literal enums
+        self.context = ("", "")
+        # required JSON keys of each class, used to dispatch module level loads
+        self.required: Dict[str, List[str]] = {}
+        # classes made only of fixed size fields, see release_gil
+        self.flat_classes: Dict[str, bool] = {}
         self.lib = ""
 
     def convert(self, n: AST) -> str:
@@ -449,11 +1127,73 @@ class StubVisitor(NodeVisitor):
         if isinstance(n, Name):
             return self._convert_simple(n.id)
         if isinstance(n, Subscript):
-            return f'{CONTAINER_TYPE_MAP[n.value.id]}<{self.convert(n.slice.value)}>'
+            inner = n.slice.value
+            if isinstance(n.value, Name) and n.value.id == "Literal":
+                value = literal_eval(inner)
+                return self.literal_enum(value if isinstance(value, tuple) else (value,))
+            if isinstance(n.value, Name) and n.value.id == "Tuple":
+                elts = inner.elts if isinstance(inner, Tuple_) else [inner]
+                if any(is_ellipsis(e) for e in elts):
+                    invalid_type(", ".join(getattr(e, "id", "...") for e in elts), "Tuple")
+                types = [self.convert(e) for e in elts]
+                # a one element tuple needs a trailing comma in Rust too
+                return f"({', '.join(types)}{',' if len(types) == 1 else ''})"
+            if isinstance(n.value, Name) and n.value.id in ("Dict", "Mapping"):
+                if not (isinstance(inner, Tuple_) and len(inner.elts) == 2):
+                    elts = inner.elts if isinstance(inner, Tuple_) else [inner]
+                    invalid_type(", ".join(getattr(e, "id", "...") for e in elts), n.value.id)
+                key, value = inner.elts
+                if not (isinstance(key, Name) and key.id == "str"):
+                    invalid_type(f"{getattr(key, 'id', '...')}, ...", n.value.id)
+                return f"Map<{self.convert(value)}>"
+            return f'{CONTAINER_TYPE_MAP[n.value.id]}<{self.convert(inner)}>'
+
+    def literal_enum(self, values: Tuple[str, ...]) -> str:
+        """The Rust enum for a Literal of string values, written the first time it is used"""
+        if values not in self.literals:
+            for value in values:
+                if not isinstance(value, str):
+                    invalid_type(repr(value), "Literal")
+            cls, field = self.context
+            name = f"{RESERVED_PREFIX}Literal{cls}_{field}"
+            # class names may hold underscores too, e.g. A_b.c and A.b_c
+            taken = set(self.literals.values())
+            suffix = 1
+            while name in taken:
+                name = f"{RESERVED_PREFIX}Literal{cls}_{field}_{suffix}"
+                suffix += 1
+            self.literals[values] = name
+            self.write_literal_enum(name, list(values))
+        return self.literals[values]
+
+    def write_literal_enum(self, name: str, values: List[str]) -> None:
+        variants = []
+        for i, value in enumerate(values):
+            variant = "".join(part.capitalize() for part in re.split(r"[^0-9a-zA-Z]+", value))
+            if not variant or variant[0].isdigit() or variant in variants:
+                variant = f"V{i}"
+            variants.append(variant)
+        self.write(
+            LITERAL_ENUM.format(
+                name=name,
+                values=rust_str(", ".join(values)),
+                variants="".join(" " * 4 + f"{variant},\n" for variant in variants),
+                values_json=", ".join(rust_str(v) for v in values),
+                variant_paths=", ".join(f"{name}::{variant}" for variant in variants),
+                as_str="".join(
+                    " " * 12 + f"{name}::{variant} => {rust_str(v)},\n"
+                    for v, variant in zip(values, variants)
+                ),
+                from_str="".join(
+                    " " * 12 + f"{rust_str(v)} => Ok({name}::{variant}),\n"
+                    for v, variant in zip(values, variants)
+                ),
+            )
+        )
 
     def _convert_simple(self, typ: str) -> str:
         """Utility method to convert Python annotations to Rust types"""
-        if typ in self.classes:
+        if typ in self.classes or typ in self.enums:
             return f"{typ}"
         try:
             return f"{SIMPLE_TYPE_MAP[typ]}"
@@ -466,6 +1206,24 @@ class StubVisitor(NodeVisitor):
         else:
             return name
 
+    def is_shared(self, typ: str) -> bool:
+        """Whether a field of Rust type typ is stored as a Shared Python object"""
+        if typ.startswith("Option<"):
+            typ = typ[len("Option<"):-1]
+        return typ.startswith(("Vec<", "Map<")) or typ == "JsonValue" or typ in self.classes
+
+    def release_gil(self, cls: str) -> str:
+        """Whether (de)serializing cls can take long enough to be worth releasing the GIL"""
+        return "false" if self.flat_classes.get(cls, False) else "true"
+
+    def is_optional(self, item: AnnAssign) -> bool:
+        typ = item.annotation
+        return (
+            isinstance(typ, Subscript)
+            and isinstance(typ.value, Name)
+            and typ.value.id == "Optional"
+        )
+
     def is_union(self, item: AST) -> bool:
         return isinstance(item.annotation, Subscript) and item.annotation.value.id == "Union"
 
@@ -479,63 +1237,155 @@ class StubVisitor(NodeVisitor):
     def writeline(self, s: str) -> None:
         self.lib += s + "\n"
 
-    def write_enum(self, name: str, members: List[str]) -> None:
+    def write_enum(self, name: str, members: List[str], untagged: bool = True) -> None:
         self.write(ENUM_IMPL_PREFIX.format(name=name))
         for elt in members:
-            typ = elt.replace('<', '').replace('>', '')
+            typ = re.sub(r"\W", "", elt)
             self.writeline(" " * 12 + f"{name}::{typ}Type(v) => v.into_py(py),")
         self.write(ENUM_IMPL_SUFFIX.format(name=name))
         for elt in members:
-            typ = elt.replace('<', '').replace('>', '')
+            typ = re.sub(r"\W", "", elt)
             self.writeline(f"""if let Ok(t) = ob.extract::<{elt}>() {{
                                 Ok({name}::{typ}Type(t)) }} else """)
         types = " ".join(members)
-        self.writeline(ENUM_DECL.format(name=name, types=types))
+        if untagged:
+            decl = ENUM_DECL.format(
+                name=name,
+                types=types,
+                derives="Serialize, Deserialize, Clone, PartialEq",
+                attrs="#[serde(untagged)]\n",
+            )
+        else:
+            decl = ENUM_DECL.format(name=name, types=types, derives="Clone", attrs="")
+        self.writeline(decl)
         for elt in members:
-            typ = elt.replace('<', '').replace('>', '')
+            typ = re.sub(r"\W", "", elt)
             self.writeline("#[allow(non_camel_case_types)]\n" + " " * 4 + f"{typ}Type({elt}),")
         self.writeline("}")
         self.writeline(ENUM_IMPL_DEBUG_PREFIX.format(name=name))
         for elt in members:
-            typ = elt.replace('<', '').replace('>', '')
+            typ = re.sub(r"\W", "", elt)
             self.writeline(" " * 12 + f'{name}::{typ}Type(v) => write!(f, "{{:?}}", v),')
         self.writeline(ENUM_IMPL_DEBUG_SUFFIX)
 
+    def write_dispatch(self) -> None:
+        """Write the key-fingerprint dispatch used by the module level loads"""
+        required = [self.required.get(cls, []) for cls in self.classes]
+        count = len(self.classes)
+        owners: Dict[str, List[int]] = {}
+        for i, keys in enumerate(required):
+            for key in keys:
+                owners.setdefault(key, []).append(i)
+        self.write(
+            DISPATCH_PREFIX.format(
+                count=count,
+                keys=len(owners),
+                required=", ".join(str(len(r)) for r in required),
+            )
+        )
+        for k, (key, indices) in enumerate(owners.items()):
+            counts = " ".join(f"seen[{i}] += 1;" for i in indices)
+            self.writeline(
+                " " * 12 + f"{rust_str(key)} if !keys[{k}] => {{ keys[{k}] = true; {counts} }}"
+            )
+        self.write(DISPATCH_SUFFIX.format(count=count, keys=len(owners)))
+        for i, cls in enumerate(self.classes):
+            self.write(DISPATCH_FOR_CLS.format(index=i, cls=cls))
+        self.write(DISPATCH_END.format(types=", ".join(self.classes)))
+
     def visit_Module(self, n: Module) -> None:
         self.write(LIB_USES)
+        for name, values in self.enums.items():
+            self.write_literal_enum(name, values)
         self.generic_visit(n)
         module = self.config.filename
-        self.write_enum("Classes", self.classes)
-        self.write(DUMPS_IMPL_PREFIX)
-        self.write(" else ".join(DUMPS_FOR_CLS.format(cls=cls) for cls in self.classes))
-        self.write(DUMPS_IMPL_SUFFIX)
-        self.write(MODULE_PREFIX.format(module=module))
+        self.write_enum("Classes", self.classes, untagged=False)
+        module_stats = self.module_stats()
+        self.write(DUMPS_IMPL_PREFIX.format(timer=module_stats["dumps_timer"]))
+        self.write(
+            " else ".join(
+                DUMPS_FOR_CLS.format(cls=cls, release=self.release_gil(cls))
+                for cls in self.classes
+            )
+        )
+        self.write(DUMPS_IMPL_SUFFIX.format(finish=module_stats["dumps_finish"]))
+        self.write_dispatch()
+        if self.config.parser == "simd":
+            self.write_simd_parse()
+        for format in self.config.formats:
+            self.write_binary_module(format, module_stats)
+        if self.config.stats:
+            self.write(
+                STATS_IMPL.format(
+                    len=len(self.stats_classes) + 1,
+                    classes=", ".join(
+                        [f"&{cls.upper()}_STATS" for cls in self.stats_classes]
+                        + ["&MODULE_COUNTERS"]
+                    ),
+                )
+            )
+        self.write(
+            MODULE_PREFIX.format(
+                module=module,
+                timer=module_stats["loads_timer"],
+                finish=module_stats["loads_finish"],
+            )
+        )
         for cls in self.classes:
             self.writeline(" " * 4 + f"m.add_class::<{cls}>()?;")
+        if self.config.stats:
+            self.writeline(" " * 4 + "m.add_wrapped(wrap_pyfunction!(stats))?;")
+            self.writeline(" " * 4 + "m.add_wrapped(wrap_pyfunction!(reset_stats))?;")
+        for format in self.config.formats:
+            self.writeline(" " * 4 + f"m.add_wrapped(wrap_pyfunction!(loads_{format}))?;")
+            self.writeline(" " * 4 + f"m.add_wrapped(wrap_pyfunction!(dumps_{format}))?;")
         self.write(MODULE_SUFFIX)
         if self.config.debug:
             print(f"Generated Rust for: {self.config.filename}")
 
     def visit_ClassDef(self, n: ClassDef) -> None:
-        decorators = n.decorator_list
-        if (
-            len(decorators) != 1
-            or not isinstance(decorators[0], Name)
-            or decorators[0].id != "abserde"
-        ):
+        options = class_options(n)
+        if options is None:
             if self.config.debug:
                 print("Skipping class {n.name}")
             self.generic_visit(n)
             return
-        # First, we write out the struct and its members
-        self.write(STRUCT_PREFIX.format(name=n.name))
+        lazy = options.get("lazy", self.config.lazy)
+        # compact instances have no __dict__, so only the declared fields can be set
+        compact = options.get("compact", self.config.compact)
+        skip_defaults = options.get("skip_defaults", self.config.skip_defaults)
         attributes: List[Tuple[str, str]] = []
         # enums that need to be generated later
         enums: List[Tuple[str, Tuple[str, ...]]] = []
+        # Rust expressions for the fields with a default value in the stub
+        defaults: Dict[str, str] = {}
+        # fields left out of dumps when they hold their default (or None)
+        skipped: List[str] = []
+        required = self.required.setdefault(n.name, [])
+        # the first field with a default; every later field needs one too
+        first_default: Optional[str] = None
+        # lazy classes and BigInt fields are read through a serde_json RawValue
+        refs: Optional[Set[str]] = None if lazy else set()
         for item in n.body:
             if isinstance(item, AnnAssign):
                 assert isinstance(item.target, Name)
                 name = item.target.id
+                idents = {node.id for node in walk(item.annotation) if isinstance(node, Name)}
+                if refs is not None and "BigInt" in idents:
+                    refs = None
+                elif refs is not None:
+                    refs |= idents & set(self.classes)
+                if not self.is_optional(item) and item.value is None:
+                    required.append(name)
+                # as in dataclasses, so the constructor's arguments keep their order
+                if item.value is None and first_default is not None:
+                    raise InvalidTypeError(
+                        f"The field {n.name}.{name} has no default but follows "
+                        f"{n.name}.{first_default}, which has one."
+                    )
+                if item.value is not None and first_default is None:
+                    first_default = name
+                self.context = (n.name, name)
                 if self.is_union(item):
                     id = len(self.unions)
                     annotation = f'Union{id}'
@@ -545,43 +1395,406 @@ class StubVisitor(NodeVisitor):
                 else:
                     annotation = self.convert(item.annotation)
                 assert annotation is not None, print(n.name, item.target.id)
-                attributes.append((self.escape_keywords(name), annotation))
-                self.writeline(" " * 4 + "#[pyo3(get, set)]")
-                self.writeline(" " * 4 + f"pub {self.escape_keywords(name)}: {annotation},")
-        self.writeline("}")
+                field = self.escape_keywords(name)
+                if item.value is not None:
+                    defaults[field] = self.default_value(annotation, item.value)
+                    # the constructor cannot tell None from a missing argument for these
+                    none_only = annotation.startswith("Option<") or annotation == "JsonValue"
+                    if none_only and literal_eval(item.value) is not None:
+                        invalid_default(n.name, name)
+                if self.is_shared(annotation):
+                    if field in defaults:
+                        defaults[field] = f"Shared::new({defaults[field]})"
+                    annotation = f"Shared<{annotation}>"
+                if skip_defaults and (field in defaults or self.is_optional(item)):
+                    skipped.append(field)
+                attributes.append((field, annotation))
+        self.flat_classes[n.name] = all(typ in FLAT_TYPES for _, typ in attributes)
+        self.simd_refs[n.name] = refs
+        self.write_defaults(n.name, attributes, defaults, skipped)
+        self.write_scalars(n.name, attributes, defaults)
+        shared = [name for name, typ in attributes if typ.startswith("Shared<")]
+        # the module is set so that pickle can find the class, and classes
+        # caching Python objects in Shared fields take part in cycle collection
+        flags = [] if compact else ["dict"]
+        if shared:
+            flags.append("gc")
+        flags.append(f"module = {rust_str(self.config.filename)}")
+        pyclass = f"#[pyclass({', '.join(flags)})]"
+        if lazy:
+            self.write_lazy_struct(n.name, pyclass, attributes, required, defaults, skipped)
+        else:
+            # First, we write out the struct and its members
+            self.write(STRUCT_PREFIX.format(name=n.name, pyclass=pyclass))
+            for name, annotation in attributes:
+                pyname = name.replace("r#", "")
+                if name in defaults:
+                    self.writeline(" " * 4 + f'#[serde(default = "{n.name}::default_{pyname}")]')
+                if name in skipped:
+                    self.writeline(
+                        " " * 4
+                        + f'#[serde(skip_serializing_if = "{n.name}::is_default_{pyname}")]'
+                    )
+                # with stats, every field gets a getter that counts its calls
+                if name not in shared and not self.config.stats:
+                    self.writeline(" " * 4 + "#[pyo3(get, set)]")
+                self.writeline(" " * 4 + f"pub {name}: {annotation},")
+            self.writeline("}")
         # Then we write out the class implementation.
-        self.write(PYCLASS_PREFIX.format(name=n.name))
-        args = ", ".join(f"{name}: {typ}" for name, typ in attributes)
-        self.write(IMPL_NEW_PREFIX.format(args=args, name=n.name))
-        for pair in attributes:
-            name = pair[0]
-            self.writeline(" " * 16 + f"{name}: {name},")
+        stats = self.write_stats(n.name, attributes)
+        loads = (LAZY_LOADS if lazy else LOADS).format(name=n.name, **stats)
+        self.write(
+            PYCLASS_PREFIX.format(
+                name=n.name, release=self.release_gil(n.name), loads=loads, **stats
+            )
+        )
+        for format in self.config.formats:
+            self.write(
+                BINARY_METHODS.format(
+                    name=n.name, format=format, title=BINARY_FORMATS[format], **stats
+                )
+            )
+        args = ", ".join(
+            f"{name}: {self.new_arg_type(typ, name in defaults)}" for name, typ in attributes
+        )
+        # Optional and shared fields are Option arguments already, which are None
+        # when left out; shared fields then use their default
+        new_defaults = ", ".join(
+            f"{name} = \"{n.name}::default_{name.replace('r#', '')}()\""
+            for name, typ in attributes
+            if name in defaults and not typ.startswith(("Option<", "Shared<"))
+        )
+        self.write(
+            IMPL_NEW_PREFIX.format(
+                args=args,
+                name=n.name,
+                gil=IMPL_NEW_GIL if shared else "",
+                defaults=" " * 4 + f"#[args({new_defaults})]\n" if new_defaults else "",
+            )
+        )
+        for name, _ in attributes:
+            if name in shared and name in defaults:
+                value = (
+                    f"match {name} {{ Some(o) => Shared::from_object(py, o)?, "
+                    f"None => {n.name}::default_{name.replace('r#', '')}() }}"
+                )
+            elif name in shared:
+                value = f"Shared::from_object(py, {name})?"
+            else:
+                value = name
+            if lazy:
+                value = f"Lazy::from_value({value})"
+            self.writeline(" " * 12 + f"{name}: {value},")
+        if lazy:
+            self.writeline(" " * 12 + "source: None,")
+            self.writeline(" " * 12 + "dirty: true,")
+            self.writeline(" " * 12 + "projected: false,")
         self.write(IMPL_NEW_SUFFIX)
+        for i, (name, typ) in enumerate(attributes):
+            pyname = name.replace("r#", "")
+            timer = self.stats_timer(n.name, f"field({i})")
+            if lazy:
+                if name in shared:
+                    to_py, from_py = "v.get(py)", "Shared::from_object(py, value)?"
+                else:
+                    to_py, from_py = "v.clone().into_py(py)", "value.extract(py)?"
+                self.write(
+                    LAZY_ACCESSORS.format(
+                        name=name, pyname=pyname, to_py=to_py, from_py=from_py, timer=timer
+                    )
+                )
+            elif name in shared:
+                self.write(SHARED_ACCESSORS.format(name=name, pyname=pyname, timer=timer))
+            elif self.config.stats:
+                self.write(STATS_ACCESSORS.format(name=name, pyname=pyname, typ=typ, timer=timer))
         self.writeline("}")
         # write out needed enum types
         for name, members in enums:
             self.write_enum(name, [self.convert(n) for n in members])
-        getitem = ("\n" + " " * 12).join(
-            f'"{name}" => Ok(self.{name}.clone().into_py(py)),' for name, _ in attributes
-        )
-        setitem = ("\n" + " " * 12).join(
-            f'"{name}" => Ok(self.{name} = value.extract(py)?),' for name, _ in attributes
-        )
+        if lazy:
+            getitem = ("\n" + " " * 12).join(
+                f'"{name}" => self.get_{name.replace("r#", "")}(),' for name, _ in attributes
+            )
+            setitem = ("\n" + " " * 12).join(
+                f'"{name}" => self.set_{name.replace("r#", "")}(value),' for name, _ in attributes
+            )
+        else:
+            getitem = ("\n" + " " * 12).join(
+                f'"{name}" => Ok(self.{name}.get(py)),' if name in shared
+                else f'"{name}" => Ok(self.{name}.clone().into_py(py)),'
+                for name, _ in attributes
+            )
+            setitem = ("\n" + " " * 12).join(
+                f'"{name}" => self.{name}.set(py, value),' if name in shared
+                else f'"{name}" => Ok(self.{name} = value.extract(py)?),'
+                for name, _ in attributes
+            )
         self.write(
             MAPPING_IMPL.format(
                 name=n.name, len=len(attributes), getitems=getitem, setitems=setitem
             )
         )
         self.write(OBJECT_PROTO.format(name=n.name))
-        self.write(DUNDER_STR)
-        repr_args = ", ".join(f"{name}={{{name}:?}}" for name, _ in attributes)
-        names = ", ".join(f"{name} = self.{name}" if not typ.startswith('Py<')
-                          else f"{name} = self.{name}.as_ref(py).deref()"
-                          for name, typ in attributes)
+        self.write(DUNDER_STR.format(release=self.release_gil(n.name)))
+        self.write(DUNDER_BYTES.format(release=self.release_gil(n.name)))
+        if lazy:
+            repr_args = ", ".join(f"{name}={{{name}}}" for name, _ in attributes)
+            names = ", ".join(f"{name} = self.{name}.repr(&self.source)" for name, _ in attributes)
+        else:
+            repr_args = ", ".join(f"{name}={{{name}:?}}" for name, _ in attributes)
+            names = ", ".join(f"{name} = self.{name}" if not typ.startswith('Py<')
+                              else f"{name} = self.{name}.as_ref(py).deref()"
+                              for name, typ in attributes)
         self.write(DUNDER_REPR.format(name=n.name, args=repr_args, attrs=names))
         self.write(DUNDER_RICHCMP)
         self.writeline("}")
         self.write(DISPLAY_IMPL.format(name=n.name, args=repr_args, attrs=names))
+        if shared:
+            traverse = "".join(" " * 8 + f"self.{name}.traverse(&visit)?;\n" for name in shared)
+            clear = "".join(" " * 8 + f"self.{name}.clear();\n" for name in shared)
+            self.write(GC_IMPL.format(name=n.name, traverse=traverse, clear=clear))
+        self.write(SERIALIZE_FROM_PY.format(name=n.name))
+
+    def write_simd_parse(self) -> None:
+        """Let simd-json parse the classes that hold no RawValue, even through other classes"""
+        simd = {cls for cls, refs in self.simd_refs.items() if refs is not None}
+        changed = True
+        while changed:
+            changed = False
+            for cls in list(simd):
+                refs = self.simd_refs[cls]
+                if refs is not None and not refs <= simd:
+                    simd.discard(cls)
+                    changed = True
+        # the key scan of the module level loads
+        self.write(SIMD_PARSE_IMPL.format(name="Discriminant"))
+        for cls in self.simd_refs:
+            if cls in simd:
+                self.write(SIMD_PARSE_IMPL.format(name=cls))
+            # loads_columns only reads ints, floats and bools
+            self.write(SIMD_PARSE_IMPL.format(name=f"Abserde{cls}Scalars"))
+
+    def write_binary_module(self, format: str, stats: Dict[str, str]) -> None:
+        """Write the module level loads_<format> and dumps_<format> functions"""
+        title = BINARY_FORMATS[format]
+        self.write(BINARY_MODULE_PREFIX.format(format=format, title=title, **stats))
+        for i, cls in enumerate(self.classes):
+            self.write(BINARY_MODULE_FOR_CLS.format(index=i, cls=cls, format=format))
+        dumps = " else ".join(
+            f"if let Ok(o) = c.extract::<{cls}>(py) {{\n"
+            + " " * 8 + f"dumps_{format}_impl(py, &o)\n"
+            + " " * 4 + "}"
+            for cls in self.classes
+        )
+        self.write(
+            BINARY_MODULE_SUFFIX.format(
+                format=format,
+                title=title,
+                types=", ".join(self.classes),
+                dumps=dumps,
+                loads_finish=stats["loads_finish"],
+                dumps_timer=stats["dumps_timer"],
+                dumps_finish=stats["dumps_bytes_finish"],
+            )
+        )
+
+    def stats_timer(self, cls: str, op: str, var: str = "_timer") -> str:
+        """The line starting a Timer for op of cls, if the module is built with stats"""
+        if not self.config.stats:
+            return ""
+        return f"let {var} = {cls.upper()}_STATS.{op}.timer();\n" + " " * 8
+
+    def write_stats(self, name: str, attributes: List[Tuple[str, str]]) -> Dict[str, str]:
+        """Declare the counters of a class, returning the timer code for PYCLASS_PREFIX"""
+        if not self.config.stats:
+            keys = (
+                "loads_timer", "loads_finish", "dumps_timer", "dumps_finish",
+                "dumps_bytes_finish", "dump_finish", "from_binary_finish",
+            )
+            return {**dict.fromkeys(keys, ""), **{f"{op}_stats": "None" for op in BATCH_OPS}}
+        fields = ", ".join(f'"{field.replace("r#", "")}"' for field, _ in attributes)
+        self.write(STATS_DECL.format(stats=f"{name.upper()}_STATS", name=name, fields=fields))
+        self.stats_classes.append(name)
+        finish = "timer.finish({}, result.is_ok());\n" + " " * 8
+        return {
+            "loads_timer": self.stats_timer(name, "loads()", "timer"),
+            "loads_finish": finish.format("input_len(s)"),
+            "dumps_timer": self.stats_timer(name, "dumps()", "timer"),
+            "dumps_finish": finish.format("result.as_ref().map_or(0, |s| s.len())"),
+            "dumps_bytes_finish": finish.format(
+                "result.as_ref().map_or(0, |b| output_len(gil.python(), b))"
+            ),
+            "dump_finish": finish.format("*result.as_ref().unwrap_or(&0)"),
+            "from_binary_finish": finish.format("input_len(data)"),
+            **{f"{op}_stats": f"Some({name.upper()}_STATS.{op}())" for op in BATCH_OPS},
+        }
+
+    def module_stats(self) -> Dict[str, str]:
+        """The timer code for the module level loads and dumps functions"""
+        keys = ("loads_timer", "loads_finish", "dumps_timer", "dumps_finish")
+        if not self.config.stats:
+            return dict.fromkeys(keys + ("dumps_bytes_finish",), "")
+        self.write(MODULE_STATS_DECL)
+        finish = "timer.finish({}, result.is_ok());\n" + " " * 4
+        return {
+            "loads_timer": "let timer = MODULE_COUNTERS.loads().timer();\n" + " " * 4,
+            "loads_finish": finish.format("input_len(s)"),
+            "dumps_timer": "let timer = MODULE_COUNTERS.dumps().timer();\n" + " " * 4,
+            "dumps_finish": finish.format("result.as_ref().map_or(0, |s| s.len())"),
+            "dumps_bytes_finish": finish.format(
+                "result.as_ref().map_or(0, |b| output_len(py, b))"
+            ),
+        }
+
+    def new_arg_type(self, typ: str, has_default: bool) -> str:
+        """The type of a constructor argument for a field of Rust type typ"""
+        if typ.startswith("Shared<"):
+            return "Option<PyObject>" if has_default else "PyObject"
+        return typ
+
+    def default_value(self, typ: str, node: AST) -> str:
+        """A Rust expression of type typ for the default value node of a field"""
+        cls, field = self.context
+        try:
+            value = literal_eval(node)
+        except ValueError:
+            invalid_default(cls, field)
+        if value is None:
+            if typ.startswith("Option<"):
+                return "None"
+            if typ != "JsonValue":
+                invalid_default(cls, field)
+        elif typ == "bool":
+            if not isinstance(value, bool):
+                invalid_default(cls, field)
+            return "true" if value else "false"
+        elif typ in NUMBER_TYPES:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                invalid_default(cls, field)
+            if typ.startswith("f"):
+                return repr(float(value))
+            if not isinstance(value, int) or not int_fits(value, typ):
+                invalid_default(cls, field)
+            return str(value)
+        elif typ in ("String", "Interned"):
+            if not isinstance(value, str):
+                invalid_default(cls, field)
+            return f"{typ}::from({rust_str(value)})" if typ == "String" else (
+                f"Interned::new({rust_str(value)})"
+            )
+        # anything else is built by parsing the default as JSON
+        return f"serde_json::from_str({rust_str(json.dumps(value))}).unwrap()"
+
+    def write_defaults(
+        self,
+        name: str,
+        attributes: List[Tuple[str, str]],
+        defaults: Dict[str, str],
+        skipped: List[str],
+    ) -> None:
+        """Write the functions serde uses for missing keys and for skipping fields in dumps"""
+        functions = []
+        for field, typ in attributes:
+            pyname = field.replace("r#", "")
+            if field in defaults:
+                functions.append(
+                    " " * 4 + f"fn default_{pyname}() -> {typ} {{\n"
+                    + " " * 8 + f"{defaults[field]}\n"
+                    + " " * 4 + "}\n"
+                )
+            if field in skipped:
+                default = f"{name}::default_{pyname}()" if field in defaults else "None"
+                if field not in defaults and typ.startswith("Shared<"):
+                    default = "Shared::new(None)"
+                functions.append(
+                    " " * 4 + f"fn is_default_{pyname}(v: &{typ}) -> bool {{\n"
+                    + " " * 8 + f"*v == {default}\n"
+                    + " " * 4 + "}\n"
+                )
+        if functions:
+            self.write(DEFAULTS_IMPL.format(name=name, functions="\n".join(functions)))
+
+    def write_scalars(
+        self, name: str, attributes: List[Tuple[str, str]], defaults: Dict[str, str]
+    ) -> None:
+        """Write the struct loads_columns decodes, holding only the scalar fields"""
+        scalars = [(field, typ) for field, typ in attributes if typ in FLAT_TYPES]
+        fields = "".join(
+            (
+                " " * 4 + f'#[serde(default = "{name}::default_{field.replace("r#", "")}")]\n'
+                if field in defaults else ""
+            )
+            + " " * 4 + f"{field}: {typ},\n"
+            for field, typ in scalars
+        )
+        columns = "".join(
+            " " * 8 + f'let values = rows.iter().map(|r| r.{field});\n'
+            + " " * 8 + f'let array = {"masked_column" if typ.startswith("Option<") else "column"}'
+            + "(numpy, values)?;\n"
+            + " " * 8 + f'columns.set_item("{field.replace("r#", "")}", array)?;\n'
+            for field, typ in scalars
+        )
+        self.write(SCALARS_STRUCT.format(name=name, fields=fields, columns=columns))
+
+    def write_lazy_struct(
+        self,
+        name: str,
+        pyclass: str,
+        attributes: List[Tuple[str, str]],
+        required: List[str],
+        defaults: Dict[str, str],
+        skipped: List[str],
+    ) -> None:
+        """Write the struct, indexing and serde impls of a class decoded on access"""
+        self.write(LAZY_STRUCT_PREFIX.format(name=name, pyclass=pyclass))
+        for field, typ in attributes:
+            self.writeline(" " * 4 + f"pub {field}: Lazy<{typ}>,")
+        keys = [field.replace("r#", "") for field, _ in attributes]
+        from_spans = "".join(
+            " " * 12 + (
+                f"{field}: Lazy::indexed_or(&spans, only, {i}, "
+                f"{name}::default_{field.replace('r#', '')}),\n"
+                if field in defaults else f"{field}: Lazy::indexed(&spans, only, {i}),\n"
+            )
+            for i, (field, _) in enumerate(attributes)
+        )
+        decode_fields = "".join(
+            " " * 16 + f"Some({i}) => value.{field} = Lazy::from_value(map.next_value()?),\n"
+            for i, (field, _) in enumerate(attributes)
+        )
+        handed_out = "".join(
+            f"\n            && !self.{field}.handed_out()"
+            for field, typ in attributes if typ.startswith("Shared<")
+        )
+        serialize_fields = "".join(
+            " " * 8 + f"if !self.{field}.is_skipped() {{\n"
+            + " " * 12 + f"let v = self.{field}.get(&self.source).map_err(S::Error::custom)?;\n"
+            + (
+                " " * 12 + f"if !{name}::is_default_{key}(v) {{\n"
+                + " " * 16 + f's.serialize_field("{key}", v)?;\n'
+                + " " * 12 + "}\n"
+                if field in skipped else " " * 12 + f's.serialize_field("{key}", v)?;\n'
+            )
+            + " " * 8 + "}\n"
+            for (field, _), key in zip(attributes, keys)
+        )
+        eq = "\n            && ".join(
+            f"self.{field}.same(&self.source, &other.{field}, &other.source)"
+            for field, _ in attributes
+        )
+        self.write(
+            LAZY_STRUCT_SUFFIX.format(
+                name=name,
+                len=len(attributes),
+                names=", ".join(f'"{key}"' for key in keys),
+                required=", ".join("true" if key in required else "false" for key in keys),
+                from_spans=from_spans,
+                decode_fields=decode_fields,
+                handed_out=handed_out,
+                serialize_fields=serialize_fields,
+                eq=eq or "true",
+            )
+        )
 
 
 def gen_bindings(src: str, config: Config) -> str:
@@ -589,5 +1802,5 @@ def gen_bindings(src: str, config: Config) -> str:
     assert isinstance(mod, Module)
     gatherer = ClassGatherer()
     classes, unions = gatherer.run(mod)
-    visitor = StubVisitor(config, classes, unions)
+    visitor = StubVisitor(config, classes, unions, gatherer.enums)
     return visitor.generate_lib(mod)
@@ -1,23 +1,230 @@
+import json
+import queue
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import click
 
+from abserde.bench import bench as run_bench
+from abserde.bench import compare
+from abserde.bench import format_report
+from abserde.bench import SHAPES
 from abserde.config import Config
 from abserde.gen_crate import generate_crate
+from abserde.gen_lib import BINARY_FORMATS
 from abserde.gen_lib import gen_bindings
 
 
-@click.command()
-@click.argument("file")
+def find_stubs(paths: Tuple[str, ...]) -> List[Path]:
+    """The stubs to build: files as given, and the .pyi files in directories, each once"""
+    stubs: List[Path] = []
+    seen = set()
+    for path in map(Path, paths):
+        found = sorted(path.glob("*.pyi")) if path.is_dir() else [path]
+        for stub in found:
+            if stub.resolve() not in seen:
+                seen.add(stub.resolve())
+                stubs.append(stub)
+    return stubs
+
+
+def module_name(stub: Path) -> str:
+    """The name of the module and wheel built from stub"""
+    return stub.name.replace(".pyi", "").replace(".py", "")
+
+
+def build_stub(stub: Path, config: Config, slots: "queue.Queue[int]") -> Tuple[str, float]:
+    """Build stub, returning its status (see generate_crate) and how long it took.
+    A stub that cannot be read or generated fails without stopping the other builds."""
+    start = time.perf_counter()
+    try:
+        with open(stub) as f:
+            src = f.read()
+        mod = gen_bindings(src, config)
+    except Exception as e:
+        if config.debug:
+            traceback.print_exc()
+        print(f"{stub}: {type(e).__name__}: {e}", file=sys.stderr)
+        return "failed", time.perf_counter() - start
+    if config.debug:
+        print(mod)
+    slot = slots.get()
+    try:
+        status = generate_crate(mod, config, slot)
+    finally:
+        slots.put(slot)
+    return status, time.perf_counter() - start
+
+
+class DefaultGroup(click.Group):
+    """Runs build when the first argument is not a command, so `abserde stub.pyi` works"""
+
+    def parse_args(self, ctx: click.Context, args: List[str]) -> List[str]:
+        if args and args[0] not in self.commands and args[0] != "--help":
+            args = ["build", *args]
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup)
+def main() -> None:
+    """Generate fast JSON parsers from type stubs."""
+
+
+@main.command()
+@click.argument("files", nargs=-1, required=True)
 @click.option("-d", "--debug", "debug", is_flag=True, help="Print more output.")
 @click.option("-n", "--name", "name", help="Name for package.")
 @click.option("-e", "--email", "email", help="Email for package.")
-def main(file: str, debug: bool, name: str, email: str) -> None:
-    file_name = Path(file).name.replace(".pyi", "").replace(".py", "")
-    config = Config(file_name, debug, name, email)
-    with open(file) as f:
-        src = f.read()
-    mod = gen_bindings(src, config)
-    if config.debug:
-        print(mod)
-    generate_crate(mod, config)
+@click.option(
+    "--lazy", "lazy", is_flag=True, help="Decode fields of every class only when accessed."
+)
+@click.option(
+    "--compact", "compact", is_flag=True, help="Give no class instances a __dict__."
+)
+@click.option(
+    "--skip-defaults",
+    "skip_defaults",
+    is_flag=True,
+    help="Leave fields holding their default, or None, out of dumps.",
+)
+@click.option(
+    "--stats",
+    "stats",
+    is_flag=True,
+    help="Count calls, bytes, time and allocations, readable with stats().",
+)
+@click.option(
+    "--format",
+    "formats",
+    multiple=True,
+    type=click.Choice(list(BINARY_FORMATS)),
+    help="Also generate loads_FORMAT and dumps_FORMAT. Can be repeated.",
+)
+@click.option(
+    "--parser",
+    "parser",
+    default="serde_json",
+    type=click.Choice(["serde_json", "simd"]),
+    help="Parse with serde_json, or with simd-json where it can (portable wheels).",
+)
+@click.option(
+    "-f", "--force", "force", is_flag=True, help="Rebuild even if the stub has not changed."
+)
+@click.option("-j", "--jobs", "jobs", default=1, help="Number of stubs to build at once.")
+def build(
+    files: Tuple[str, ...],
+    debug: bool,
+    name: str,
+    email: str,
+    lazy: bool,
+    compact: bool,
+    skip_defaults: bool,
+    stats: bool,
+    formats: Tuple[str, ...],
+    parser: str,
+    force: bool,
+    jobs: int,
+) -> None:
+    """Build a wheel for each stub FILE, or each .pyi file in a directory."""
+    if jobs < 1:
+        raise click.BadParameter("must be at least 1", param_hint="--jobs")
+    stubs = find_stubs(files)
+    if not stubs:
+        raise click.ClickException("No stubs found")
+    # a module's crate and wheel are named after it, so two stubs cannot share a name
+    modules: Dict[str, Path] = {}
+    for stub in stubs:
+        if module_name(stub) in modules:
+            raise click.ClickException(
+                f"{modules[module_name(stub)]} and {stub} would both build {module_name(stub)}"
+            )
+        modules[module_name(stub)] = stub
+    # each concurrent build needs its own cargo target directory, see generate_crate
+    slots: "queue.Queue[int]" = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = []
+        for stub in stubs:
+            config = Config(
+                module_name(stub),
+                debug,
+                name,
+                email,
+                lazy,
+                compact,
+                force,
+                skip_defaults,
+                stats,
+                # keep the order stable, so it does not change the build hash
+                tuple(f for f in BINARY_FORMATS if f in formats),
+                parser,
+            )
+            results.append((stub, pool.submit(build_stub, stub, config, slots)))
+        summary = [(stub, *future.result()) for stub, future in results]
+    if len(stubs) > 1 or debug:
+        width = max(len(str(stub)) for stub in stubs)
+        for stub, status, elapsed in summary:
+            print(f"{str(stub):<{width}}  {status:<6}  {elapsed:7.1f}s")
+    failed = [str(stub) for stub, status, _ in summary if status == "failed"]
+    if failed:
+        raise click.ClickException(f"Failed to build {', '.join(failed)}")
+
+
+@main.command()
+@click.argument("stub")
+@click.option("-c", "--class", "cls", help="Class to benchmark, by default the outermost one.")
+@click.option(
+    "--shape",
+    "shape",
+    type=click.Choice(list(SHAPES)),
+    default="default",
+    help="Shape of the generated documents.",
+)
+@click.option("--scale", "scale", default=1.0, help="Multiply list, dict and str lengths.")
+@click.option("--docs", "count", default=1000, help="Number of documents to generate.")
+@click.option("--seed", "seed", default=0, help="Seed for generating documents.")
+@click.option(
+    "-o", "--output", "output", default="abserde-bench.json", help="Where to write the report."
+)
+@click.option("--compare", "previous", help="A previous report to check for regressions.")
+@click.option(
+    "--threshold", "threshold", default=0.1, help="Slowdown that counts as a regression."
+)
+def bench(
+    stub: str,
+    cls: Optional[str],
+    shape: str,
+    scale: float,
+    count: int,
+    seed: int,
+    output: str,
+    previous: Optional[str],
+    threshold: float,
+) -> None:
+    """Benchmark the built and installed module for STUB on generated documents."""
+    try:
+        report = run_bench(stub, cls, shape, scale, count, seed)
+    except ImportError as e:
+        raise click.ClickException(f"{e}. Build and install the wheel for {stub} first.")
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(format_report(report))
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    if previous is None:
+        return
+    with open(previous) as f:
+        changes = compare(json.load(f), report, threshold)
+    for metric, change, regressed in changes:
+        print(f"{metric:<28}{change:+8.1%}{'  REGRESSION' if regressed else ''}")
+    regressions = [metric for metric, _, regressed in changes if regressed]
+    if regressions:
+        raise click.ClickException(f"Regressed since {previous}: {', '.join(regressions)}")
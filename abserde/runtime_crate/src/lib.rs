@@ -0,0 +1,2736 @@
+//! Runtime support shared by every module abserde generates: input
+//! handling for loads, output for dumps, the storage types behind class
+//! fields, and the JSON value used for Any. Generated crates depend on this
+//! crate, so it is compiled once per target directory rather than once per
+//! stub.
+#![feature(specialization)]
+use pyo3::prelude::*;
+use pyo3::exceptions;
+use pyo3::types::{PyBytes, PyByteArray, PyString, PyAny, PyList, PyTuple};
+use pyo3::PyIterProtocol;
+use pyo3::PyNativeType;
+use pyo3::AsPyPointer;
+use pyo3::buffer::PyBuffer;
+use pyo3::ffi;
+use pyo3::types::PyDict;
+use pyo3::gc::{PyTraverseError, PyVisit};
+
+use rayon::prelude::*;
+use serde::{Deserialize, Serialize};
+use std::fmt;
+use std::io;
+use std::io::Read;
+use std::io::Write;
+use std::sync::mpsc::{Receiver, Sender, SyncSender};
+use once_cell::sync::OnceCell;
+use serde_json::value::RawValue;
+use std::sync::Arc;
+use std::sync::{Mutex, MutexGuard, RwLock, TryLockError};
+use std::collections::HashMap;
+use std::collections::hash_map::DefaultHasher;
+use std::hash::{Hash, Hasher};
+use std::alloc::{GlobalAlloc, Layout, System};
+use std::cell::{Cell, RefCell};
+use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+use std::time::Instant;
+use indexmap::IndexMap;
+
+static PARSE_ERROR: OnceCell<fn(String) -> PyErr> = OnceCell::new();
+
+/// Called once by each generated module, with a function raising the
+/// JSONParseError it defines under its own name. Every extension module links
+/// its own copy of this crate, so each keeps its own hook.
+pub fn set_parse_error(make: fn(String) -> PyErr) {
+    let _ = PARSE_ERROR.set(make);
+}
+
+/// The error raised for input that does not parse, or does not match a class.
+pub fn parse_error(msg: impl Into<String>) -> PyErr {
+    let msg = msg.into();
+    match PARSE_ERROR.get() {
+        Some(make) => make(msg),
+        None => exceptions::ValueError::py_err(msg),
+    }
+}
+
+/// release_gil is decided per class when the module is generated: classes made
+/// only of numbers and bools serialize faster than the GIL can change hands.
+pub fn dumps_impl<T>(py: Python, c: &T, release_gil: bool) -> PyResult<String>
+where T: Serialize + Sync
+{
+    let result = if release_gil {
+        py.allow_threads(|| serde_json::to_string(c))
+    } else {
+        serde_json::to_string(c)
+    };
+    result.map_err(|e| exceptions::ValueError::py_err(e.to_string()))
+}
+
+extern "C" {
+    fn _PyBytes_Resize(bytes: *mut *mut ffi::PyObject, size: ffi::Py_ssize_t) -> libc::c_int;
+}
+
+/// An io::Write that fills a Python bytes object directly, growing it in
+/// place the way CPython's own bytes builders do, so the output is never
+/// copied out of a Rust buffer. The GIL must be held while writing, so it is
+/// only used for the binary formats, whose output is small.
+struct BytesWriter<'p> {
+    py: Python<'p>,
+    bytes: *mut ffi::PyObject,
+    len: usize,
+    capacity: usize,
+}
+
+impl<'p> BytesWriter<'p> {
+    fn new(py: Python<'p>, capacity: usize) -> PyResult<Self> {
+        let bytes = unsafe {
+            ffi::PyBytes_FromStringAndSize(std::ptr::null(), capacity as ffi::Py_ssize_t)
+        };
+        if bytes.is_null() {
+            return Err(PyErr::fetch(py));
+        }
+        Ok(BytesWriter { py, bytes, len: 0, capacity })
+    }
+
+    fn resize(&mut self, size: usize) -> PyResult<()> {
+        if unsafe { _PyBytes_Resize(&mut self.bytes, size as ffi::Py_ssize_t) } != 0 {
+            // _PyBytes_Resize has already freed the object
+            self.bytes = std::ptr::null_mut();
+            return Err(PyErr::fetch(self.py));
+        }
+        self.capacity = size;
+        Ok(())
+    }
+
+    /// Shrink the object to what was written and hand it over.
+    fn finish(mut self) -> PyResult<PyObject> {
+        let len = self.len;
+        self.resize(len)?;
+        let bytes = std::mem::replace(&mut self.bytes, std::ptr::null_mut());
+        Ok(unsafe { PyObject::from_owned_ptr(self.py, bytes) })
+    }
+}
+
+impl<'p> io::Write for BytesWriter<'p> {
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        if self.len + buf.len() > self.capacity {
+            let size = std::cmp::max(self.capacity * 2, self.len + buf.len());
+            self.resize(size)
+                .map_err(|_| io::Error::new(io::ErrorKind::Other, "out of memory"))?;
+        }
+        unsafe {
+            let start = ffi::PyBytes_AsString(self.bytes) as *mut u8;
+            std::ptr::copy_nonoverlapping(buf.as_ptr(), start.add(self.len), buf.len());
+        }
+        self.len += buf.len();
+        Ok(buf.len())
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        Ok(())
+    }
+}
+
+impl<'p> Drop for BytesWriter<'p> {
+    fn drop(&mut self) {
+        if !self.bytes.is_null() {
+            unsafe { ffi::Py_DECREF(self.bytes) }
+        }
+    }
+}
+
+/// The first allocation of a BytesWriter; it doubles as needed.
+const BYTES_INITIAL_CAPACITY: usize = 256;
+
+/// Like dumps_impl, but returns bytes. The output is built in a Vec, which
+/// unlike a bytes object can grow without the GIL, and then copied once into
+/// a bytes object of exactly its size.
+pub fn dumps_bytes_impl<T>(py: Python, c: &T, release_gil: bool) -> PyResult<PyObject>
+where T: Serialize + Sync
+{
+    let result = if release_gil {
+        py.allow_threads(|| serde_json::to_vec(c))
+    } else {
+        serde_json::to_vec(c)
+    };
+    let output = result.map_err(|e| exceptions::ValueError::py_err(e.to_string()))?;
+    Ok(PyBytes::new(py, &output).to_object(py))
+}
+
+/// Encode c as packed CBOR for to_binary and pickling: struct fields are
+/// written as their index rather than their name. The output goes straight
+/// into the returned bytes object.
+pub fn to_binary_impl<T>(py: Python, c: &T) -> PyResult<PyObject>
+where T: Serialize
+{
+    let mut writer = BytesWriter::new(py, BYTES_INITIAL_CAPACITY)?;
+    let _cbor = CborOutput::new();
+    let mut serializer =
+        serde_cbor::Serializer::new(serde_cbor::ser::IoWrite::new(&mut writer)).packed_format();
+    c.serialize(&mut serializer).map_err(|e| exceptions::ValueError::py_err(e.to_string()))?;
+    writer.finish()
+}
+
+/// Decode the output of to_binary_impl from bytes or a buffer.
+pub fn from_binary_impl<T>(data: &PyAny) -> PyResult<T>
+where T: serde::de::DeserializeOwned
+{
+    with_input_bytes(data, |bytes, _| cbor_from_slice(bytes))
+}
+
+/// Encode c as CBOR for dumps_cbor. Unlike to_binary, struct fields are
+/// written by name, so any CBOR implementation can read the output.
+pub fn dumps_cbor_impl<T>(py: Python, c: &T) -> PyResult<PyObject>
+where T: Serialize
+{
+    let mut writer = BytesWriter::new(py, BYTES_INITIAL_CAPACITY)?;
+    let _cbor = CborOutput::new();
+    serde_cbor::to_writer(&mut writer, c)
+        .map_err(|e| exceptions::ValueError::py_err(e.to_string()))?;
+    writer.finish()
+}
+
+/// Decode CBOR, with struct fields written either by name or by index.
+pub fn cbor_from_slice<T>(bytes: &[u8]) -> PyResult<T>
+where T: serde::de::DeserializeOwned
+{
+    serde_cbor::from_slice(bytes).map_err(|e| exceptions::ValueError::py_err(e.to_string()))
+}
+
+/// Encode c as MessagePack for dumps_msgpack, with structs written as maps
+/// keyed by field name rather than as arrays.
+pub fn dumps_msgpack_impl<T>(py: Python, c: &T) -> PyResult<PyObject>
+where T: Serialize
+{
+    let mut writer = BytesWriter::new(py, BYTES_INITIAL_CAPACITY)?;
+    rmp_serde::encode::write_named(&mut writer, c)
+        .map_err(|e| exceptions::ValueError::py_err(e.to_string()))?;
+    writer.finish()
+}
+
+/// Decode MessagePack, with structs written either as maps or as arrays.
+pub fn msgpack_from_slice<T>(bytes: &[u8]) -> PyResult<T>
+where T: serde::de::DeserializeOwned
+{
+    rmp_serde::from_slice(bytes).map_err(|e| exceptions::ValueError::py_err(e.to_string()))
+}
+
+thread_local! {
+    /// Set while CBOR is written. Of the binary formats, only CBOR has a
+    /// standard encoding for integers wider than 64 bits: its bignum tags.
+    static WRITING_CBOR: Cell<bool> = Cell::new(false);
+}
+
+/// Marks the current thread as writing CBOR until it is dropped.
+struct CborOutput;
+
+impl CborOutput {
+    fn new() -> Self {
+        WRITING_CBOR.with(|w| w.set(true));
+        CborOutput
+    }
+}
+
+impl Drop for CborOutput {
+    fn drop(&mut self) {
+        WRITING_CBOR.with(|w| w.set(false));
+    }
+}
+
+/// Size of the chunks dump passes to fp.write().
+const DUMP_CHUNK_BYTES: usize = 64 * 1024;
+
+/// Buffers output and passes it to a Python file object's write method one
+/// chunk at a time.
+struct PyWriter<'p> {
+    py: Python<'p>,
+    file: PyObject,
+    chunk: Vec<u8>,
+    written: usize,
+    error: Option<PyErr>,
+}
+
+impl<'p> PyWriter<'p> {
+    fn write_chunk(&mut self) -> io::Result<()> {
+        if self.chunk.is_empty() {
+            return Ok(());
+        }
+        let chunk = PyBytes::new(self.py, &self.chunk);
+        self.written += self.chunk.len();
+        self.chunk.clear();
+        match self.file.call_method1(self.py, "write", (chunk,)) {
+            Ok(_) => Ok(()),
+            Err(e) => {
+                self.error = Some(e);
+                Err(io::Error::new(io::ErrorKind::Other, "write() failed"))
+            }
+        }
+    }
+}
+
+impl<'p> io::Write for PyWriter<'p> {
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        if self.chunk.len() + buf.len() > DUMP_CHUNK_BYTES {
+            self.write_chunk()?;
+        }
+        self.chunk.extend_from_slice(buf);
+        Ok(buf.len())
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        self.write_chunk()
+    }
+}
+
+/// Returns the number of bytes written.
+pub fn dump_impl<T>(py: Python, c: &T, file: PyObject) -> PyResult<usize>
+where T: Serialize
+{
+    let mut writer = PyWriter {
+        py,
+        file,
+        chunk: Vec::with_capacity(DUMP_CHUNK_BYTES),
+        written: 0,
+        error: None,
+    };
+    let result = serde_json::to_writer(&mut writer, c).map_err(io::Error::from)
+        .and_then(|_| writer.flush());
+    match (result, writer.error.take()) {
+        (Ok(()), _) => Ok(writer.written),
+        (Err(_), Some(e)) => Err(e),
+        (Err(e), None) => Err(exceptions::ValueError::py_err(e.to_string())),
+    }
+}
+
+/// Returns the number of bytes written.
+pub fn dump_to_path_impl<T>(py: Python, c: &T, path: &PyAny) -> PyResult<usize>
+where T: Serialize + Sync
+{
+    let os = py.import("os")?;
+    let path: String = os.call1("fspath", (path,))?.extract()?;
+    let written = py.allow_threads(|| {
+        let file = std::fs::File::create(path)?;
+        let mut writer = io::BufWriter::with_capacity(DUMP_CHUNK_BYTES, file);
+        serde_json::to_writer(&mut writer, c)?;
+        writer.flush()?;
+        // the file was truncated when it was created
+        writer.get_ref().metadata().map(|m| m.len() as usize)
+    })?;
+    Ok(written)
+}
+
+/// Inputs at least this large are parsed with the GIL released. Below it,
+/// handing the GIL to another thread and waiting to get it back costs more
+/// than the parse itself.
+const RELEASE_GIL_MIN_BYTES: usize = 16 * 1024;
+
+/// Whether parse_slice may hand a type to simd-json. It is false unless a
+/// module built with --parser simd says otherwise for one of its classes:
+/// types holding a RawValue (lazy classes, BigInt) can only be read by
+/// serde_json.
+pub trait SimdParse {
+    fn simd() -> bool;
+}
+
+impl<T> SimdParse for T {
+    default fn simd() -> bool {
+        false
+    }
+}
+
+/// Whether the CPU has the instructions simd-json is faster than serde_json
+/// with. simd-json picks its instructions at runtime, so wheels stay portable.
+#[cfg(feature = "simd")]
+fn simd_supported() -> bool {
+    #[cfg(any(target_arch = "x86", target_arch = "x86_64"))]
+    {
+        is_x86_feature_detected!("avx2") || is_x86_feature_detected!("sse4.2")
+    }
+    #[cfg(target_arch = "aarch64")]
+    {
+        true
+    }
+    #[cfg(not(any(target_arch = "x86", target_arch = "x86_64", target_arch = "aarch64")))]
+    {
+        false
+    }
+}
+
+/// Scratch memory simd-json parses with, kept per thread so that parsing a
+/// document doesn't allocate it again.
+#[cfg(feature = "simd")]
+#[derive(Default)]
+struct SimdScratch {
+    input: Vec<u8>,
+    buffers: simd_json::Buffers,
+}
+
+/// A thread's scratch is dropped after parsing a larger document, rather than
+/// holding on to the memory for the life of the thread.
+#[cfg(feature = "simd")]
+const SIMD_SCRATCH_MAX_BYTES: usize = 1 << 20;
+
+#[cfg(feature = "simd")]
+thread_local! {
+    static SIMD_SCRATCH: RefCell<SimdScratch> = RefCell::new(SimdScratch::default());
+}
+
+#[cfg(feature = "simd")]
+fn simd_error(e: simd_json::Error) -> serde_json::Error {
+    serde::de::Error::custom(e)
+}
+
+/// Run f with the thread's simd-json scratch, dropping it afterwards if
+/// parsing grew it past SIMD_SCRATCH_MAX_BYTES.
+#[cfg(feature = "simd")]
+fn with_simd_scratch<R, F>(f: F) -> R
+where F: FnOnce(&mut Vec<u8>, &mut simd_json::Buffers) -> R
+{
+    SIMD_SCRATCH.with(|scratch| match scratch.try_borrow_mut() {
+        Ok(mut scratch) => {
+            let SimdScratch { input, buffers } = &mut *scratch;
+            let result = f(input, buffers);
+            if input.capacity() > SIMD_SCRATCH_MAX_BYTES {
+                *scratch = SimdScratch::default();
+            }
+            result
+        }
+        // only when a Deserialize impl parses JSON of its own
+        Err(_) => f(&mut Vec::new(), &mut simd_json::Buffers::default()),
+    })
+}
+
+/// Parse a JSON document, with simd-json when the runtime is built with the
+/// simd feature and both T and the CPU allow it, and serde_json otherwise.
+/// simd-json parses in place, so it is given a copy of bytes in the thread's
+/// scratch; parse_slice_mut avoids the copy for input that may be overwritten.
+pub fn parse_slice<T>(bytes: &[u8]) -> serde_json::Result<T>
+where T: serde::de::DeserializeOwned
+{
+    #[cfg(feature = "simd")]
+    {
+        if T::simd() && simd_supported() {
+            return with_simd_scratch(|input, buffers| {
+                input.clear();
+                input.extend_from_slice(bytes);
+                simd_json::serde::from_slice_with_buffers(input, buffers)
+            })
+            .map_err(simd_error);
+        }
+    }
+    serde_json::from_slice::<T>(bytes)
+}
+
+/// Like parse_slice, but simd-json parses bytes in place, leaving them
+/// overwritten.
+pub fn parse_slice_mut<T>(bytes: &mut [u8]) -> serde_json::Result<T>
+where T: serde::de::DeserializeOwned
+{
+    #[cfg(feature = "simd")]
+    {
+        if T::simd() && simd_supported() {
+            return with_simd_scratch(|_, buffers| {
+                simd_json::serde::from_slice_with_buffers(bytes, buffers)
+            })
+            .map_err(simd_error);
+        }
+    }
+    serde_json::from_slice::<T>(bytes)
+}
+
+/// frozen is true when no other Python thread can modify bytes while the GIL
+/// is released, which only str and bytes guarantee.
+pub fn from_slice_impl<T>(py: Python, bytes: &[u8], frozen: bool) -> PyResult<T>
+where T: serde::de::DeserializeOwned + Send
+{
+    let result = if frozen && bytes.len() >= RELEASE_GIL_MIN_BYTES {
+        py.allow_threads(|| parse_slice::<T>(bytes))
+    } else {
+        parse_slice::<T>(bytes)
+    };
+    result.map_err(|e| parse_error(e.to_string()))
+}
+
+/// Run f over the memory backing s without copying it first.
+/// str uses the UTF-8 buffer CPython caches on the object, bytes its internal
+/// storage, and anything else supporting the buffer protocol (bytearray,
+/// memoryview, mmap, ...) is borrowed through a PyBuffer view.
+/// f is also told whether the memory is frozen (see from_slice_impl). A
+/// buffer never is, even if it is read-only: a read-only memoryview of a
+/// bytearray can still be changed through the bytearray.
+pub fn with_input_bytes<R, F>(s: &PyAny, f: F) -> PyResult<R>
+where F: FnOnce(&[u8], bool) -> PyResult<R>
+{
+    if let Ok(string) = s.downcast::<PyString>() {
+        f(string.as_bytes()?, true)
+    } else if let Ok(bytes) = s.downcast::<PyBytes>() {
+        f(bytes.as_bytes(), true)
+    } else if let Ok(buf) = PyBuffer::get(s.py(), s) {
+        f(buffer_bytes(&buf)?, false)
+    } else {
+        Err(invalid_input(s))
+    }
+}
+
+fn buffer_bytes(buf: &PyBuffer) -> PyResult<&[u8]> {
+    if !buf.is_c_contiguous() {
+        return Err(exceptions::ValueError::py_err("loads() requires a contiguous buffer"));
+    }
+    Ok(unsafe { std::slice::from_raw_parts(buf.buf_ptr() as *const u8, buf.len_bytes()) })
+}
+
+fn invalid_input(s: &PyAny) -> PyErr {
+    exceptions::TypeError::py_err(format!(
+        "loads() takes str, bytes, bytearray, or a buffer, got {}",
+        s.get_type().name()
+    ))
+}
+
+pub fn loads_impl<T>(s: &PyAny) -> PyResult<T>
+where T: serde::de::DeserializeOwned + Send
+{
+    with_input_bytes(s, |bytes, frozen| from_slice_impl::<T>(s.py(), bytes, frozen))
+}
+
+/// A payload of a loads_many batch. str and bytes are borrowed; buffers are
+/// copied, since they could be modified by another Python thread while the
+/// batch is parsed without the GIL (see with_input_bytes).
+enum BatchInput<'p> {
+    Borrowed(&'p [u8]),
+    Owned(Vec<u8>),
+}
+
+impl<'p> BatchInput<'p> {
+    fn new(s: &'p PyAny) -> PyResult<BatchInput<'p>> {
+        if let Ok(string) = s.downcast::<PyString>() {
+            Ok(BatchInput::Borrowed(string.as_bytes()?))
+        } else if let Ok(bytes) = s.downcast::<PyBytes>() {
+            Ok(BatchInput::Borrowed(bytes.as_bytes()))
+        } else if let Ok(buf) = PyBuffer::get(s.py(), s) {
+            Ok(BatchInput::Owned(buffer_bytes(&buf)?.to_vec()))
+        } else {
+            Err(invalid_input(s))
+        }
+    }
+
+    fn len(&self) -> usize {
+        match self {
+            BatchInput::Borrowed(b) => b.len(),
+            BatchInput::Owned(v) => v.len(),
+        }
+    }
+
+    /// Copies are the batch's own, so they are parsed in place.
+    fn parse<T>(&mut self) -> serde_json::Result<T>
+    where T: serde::de::DeserializeOwned
+    {
+        match self {
+            BatchInput::Borrowed(b) => parse_slice::<T>(b),
+            BatchInput::Owned(v) => parse_slice_mut::<T>(v),
+        }
+    }
+}
+
+/// The pool for loads_many(threads=n): a single pool, as large as the most
+/// threads asked for so far. It is kept, since starting threads costs more
+/// than parsing a small batch. A larger request replaces it, and the threads
+/// of the old pool exit once the calls using it return.
+fn thread_pool(n: usize) -> PyResult<Arc<rayon::ThreadPool>> {
+    static POOL: OnceCell<Mutex<Option<Arc<rayon::ThreadPool>>>> = OnceCell::new();
+    let mut pool = POOL.get_or_init(|| Mutex::new(None)).lock().unwrap();
+    if let Some(pool) = pool.as_ref().filter(|pool| pool.current_num_threads() >= n) {
+        return Ok(pool.clone());
+    }
+    let new = rayon::ThreadPoolBuilder::new()
+        .num_threads(n)
+        .build()
+        .map_err(|e| exceptions::ValueError::py_err(e.to_string()))?;
+    let new = Arc::new(new);
+    *pool = Some(new.clone());
+    Ok(new)
+}
+
+/// Parses inputs in order, numbering errors from first.
+fn parse_batch<T>(
+    inputs: &mut [BatchInput], first: usize
+) -> Result<Vec<T>, (usize, serde_json::Error)>
+where T: serde::de::DeserializeOwned
+{
+    inputs
+        .iter_mut()
+        .enumerate()
+        .map(|(i, input)| input.parse::<T>().map_err(|e| (first + i, e)))
+        .collect()
+}
+
+/// stats counts the call, for modules built with --stats.
+pub fn loads_many_impl<T>(
+    payloads: &PyAny, threads: Option<usize>, stats: Option<&OpStats>
+) -> PyResult<Vec<T>>
+where T: serde::de::DeserializeOwned + Send
+{
+    let timer = stats.map(OpStats::timer);
+    let py = payloads.py();
+    let mut inputs = Vec::new();
+    for payload in payloads.iter()? {
+        inputs.push(BatchInput::new(payload?)?);
+    }
+    let bytes = inputs.iter().map(BatchInput::len).sum();
+    let pool = match threads {
+        Some(n) if n > 0 => Some((n, thread_pool(n)?)),
+        _ => None,
+    };
+    let result = py.allow_threads(|| match pool {
+        // the shared pool may have more threads than asked for, so the batch
+        // is split into n parts to keep at most n of them busy
+        Some((n, pool)) => {
+            let size = ((inputs.len() + n - 1) / n).max(1);
+            pool.install(|| {
+                inputs
+                    .par_chunks_mut(size)
+                    .enumerate()
+                    .map(|(c, chunk)| parse_batch::<T>(chunk, c * size))
+                    .collect::<Result<Vec<Vec<T>>, (usize, serde_json::Error)>>()
+            })
+            .map(|parts| parts.into_iter().flatten().collect())
+        }
+        None => inputs
+            .par_iter_mut()
+            .enumerate()
+            .map(|(i, input)| input.parse::<T>().map_err(|e| (i, e)))
+            .collect::<Result<Vec<T>, (usize, serde_json::Error)>>(),
+    });
+    finish_timer(timer, bytes, result.is_ok());
+    result.map_err(|(i, e)| parse_error(format!("payload {}: {}", i, e)))
+}
+
+/// Lines are read from their source this many bytes at a time.
+const LINE_CHUNK_BYTES: usize = 1 << 20;
+
+/// Parses the given (start, end, line number) ranges of buf into Python
+/// objects. The ranges may be overwritten by the parser.
+pub type ParseLines = fn(Python, &mut [u8], &[(usize, usize, usize)]) -> PyResult<Vec<PyObject>>;
+
+pub fn parse_lines<T>(
+    py: Python, buf: &mut [u8], lines: &[(usize, usize, usize)]
+) -> PyResult<Vec<PyObject>>
+where T: serde::de::DeserializeOwned + Send + IntoPy<PyObject>
+{
+    let mut parse = || {
+        lines
+            .iter()
+            .map(|&(start, end, line_no)| {
+                parse_slice_mut::<T>(&mut buf[start..end]).map_err(|e| (line_no, e))
+            })
+            .collect::<Result<Vec<T>, (usize, serde_json::Error)>>()
+    };
+    let size = match (lines.first(), lines.last()) {
+        (Some(first), Some(last)) => last.1 - first.0,
+        _ => 0,
+    };
+    let values = if size >= RELEASE_GIL_MIN_BYTES {
+        py.allow_threads(parse)
+    } else {
+        parse()
+    };
+    match values {
+        Ok(v) => Ok(v.into_iter().map(|v| v.into_py(py)).collect()),
+        Err((line_no, e)) => Err(parse_error(format!("line {}: {}", line_no, e))),
+    }
+}
+
+enum LineSource {
+    File(std::fs::File),
+    Object(PyObject),
+}
+
+/// Iterator returned by iter_lines. Only the current chunk and the lines of
+/// the current batch are kept in memory, however large the input is.
+#[pyclass]
+pub struct LineReader {
+    source: LineSource,
+    buf: Vec<u8>,
+    pos: usize,
+    eof: bool,
+    line_no: usize,
+    batch_size: Option<usize>,
+    parse: ParseLines,
+    stats: Option<&'static OpStats>,
+}
+
+impl LineReader {
+    /// stats counts each call to __next__, for modules built with --stats.
+    pub fn new(
+        source: &PyAny,
+        batch_size: Option<usize>,
+        parse: ParseLines,
+        stats: Option<&'static OpStats>,
+    ) -> PyResult<LineReader> {
+        if batch_size == Some(0) {
+            return Err(exceptions::ValueError::py_err("batch_size must be at least 1"));
+        }
+        let source = if source.hasattr("read")? {
+            LineSource::Object(source.to_object(source.py()))
+        } else {
+            let os = source.py().import("os")?;
+            let path: String = os.call1("fspath", (source,))?.extract()?;
+            LineSource::File(std::fs::File::open(path)?)
+        };
+        Ok(LineReader {
+            source,
+            buf: Vec::with_capacity(LINE_CHUNK_BYTES),
+            pos: 0,
+            eof: false,
+            line_no: 0,
+            batch_size,
+            parse,
+            stats,
+        })
+    }
+
+    /// Drop everything in buf before keep, then append the next chunk of input.
+    fn fill(&mut self, py: Python, keep: usize) -> PyResult<()> {
+        self.buf.drain(..keep);
+        self.pos -= keep;
+        let buf = &mut self.buf;
+        let read = match &mut self.source {
+            LineSource::File(f) => {
+                let len = buf.len();
+                buf.resize(len + LINE_CHUNK_BYTES, 0);
+                let dest = &mut buf[len..];
+                let n = py.allow_threads(|| f.read(dest))?;
+                buf.truncate(len + n);
+                n
+            }
+            LineSource::Object(o) => {
+                let chunk = o.call_method1(py, "read", (LINE_CHUNK_BYTES,))?;
+                with_input_bytes(chunk.as_ref(py), |bytes, _| {
+                    buf.extend_from_slice(bytes);
+                    Ok(bytes.len())
+                })?
+            }
+        };
+        self.eof = read == 0;
+        Ok(())
+    }
+
+    /// Find up to max non-blank lines, reading more input as needed.
+    fn next_batch(&mut self, py: Python, max: usize) -> PyResult<Vec<(usize, usize, usize)>> {
+        let mut lines = Vec::with_capacity(max);
+        while lines.len() < max {
+            let (end, next) = match memchr::memchr(b'\n', &self.buf[self.pos..]) {
+                Some(i) => (self.pos + i, self.pos + i + 1),
+                None if self.eof => {
+                    if self.pos == self.buf.len() {
+                        break;
+                    }
+                    (self.buf.len(), self.buf.len())
+                }
+                None => {
+                    // keep the lines already in this batch, they are parsed from buf
+                    let keep = lines.first().map_or(self.pos, |l: &(usize, usize, usize)| l.0);
+                    self.fill(py, keep)?;
+                    for line in lines.iter_mut() {
+                        line.0 -= keep;
+                        line.1 -= keep;
+                    }
+                    continue;
+                }
+            };
+            self.line_no += 1;
+            if !self.buf[self.pos..end].iter().all(|b| b.is_ascii_whitespace()) {
+                lines.push((self.pos, end, self.line_no));
+            }
+            self.pos = next;
+        }
+        Ok(lines)
+    }
+}
+
+#[pyproto]
+impl PyIterProtocol for LineReader {
+    fn __iter__(slf: PyRef<Self>) -> PyResult<Py<LineReader>> {
+        Ok(slf.into())
+    }
+
+    fn __next__(mut slf: PyRefMut<Self>) -> PyResult<Option<PyObject>> {
+        let gil = GILGuard::acquire();
+        let py = gil.python();
+        let timer = slf.stats.map(OpStats::timer);
+        let max = slf.batch_size.unwrap_or(1);
+        let result = slf.next_batch(py, max).and_then(|lines| {
+            let bytes = lines.iter().map(|&(start, end, _)| end - start).sum();
+            if lines.is_empty() {
+                return Ok((Vec::new(), bytes));
+            }
+            let reader = &mut *slf;
+            Ok(((reader.parse)(py, &mut reader.buf, &lines)?, bytes))
+        });
+        finish_timer(timer, result.as_ref().map_or(0, |r| r.1), result.is_ok());
+        let (mut values, _) = result?;
+        if values.is_empty() {
+            return Ok(None);
+        }
+        match slf.batch_size {
+            Some(_) => Ok(Some(values.into_py(py))),
+            None => Ok(values.pop()),
+        }
+    }
+}
+
+/// Elements are handed from the parsing thread to Python in batches this large.
+const ARRAY_BATCH: usize = 256;
+/// How many batches the parsing thread may get ahead of the Python iterator.
+const ARRAY_QUEUE_LEN: usize = 4;
+
+/// What the parsing thread of iter_array tells the iterator.
+enum ArrayEvent<T> {
+    Batch(Vec<T>),
+    Error(String),
+    /// The parsing thread is waiting for the next chunk of a ChunkSource.
+    NeedInput,
+}
+
+/// A file object or buffer iter_array reads from. Python objects are only
+/// touched on the thread calling __next__, which reads a chunk whenever the
+/// parsing thread asks for one.
+enum ChunkSource {
+    File(PyObject),
+    /// Streamed rather than copied whole, since it may be modified while the
+    /// array is parsed; the PyBuffer keeps it from being resized meanwhile.
+    Buffer { buf: PyBuffer, pos: usize },
+}
+
+impl ChunkSource {
+    /// The next chunk of at most n bytes, empty at the end of the input.
+    fn read(&mut self, py: Python, n: usize) -> PyResult<Vec<u8>> {
+        match self {
+            ChunkSource::File(file) => {
+                let chunk = file.call_method1(py, "read", (n,))?;
+                with_input_bytes(chunk.as_ref(py), |bytes, _| Ok(bytes.to_vec()))
+            }
+            ChunkSource::Buffer { buf, pos } => {
+                let bytes = buffer_bytes(buf)?;
+                let end = std::cmp::min(bytes.len(), *pos + n);
+                let chunk = bytes[*pos..end].to_vec();
+                *pos = end;
+                Ok(chunk)
+            }
+        }
+    }
+}
+
+/// io::Read for the parsing thread over the chunks of a ChunkSource, which it
+/// asks the iterator for with ArrayEvent::NeedInput.
+struct ChunkReader<T> {
+    events: SyncSender<ArrayEvent<T>>,
+    chunks: Receiver<Vec<u8>>,
+    pending: Vec<u8>,
+    pos: usize,
+}
+
+impl<T> io::Read for ChunkReader<T> {
+    fn read(&mut self, out: &mut [u8]) -> io::Result<usize> {
+        if self.pos == self.pending.len() {
+            let closed = || io::Error::new(io::ErrorKind::Other, "iterator was closed");
+            self.events.send(ArrayEvent::NeedInput).map_err(|_| closed())?;
+            self.pending = self.chunks.recv().map_err(|_| closed())?;
+            self.pos = 0;
+        }
+        let n = std::cmp::min(out.len(), self.pending.len() - self.pos);
+        out[..n].copy_from_slice(&self.pending[self.pos..self.pos + n]);
+        self.pos += n;
+        Ok(n)
+    }
+}
+
+/// The memory of a bytes object, readable from another thread while the
+/// owner keeps it alive. Only bytes can be shared, being immutable; buffers
+/// are streamed through a ChunkSource.
+struct SharedMemory {
+    _owner: PyObject,
+    ptr: *const u8,
+    len: usize,
+}
+
+unsafe impl Send for SharedMemory {}
+
+impl SharedMemory {
+    fn new(bytes: &PyBytes) -> SharedMemory {
+        let b = bytes.as_bytes();
+        SharedMemory { _owner: bytes.to_object(bytes.py()), ptr: b.as_ptr(), len: b.len() }
+    }
+
+    fn as_slice(&self) -> &[u8] {
+        unsafe { std::slice::from_raw_parts(self.ptr, self.len) }
+    }
+}
+
+/// Collects parsed elements and sends them to the iterator a batch at a time.
+/// Sending fails once the iterator has been dropped, which stops the parse.
+struct ElementSink<T> {
+    tx: SyncSender<ArrayEvent<T>>,
+    batch: Vec<T>,
+}
+
+impl<T> ElementSink<T> {
+    fn push(&mut self, v: T) -> Result<(), &'static str> {
+        self.batch.push(v);
+        if self.batch.len() >= ARRAY_BATCH {
+            self.flush()
+        } else {
+            Ok(())
+        }
+    }
+
+    fn flush(&mut self) -> Result<(), &'static str> {
+        if self.batch.is_empty() {
+            return Ok(());
+        }
+        let batch = std::mem::replace(&mut self.batch, Vec::with_capacity(ARRAY_BATCH));
+        self.tx.send(ArrayEvent::Batch(batch)).map_err(|_| "iterator was closed")
+    }
+}
+
+/// Walks down the keys in path, skipping every other value with IgnoredAny,
+/// then feeds each element of the array found there to the sink.
+struct ArrayPath<'a, T> {
+    path: &'a [String],
+    sink: &'a mut ElementSink<T>,
+}
+
+impl<'de, 'a, T> serde::de::DeserializeSeed<'de> for ArrayPath<'a, T>
+where T: serde::de::DeserializeOwned
+{
+    type Value = ();
+
+    fn deserialize<D>(self, deserializer: D) -> Result<(), D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        if self.path.is_empty() {
+            deserializer.deserialize_seq(self)
+        } else {
+            deserializer.deserialize_map(self)
+        }
+    }
+}
+
+impl<'de, 'a, T> serde::de::Visitor<'de> for ArrayPath<'a, T>
+where T: serde::de::DeserializeOwned
+{
+    type Value = ();
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        if self.path.is_empty() {
+            f.write_str("a JSON array")
+        } else {
+            write!(f, "a JSON object with the field `{}`", self.path[0])
+        }
+    }
+
+    fn visit_seq<A>(self, mut seq: A) -> Result<(), A::Error>
+    where A: serde::de::SeqAccess<'de>
+    {
+        while let Some(v) = seq.next_element::<T>()? {
+            self.sink.push(v).map_err(serde::de::Error::custom)?;
+        }
+        self.sink.flush().map_err(serde::de::Error::custom)
+    }
+
+    fn visit_map<A>(self, mut map: A) -> Result<(), A::Error>
+    where A: serde::de::MapAccess<'de>
+    {
+        let ArrayPath { path, sink } = self;
+        let mut found = false;
+        while let Some(key) = map.next_key::<String>()? {
+            if !found && key == path[0] {
+                map.next_value_seed(ArrayPath { path: &path[1..], sink: &mut *sink })?;
+                found = true;
+            } else {
+                map.next_value::<serde::de::IgnoredAny>()?;
+            }
+        }
+        if found {
+            Ok(())
+        } else {
+            Err(serde::de::Error::custom(format!("missing field `{}`", path[0])))
+        }
+    }
+}
+
+fn stream_array<'de, T, R>(
+    mut de: serde_json::Deserializer<R>, keys: &[String], tx: SyncSender<ArrayEvent<T>>
+)
+where T: serde::de::DeserializeOwned, R: serde_json::de::Read<'de>
+{
+    use serde::de::DeserializeSeed;
+    let mut sink = ElementSink { tx: tx.clone(), batch: Vec::with_capacity(ARRAY_BATCH) };
+    let seed = ArrayPath { path: keys, sink: &mut sink };
+    if let Err(e) = seed.deserialize(&mut de).and_then(|_| de.end()) {
+        // if the iterator is gone there is nobody left to tell
+        let _ = tx.send(ArrayEvent::Error(e.to_string()));
+    }
+}
+
+/// Iterator returned by iter_array. The document is parsed on a background
+/// thread which stays at most ARRAY_QUEUE_LEN batches ahead, so memory use
+/// does not depend on the length of the array. The thread is joined when the
+/// iterator is dropped.
+#[pyclass]
+pub struct ArrayReader {
+    next: Box<dyn FnMut(Python) -> PyResult<Option<PyObject>> + Send>,
+    stats: Option<&'static OpStats>,
+    worker: Option<std::thread::JoinHandle<()>>,
+}
+
+impl Drop for ArrayReader {
+    fn drop(&mut self) {
+        // hang up first, so the parsing thread stops at its next send or read
+        self.next = Box::new(|_| Ok(None));
+        if let Some(worker) = self.worker.take() {
+            let _ = worker.join();
+        }
+    }
+}
+
+#[pyproto]
+impl PyIterProtocol for ArrayReader {
+    fn __iter__(slf: PyRef<Self>) -> PyResult<Py<ArrayReader>> {
+        Ok(slf.into())
+    }
+
+    fn __next__(mut slf: PyRefMut<Self>) -> PyResult<Option<PyObject>> {
+        let gil = GILGuard::acquire();
+        let timer = slf.stats.map(OpStats::timer);
+        let next = &mut slf.next;
+        let result = next(gil.python());
+        // the input is read by the parsing thread, so its bytes are not counted
+        finish_timer(timer, 0, result.is_ok());
+        result
+    }
+}
+
+/// iter_array reads source, a bytes object, buffer or file object, or else
+/// the file at path, and yields the elements of the array under keys, a
+/// dotted sequence of keys. stats counts each call to __next__, for modules
+/// built with --stats.
+pub fn iter_array_impl<T>(
+    py: Python,
+    source: Option<&PyAny>,
+    path: Option<&PyAny>,
+    keys: Option<&str>,
+    stats: Option<&'static OpStats>,
+) -> PyResult<ArrayReader>
+where T: serde::de::DeserializeOwned + Send + IntoPy<PyObject> + 'static
+{
+    let keys: Vec<String> = match keys {
+        Some(k) => k.split('.').map(String::from).collect(),
+        None => Vec::new(),
+    };
+    let (tx, mut events) = std::sync::mpsc::sync_channel::<ArrayEvent<T>>(ARRAY_QUEUE_LEN);
+    let mut input: Option<(ChunkSource, Sender<Vec<u8>>)> = None;
+    let worker = match (source, path) {
+        (Some(_), Some(_)) => {
+            return Err(exceptions::TypeError::py_err(
+                "iter_array() takes a source or a path, not both",
+            ));
+        }
+        (None, None) => {
+            return Err(exceptions::TypeError::py_err("iter_array() needs a source or a path"));
+        }
+        (None, Some(path)) => {
+            let file_path: String = py.import("os")?.call1("fspath", (path,))?.extract()?;
+            let file = std::fs::File::open(file_path)?;
+            std::thread::spawn(move || {
+                let reader = io::BufReader::with_capacity(LINE_CHUNK_BYTES, file);
+                stream_array(serde_json::Deserializer::from_reader(reader), &keys, tx)
+            })
+        }
+        (Some(source), None) => {
+            if let Ok(bytes) = source.downcast::<PyBytes>() {
+                let memory = SharedMemory::new(bytes);
+                std::thread::spawn(move || {
+                    let de = serde_json::Deserializer::from_slice(memory.as_slice());
+                    stream_array(de, &keys, tx)
+                })
+            } else {
+                let chunk_source = if source.hasattr("read")? {
+                    ChunkSource::File(source.to_object(py))
+                } else if let Ok(buf) = PyBuffer::get(py, source) {
+                    ChunkSource::Buffer { buf, pos: 0 }
+                } else {
+                    return Err(exceptions::TypeError::py_err(format!(
+                        "iter_array() takes bytes, a buffer or a file object, got {}; \
+                         pass a filename as path=",
+                        source.get_type().name()
+                    )));
+                };
+                let (chunks_tx, chunks) = std::sync::mpsc::channel();
+                input = Some((chunk_source, chunks_tx));
+                let reader =
+                    ChunkReader { events: tx.clone(), chunks, pending: Vec::new(), pos: 0 };
+                std::thread::spawn(move || {
+                    let reader = io::BufReader::with_capacity(LINE_CHUNK_BYTES, reader);
+                    stream_array(serde_json::Deserializer::from_reader(reader), &keys, tx)
+                })
+            }
+        }
+    };
+    let mut pending = Vec::new().into_iter();
+    let mut done = false;
+    let next = move |py: Python| loop {
+        if let Some(v) = pending.next() {
+            return Ok(Some(v.into_py(py)));
+        }
+        if done {
+            return Ok(None);
+        }
+        let events = &mut events;
+        match py.allow_threads(move || events.recv()) {
+            Ok(ArrayEvent::Batch(batch)) => pending = batch.into_iter(),
+            Ok(ArrayEvent::Error(e)) => {
+                done = true;
+                return Err(parse_error(e));
+            }
+            Ok(ArrayEvent::NeedInput) => {
+                let (source, chunks) = input.as_mut().expect("only a ChunkSource asks for input");
+                match source.read(py, LINE_CHUNK_BYTES) {
+                    // if the parsing thread is gone, recv() says so next
+                    Ok(chunk) => drop(chunks.send(chunk)),
+                    Err(e) => {
+                        // hanging up stops the parsing thread
+                        input = None;
+                        done = true;
+                        return Err(e);
+                    }
+                }
+            }
+            // the parsing thread finished and hung up
+            Err(_) => done = true,
+        }
+    };
+    Ok(ArrayReader { next: Box::new(next), stats, worker: Some(worker) })
+}
+
+/// Storage for fields holding abserde classes, lists, dicts or Any.
+///
+/// loads fills in value, and dumps serializes it without needing the GIL.
+/// The first time the field is read from Python, value is moved into a Python
+/// object, which is cached in object. Later reads return that same object, so
+/// they are O(1) and allocate nothing, and changes made through it (e.g.
+/// appending to a list) are seen by dumps, which serializes the object in
+/// place (see SharedValue). Setting the field to an instance of a class keeps
+/// that instance; other objects are converted once and stored in value.
+///
+/// value is behind a Mutex because dumps may read it without the GIL while a
+/// getter moves it out. Lock it with lock(), never with value.lock().
+pub struct Shared<T> {
+    value: Mutex<Option<T>>,
+    object: OnceCell<PyObject>,
+}
+
+impl<T> Shared<T>
+where T: SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    pub fn new(value: T) -> Self {
+        Shared { value: Mutex::new(Some(value)), object: OnceCell::new() }
+    }
+
+    /// A field holding object: the object itself if it is an instance of
+    /// the field's class, else its value converted to T.
+    pub fn from_object(py: Python, object: PyObject) -> PyResult<Self> {
+        if T::is_instance(object.as_ref(py)) {
+            let cell = OnceCell::new();
+            let _ = cell.set(object);
+            return Ok(Shared { value: Mutex::new(None), object: cell });
+        }
+        Ok(Shared::new(object.extract::<T>(py)?))
+    }
+
+    /// The holder of the lock may be a dumps running without the GIL, which
+    /// needs the GIL to serialize fields that were handed out. Waiting for it
+    /// with the GIL held would deadlock, so wait with the GIL released.
+    fn lock(&self) -> MutexGuard<Option<T>> {
+        match self.value.try_lock() {
+            Ok(guard) => guard,
+            Err(TryLockError::Poisoned(e)) => e.into_inner(),
+            Err(TryLockError::WouldBlock) => {
+                let gil = Python::acquire_gil();
+                gil.python()
+                    .allow_threads(|| self.value.lock().unwrap_or_else(|e| e.into_inner()))
+            }
+        }
+    }
+
+    pub fn get(&self, py: Python) -> PyObject {
+        if let Some(object) = self.object.get() {
+            return object.clone_ref(py);
+        }
+        let mut value = self.lock();
+        // object is set before the lock is released, so dumps finds either
+        // value or object
+        let object = self.object.get_or_init(|| match value.take() {
+            Some(v) => v.into_py(py),
+            None => py.None(),
+        });
+        object.clone_ref(py)
+    }
+
+    pub fn set(&mut self, py: Python, object: PyObject) -> PyResult<()> {
+        *self = Shared::from_object(py, object)?;
+        Ok(())
+    }
+
+    /// Run f on the current value, converting it back from Python if it has
+    /// been handed out. Only used off the hot paths.
+    pub fn with_value<R, F>(&self, f: F) -> PyResult<R>
+    where F: FnOnce(&T) -> R
+    {
+        if let Some(value) = self.lock().as_ref() {
+            return Ok(f(value));
+        }
+        match self.object.get() {
+            Some(object) => {
+                let gil = Python::acquire_gil();
+                Ok(f(&object.extract::<T>(gil.python())?))
+            }
+            None => Err(exceptions::ValueError::py_err("field has no value")),
+        }
+    }
+
+    /// Visit the cached object, for the class's __traverse__.
+    pub fn traverse(&self, visit: &PyVisit) -> Result<(), PyTraverseError> {
+        match self.object.get() {
+            Some(object) => visit.call(object),
+            None => Ok(()),
+        }
+    }
+
+    /// Drop the cached object, for the class's __clear__. The field has no
+    /// value afterwards.
+    pub fn clear(&mut self) {
+        self.object = OnceCell::new();
+    }
+}
+
+impl<T> Clone for Shared<T>
+where T: Clone + SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    fn clone(&self) -> Self {
+        let value = self.lock().clone();
+        let object = OnceCell::new();
+        if let (None, Some(o)) = (&value, self.object.get()) {
+            let gil = Python::acquire_gil();
+            let _ = object.set(o.clone_ref(gil.python()));
+        }
+        Shared { value: Mutex::new(value), object }
+    }
+}
+
+impl<T> PartialEq for Shared<T>
+where T: PartialEq + SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    fn eq(&self, other: &Self) -> bool {
+        if let (Some(a), Some(b)) = (self.object.get(), other.object.get()) {
+            // both handed out: compare the objects rather than copying them
+            let gil = Python::acquire_gil();
+            let py = gil.python();
+            return a
+                .as_ref(py)
+                .rich_compare(b, pyo3::class::basic::CompareOp::Eq)
+                .and_then(|r| r.is_true(py))
+                .unwrap_or(false);
+        }
+        self.with_value(|a| other.with_value(|b| a == b).unwrap_or(false)).unwrap_or(false)
+    }
+}
+
+impl<T> fmt::Debug for Shared<T>
+where T: fmt::Debug + SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        if let Some(value) = self.lock().as_ref() {
+            return write!(f, "{:?}", value);
+        }
+        match self.object.get() {
+            Some(object) => {
+                let gil = Python::acquire_gil();
+                match object.as_ref(gil.python()).repr() {
+                    Ok(r) => write!(f, "{}", r.to_string_lossy()),
+                    Err(_) => Err(fmt::Error),
+                }
+            }
+            None => Err(fmt::Error),
+        }
+    }
+}
+
+impl<T> Serialize for Shared<T>
+where T: Serialize + SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        {
+            let value = self.lock();
+            if let Some(value) = value.as_ref() {
+                return value.serialize(serializer);
+            }
+        }
+        match self.object.get() {
+            Some(object) => {
+                let gil = Python::acquire_gil();
+                T::serialize_from_py(object.as_ref(gil.python()), serializer)
+            }
+            None => Err(serde::ser::Error::custom("field has no value")),
+        }
+    }
+}
+
+impl<'de, T> Deserialize<'de> for Shared<T>
+where T: Deserialize<'de> + SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        T::deserialize(deserializer).map(Shared::new)
+    }
+}
+
+/// How a Shared field of type T uses the Python object it holds.
+/// serialize_from_py serializes the object as the T it was made from: lists,
+/// dicts, Any values and class instances are read in place, while other
+/// values are cheap to extract and are converted back to T first. Generated
+/// modules implement it for their classes, borrowing the instance.
+pub trait SharedValue {
+    /// Whether ob can be kept as it is, rather than converted to T, when a
+    /// field is set to it.
+    fn is_instance(ob: &PyAny) -> bool;
+
+    fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer;
+}
+
+impl<T> SharedValue for T
+where T: Serialize + for<'a> FromPyObject<'a>
+{
+    default fn is_instance(_ob: &PyAny) -> bool {
+        false
+    }
+
+    default fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        match ob.extract::<T>() {
+            Ok(value) => value.serialize(serializer),
+            Err(_) => Err(serde::ser::Error::custom(wrong_type(ob))),
+        }
+    }
+}
+
+fn wrong_type(ob: &PyAny) -> String {
+    format!("field holds a value of the wrong type: {}", ob.get_type().name())
+}
+
+/// ob serialized as a T, see SharedValue.
+struct FromPy<'a, T>(&'a PyAny, std::marker::PhantomData<T>);
+
+impl<'a, T: SharedValue> FromPy<'a, T> {
+    fn new(ob: &'a PyAny) -> Self {
+        FromPy(ob, std::marker::PhantomData)
+    }
+}
+
+impl<'a, T: SharedValue> Serialize for FromPy<'a, T> {
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        T::serialize_from_py(self.0, serializer)
+    }
+}
+
+impl<T> SharedValue for Vec<T>
+where T: SharedValue + Serialize + for<'a> FromPyObject<'a>
+{
+    fn is_instance(_ob: &PyAny) -> bool {
+        false
+    }
+
+    fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        use serde::ser::SerializeSeq;
+        let list = ob.downcast::<PyList>()
+            .map_err(|_| serde::ser::Error::custom(wrong_type(ob)))?;
+        let mut seq = serializer.serialize_seq(Some(list.len()))?;
+        for item in list.iter() {
+            seq.serialize_element(&FromPy::<T>::new(item))?;
+        }
+        seq.end()
+    }
+}
+
+impl<T> SharedValue for Option<T>
+where T: SharedValue + Serialize + for<'a> FromPyObject<'a>
+{
+    fn is_instance(ob: &PyAny) -> bool {
+        !ob.is_none() && T::is_instance(ob)
+    }
+
+    fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        if ob.is_none() {
+            serializer.serialize_none()
+        } else {
+            serializer.serialize_some(&FromPy::<T>::new(ob))
+        }
+    }
+}
+
+impl<T> SharedValue for Map<T>
+where T: SharedValue + Serialize + for<'a> FromPyObject<'a>
+{
+    fn is_instance(_ob: &PyAny) -> bool {
+        false
+    }
+
+    fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        use serde::ser::SerializeMap;
+        let dict = ob.downcast::<PyDict>()
+            .map_err(|_| serde::ser::Error::custom(wrong_type(ob)))?;
+        let mut map = serializer.serialize_map(Some(dict.len()))?;
+        for (k, v) in dict.iter() {
+            let key = k.extract::<&str>().map_err(|_| serde::ser::Error::custom(wrong_type(k)))?;
+            map.serialize_entry(key, &FromPy::<T>::new(v))?;
+        }
+        map.end()
+    }
+}
+
+impl SharedValue for JsonValue {
+    fn is_instance(_ob: &PyAny) -> bool {
+        false
+    }
+
+    fn serialize_from_py<S>(ob: &PyAny, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        PyValue(ob).serialize(serializer)
+    }
+}
+
+/// A field of a class declared with @abserde(lazy=True).
+///
+/// Lazy classes keep the JSON text they were loaded from and only record
+/// where each field's value starts and ends in it. A field is parsed the first
+/// time it is read, and the result is cached in value, so fields that are
+/// never read are never parsed. Fields set from Python have no span.
+#[derive(Clone)]
+pub struct Lazy<T> {
+    span: Option<(usize, usize)>,
+    /// Left out by loads(s, only=...). Skipped fields cannot be read and
+    /// are not dumped.
+    skipped: bool,
+    value: OnceCell<T>,
+}
+
+impl<T> Lazy<T> {
+    /// The field at index i of a class, given the spans found by index_fields.
+    pub fn indexed(spans: &[Option<(usize, usize)>], only: Option<&[bool]>, i: usize) -> Self {
+        let skipped = only.map_or(false, |only| !only[i]);
+        Lazy { span: spans[i], skipped, value: OnceCell::new() }
+    }
+
+    /// Like indexed, but a field missing from the document holds default().
+    pub fn indexed_or(
+        spans: &[Option<(usize, usize)>],
+        only: Option<&[bool]>,
+        i: usize,
+        default: fn() -> T,
+    ) -> Self {
+        let lazy = Self::indexed(spans, only, i);
+        if lazy.span.is_none() && !lazy.skipped {
+            let _ = lazy.value.set(default());
+        }
+        lazy
+    }
+
+    pub fn from_value(value: T) -> Self {
+        let cell = OnceCell::new();
+        let _ = cell.set(value);
+        Lazy { span: None, skipped: false, value: cell }
+    }
+
+    pub fn is_skipped(&self) -> bool {
+        self.skipped
+    }
+
+    /// The JSON text of the field, if it was loaded from source.
+    fn raw<'s>(&self, source: &'s Option<Arc<Box<RawValue>>>) -> Option<&'s str> {
+        match (source, self.span) {
+            (Some(source), Some((start, end))) => Some(&source.get()[start..end]),
+            _ => None,
+        }
+    }
+}
+
+impl<T> Lazy<T>
+where T: for<'de> Deserialize<'de>
+{
+    pub fn get(&self, source: &Option<Arc<Box<RawValue>>>) -> serde_json::Result<&T> {
+        if let Some(value) = self.value.get() {
+            return Ok(value);
+        }
+        if self.skipped {
+            return Err(serde::de::Error::custom("field was not loaded"));
+        }
+        // a missing field is only allowed if it is Optional, see index_fields
+        let value = serde_json::from_str(self.raw(source).unwrap_or("null"))?;
+        Ok(self.value.get_or_init(|| value))
+    }
+
+    /// Whether two fields hold the same value. A field that cannot be decoded
+    /// only equals one with exactly the same JSON text, so two fields are not
+    /// equal merely because both are invalid.
+    pub fn same(
+        &self,
+        source: &Option<Arc<Box<RawValue>>>,
+        other: &Self,
+        other_source: &Option<Arc<Box<RawValue>>>,
+    ) -> bool
+    where T: PartialEq
+    {
+        match (self.get(source), other.get(other_source)) {
+            (Ok(a), Ok(b)) => a == b,
+            (Err(_), Err(_)) => match (self.raw(source), other.raw(other_source)) {
+                (Some(a), Some(b)) => a == b,
+                _ => false,
+            },
+            _ => false,
+        }
+    }
+
+    pub fn repr(&self, source: &Option<Arc<Box<RawValue>>>) -> String
+    where T: fmt::Debug
+    {
+        match self.get(source) {
+            Ok(value) => format!("{:?}", value),
+            Err(e) => format!("<invalid: {}>", e),
+        }
+    }
+}
+
+impl<T> Lazy<Shared<T>>
+where T: SharedValue + Send + IntoPy<PyObject> + for<'a> FromPyObject<'a>
+{
+    /// Whether the field has been read from Python, and so may have been
+    /// changed in place without going through a setter.
+    pub fn handed_out(&self) -> bool {
+        self.value.get().map_or(false, |shared| shared.object.get().is_some())
+    }
+
+    pub fn traverse(&self, visit: &PyVisit) -> Result<(), PyTraverseError> {
+        match self.value.get() {
+            Some(shared) => shared.traverse(visit),
+            None => Ok(()),
+        }
+    }
+
+    pub fn clear(&mut self) {
+        if let Some(shared) = self.value.get_mut() {
+            shared.clear();
+        }
+    }
+}
+
+/// Maps an object key to its index in the fields of a lazy class. Packed
+/// CBOR (to_binary) writes the index itself as the key.
+pub struct FieldKey(pub &'static [&'static str]);
+
+impl<'de> serde::de::DeserializeSeed<'de> for FieldKey {
+    type Value = Option<usize>;
+
+    fn deserialize<D>(self, deserializer: D) -> Result<Self::Value, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        deserializer.deserialize_str(self)
+    }
+}
+
+impl<'de> serde::de::Visitor<'de> for FieldKey {
+    type Value = Option<usize>;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "a field name")
+    }
+
+    fn visit_str<E>(self, key: &str) -> Result<Self::Value, E>
+    where E: serde::de::Error
+    {
+        Ok(self.0.iter().position(|field| *field == key))
+    }
+
+    fn visit_u64<E>(self, i: u64) -> Result<Self::Value, E>
+    where E: serde::de::Error
+    {
+        Ok(Some(i as usize).filter(|&i| i < self.0.len()))
+    }
+}
+
+/// Records the span of each field's value without parsing it.
+struct FieldSpans<'a> {
+    fields: &'static [&'static str],
+    only: Option<&'a [bool]>,
+    base: usize,
+}
+
+impl<'a, 'de> serde::de::DeserializeSeed<'de> for FieldSpans<'a> {
+    type Value = Vec<Option<(usize, usize)>>;
+
+    fn deserialize<D>(self, deserializer: D) -> Result<Self::Value, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        deserializer.deserialize_map(self)
+    }
+}
+
+impl<'a, 'de> serde::de::Visitor<'de> for FieldSpans<'a> {
+    type Value = Vec<Option<(usize, usize)>>;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "a JSON object")
+    }
+
+    fn visit_map<A>(self, mut map: A) -> Result<Self::Value, A::Error>
+    where A: serde::de::MapAccess<'de>
+    {
+        let mut spans = vec![None; self.fields.len()];
+        let only = self.only;
+        while let Some(key) = map.next_key_seed(FieldKey(self.fields))? {
+            match key.filter(|&i| only.map_or(true, |only| only[i])) {
+                Some(i) => {
+                    let value: &'de RawValue = map.next_value()?;
+                    let start = value.get().as_ptr() as usize - self.base;
+                    spans[i] = Some((start, start + value.get().len()));
+                }
+                None => {
+                    map.next_value::<serde::de::IgnoredAny>()?;
+                }
+            }
+        }
+        Ok(spans)
+    }
+}
+
+/// Find where the value of each field starts and ends in the JSON object text.
+/// Fields not marked in only are skipped like unknown keys.
+pub fn index_fields(
+    text: &str,
+    fields: &'static [&'static str],
+    required: &'static [bool],
+    only: Option<&[bool]>,
+) -> serde_json::Result<Vec<Option<(usize, usize)>>> {
+    use serde::de::{DeserializeSeed, Error};
+    let mut de = serde_json::Deserializer::from_str(text);
+    let base = text.as_ptr() as usize;
+    let spans = FieldSpans { fields, only, base }.deserialize(&mut de)?;
+    de.end()?;
+    for (i, span) in spans.iter().enumerate() {
+        let selected = only.map_or(true, |only| only[i]);
+        if span.is_none() && required[i] && selected {
+            return Err(serde_json::Error::missing_field(fields[i]));
+        }
+    }
+    Ok(spans)
+}
+
+/// For loads(s, only=...): index the object in s, and copy the fields
+/// selected by only into a new object holding just them, returned with their
+/// spans in it. Nothing else of s is kept.
+pub fn loads_projected(
+    s: &PyAny,
+    fields: &'static [&'static str],
+    required: &'static [bool],
+    only: &[bool],
+) -> PyResult<(Box<RawValue>, Vec<Option<(usize, usize)>>)> {
+    with_input_bytes(s, |bytes, frozen| {
+        let project = || {
+            let text = std::str::from_utf8(bytes)
+                .map_err(<serde_json::Error as serde::de::Error>::custom)?;
+            project_fields(text, fields, required, only)
+        };
+        let result = if frozen && bytes.len() >= RELEASE_GIL_MIN_BYTES {
+            s.py().allow_threads(project)
+        } else {
+            project()
+        };
+        result.map_err(|e| parse_error(e.to_string()))
+    })
+}
+
+fn project_fields(
+    text: &str,
+    fields: &'static [&'static str],
+    required: &'static [bool],
+    only: &[bool],
+) -> serde_json::Result<(Box<RawValue>, Vec<Option<(usize, usize)>>)> {
+    let spans = index_fields(text, fields, required, Some(only))?;
+    let mut out = String::from("{");
+    let mut projected = vec![None; spans.len()];
+    for (i, span) in spans.iter().enumerate() {
+        if let (true, Some((start, end))) = (only[i], *span) {
+            if out.len() > 1 {
+                out.push(',');
+            }
+            out.push_str(&serde_json::to_string(fields[i])?);
+            out.push(':');
+            let value_start = out.len();
+            out.push_str(&text[start..end]);
+            projected[i] = Some((value_start, out.len()));
+        }
+    }
+    out.push('}');
+    Ok((RawValue::from_string(out)?, projected))
+}
+
+/// Which of fields are listed in only.
+pub fn field_mask(fields: &[&str], only: &[String]) -> PyResult<Vec<bool>> {
+    let mut mask = vec![false; fields.len()];
+    for name in only {
+        match fields.iter().position(|field| *field == name.as_str()) {
+            Some(i) => mask[i] = true,
+            None => {
+                let msg = format!("No such field {}", name);
+                return Err(exceptions::AttributeError::py_err(msg));
+            }
+        }
+    }
+    Ok(mask)
+}
+
+/// Element types of loads_columns arrays, with their NumPy dtypes.
+pub trait Scalar: Copy + Default {
+    const DTYPE: &'static str;
+}
+
+impl Scalar for i64 {
+    const DTYPE: &'static str = "i8";
+}
+
+impl Scalar for f64 {
+    const DTYPE: &'static str = "f8";
+}
+
+impl Scalar for bool {
+    const DTYPE: &'static str = "?";
+}
+
+macro_rules! scalar {
+    ($($t:ty => $dtype:expr),*) => {
+        $(impl Scalar for $t {
+            const DTYPE: &'static str = $dtype;
+        })*
+    };
+}
+
+scalar!(i32 => "i4", i16 => "i2", i8 => "i1", u64 => "u8", u32 => "u4", u16 => "u2", u8 => "u1",
+        f32 => "f4");
+
+/// A bytearray holding values, each written straight into its memory.
+fn scalar_bytes<'p, T, I>(py: Python<'p>, values: I) -> PyResult<&'p PyByteArray>
+where T: Scalar, I: ExactSizeIterator<Item = T>
+{
+    let len = values.len();
+    let size = len * std::mem::size_of::<T>();
+    let buf: &PyByteArray = unsafe {
+        py.from_owned_ptr_or_err(ffi::PyByteArray_FromStringAndSize(
+            std::ptr::null(),
+            size as ffi::Py_ssize_t,
+        ))?
+    };
+    let data = unsafe { ffi::PyByteArray_AsString(buf.as_ptr()) } as *mut T;
+    let mut written = 0;
+    for v in values.take(len) {
+        // a bytearray's memory is not guaranteed to be aligned for T
+        unsafe { data.add(written).write_unaligned(v) };
+        written += 1;
+    }
+    // never expose uninitialized memory, should values yield fewer than len
+    let rest = (len - written) * std::mem::size_of::<T>();
+    unsafe { std::ptr::write_bytes(data.add(written) as *mut u8, 0, rest) };
+    Ok(buf)
+}
+
+/// A NumPy array holding values, written once into the bytearray backing it.
+pub fn column<'p, T, I>(numpy: &'p PyModule, values: I) -> PyResult<&'p PyAny>
+where T: Scalar, I: ExactSizeIterator<Item = T>
+{
+    let buf = scalar_bytes(numpy.py(), values)?;
+    numpy.call1("frombuffer", (buf, T::DTYPE))
+}
+
+/// A NumPy masked array, with missing or null values masked.
+pub fn masked_column<'p, T, I>(numpy: &'p PyModule, values: I) -> PyResult<&'p PyAny>
+where T: Scalar, I: ExactSizeIterator<Item = Option<T>> + Clone
+{
+    let data = column(numpy, values.clone().map(|v| v.unwrap_or_default()))?;
+    let kwargs = PyDict::new(numpy.py());
+    kwargs.set_item("mask", column(numpy, values.map(|v| v.is_none()))?)?;
+    numpy.getattr("ma")?.call_method("array", (data,), Some(kwargs))
+}
+
+/// (start, end, line number) of each non-blank line of a JSON Lines buffer.
+fn split_lines(bytes: &[u8]) -> Vec<(usize, usize, usize)> {
+    let mut lines = Vec::new();
+    let mut start = 0;
+    let ends = memchr::memchr_iter(b'\n', bytes).chain(std::iter::once(bytes.len()));
+    for (i, end) in ends.enumerate() {
+        let line = bytes.get(start..end).unwrap_or(&[]);
+        if line.iter().any(|b| !b.is_ascii_whitespace()) {
+            lines.push((start, end, i + 1));
+        }
+        start = end + 1;
+    }
+    lines
+}
+
+/// Parse the records for loads_columns: a str, bytes or buffer is read as
+/// JSON Lines, anything else as an iterable of payloads like loads_many.
+/// stats counts the parse, but not building the arrays.
+pub fn load_rows<T>(payloads: &PyAny, stats: Option<&OpStats>) -> PyResult<Vec<T>>
+where T: serde::de::DeserializeOwned + Send
+{
+    let py = payloads.py();
+    let is_buffer = payloads.downcast::<PyString>().is_ok()
+        || payloads.downcast::<PyBytes>().is_ok()
+        || PyBuffer::get(py, payloads).is_ok();
+    if !is_buffer {
+        return loads_many_impl::<T>(payloads, None, stats);
+    }
+    let timer = stats.map(OpStats::timer);
+    let result = with_input_bytes(payloads, |bytes, frozen| {
+        let lines = split_lines(bytes);
+        let parse = || {
+            lines
+                .par_iter()
+                .map(|&(start, end, line_no)| {
+                    parse_slice::<T>(&bytes[start..end]).map_err(|e| (line_no, e))
+                })
+                .collect::<Result<Vec<T>, (usize, serde_json::Error)>>()
+        };
+        let result = if frozen { py.allow_threads(parse) } else { parse() };
+        result
+            .map(|rows| (rows, bytes.len()))
+            .map_err(|(line_no, e)| parse_error(format!("line {}: {}", line_no, e)))
+    });
+    finish_timer(timer, result.as_ref().map_or(0, |r| r.1), result.is_ok());
+    result.map(|r| r.0)
+}
+
+#[derive(Serialize, Deserialize, Clone, PartialEq)]
+#[serde(transparent)]
+pub struct JsonValue(serde_json::Value);
+
+impl fmt::Debug for JsonValue {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        write!(f, "{}", self.0)
+    }
+}
+
+impl IntoPy<PyObject> for JsonValue {
+    fn into_py(self, py: Python) -> PyObject {
+        value_to_py(py, &self.0)
+    }
+}
+
+impl ToPyObject for JsonValue {
+    fn to_object(&self, py: Python) -> PyObject {
+        value_to_py(py, &self.0)
+    }
+}
+
+/// Build the Python object for a JSON value, borrowing it so that nested
+/// arrays and objects are walked once rather than cloned at every level.
+fn value_to_py(py: Python, value: &serde_json::Value) -> PyObject {
+    use serde_json::Value;
+    match value {
+        Value::Null => py.None(),
+        Value::Bool(b) => b.to_object(py),
+        Value::Number(n) => match (n.as_i64(), n.as_u64()) {
+            (Some(i), _) => i.to_object(py),
+            (None, Some(u)) => u.to_object(py),
+            // serde_json numbers are always one of i64, u64 or f64
+            (None, None) => n.as_f64().unwrap_or(std::f64::NAN).to_object(py),
+        },
+        Value::String(s) => s.to_object(py),
+        Value::Array(v) => {
+            PyList::new(py, v.iter().map(|i| value_to_py(py, i))).to_object(py)
+        }
+        Value::Object(m) => {
+            let d = PyDict::new(py);
+            for (k, v) in m {
+                d.set_item(k, value_to_py(py, v)).expect("str keys are always hashable");
+            }
+            d.to_object(py)
+        }
+    }
+}
+
+impl<'source> pyo3::FromPyObject<'source> for JsonValue {
+    fn extract(ob: &'source PyAny) -> pyo3::PyResult<JsonValue> {
+        value_from_py(ob).map(JsonValue)
+    }
+}
+
+/// Convert a Python object to a JSON value with one type check per object.
+/// The checks are type flag tests, so unlike trying each extraction in turn
+/// no exception is created for the types that do not match. bool is checked
+/// before int, since it is a subclass of it.
+fn value_from_py(ob: &PyAny) -> PyResult<serde_json::Value> {
+    use serde_json::Value;
+    let ptr = ob.as_ptr();
+    unsafe {
+        if ob.is_none() {
+            Ok(Value::Null)
+        } else if ffi::PyBool_Check(ptr) != 0 {
+            Ok(Value::Bool(ptr == ffi::Py_True()))
+        } else if ffi::PyUnicode_Check(ptr) != 0 {
+            Ok(Value::String(ob.extract::<&PyString>()?.to_string()?.into_owned()))
+        } else if ffi::PyLong_Check(ptr) != 0 {
+            match ob.extract::<i64>() {
+                Ok(i) => Ok(Value::Number(i.into())),
+                Err(_) => Ok(Value::Number(ob.extract::<u64>()?.into())),
+            }
+        } else if ffi::PyFloat_Check(ptr) != 0 {
+            match serde_json::Number::from_f64(ffi::PyFloat_AsDouble(ptr)) {
+                Some(n) => Ok(Value::Number(n)),
+                None => Err(exceptions::ValueError::py_err("Cannot convert NaN or inf to JSON")),
+            }
+        } else if ffi::PyList_Check(ptr) != 0 {
+            let list = ob.extract::<&PyList>()?;
+            let items: PyResult<Vec<Value>> = list.iter().map(value_from_py).collect();
+            Ok(Value::Array(items?))
+        } else if ffi::PyTuple_Check(ptr) != 0 {
+            let tuple = ob.extract::<&PyTuple>()?;
+            let items: PyResult<Vec<Value>> = tuple.iter().map(value_from_py).collect();
+            Ok(Value::Array(items?))
+        } else if ffi::PyDict_Check(ptr) != 0 {
+            let d = ob.extract::<&PyDict>()?;
+            let mut m = serde_json::Map::with_capacity(d.len());
+            for (k, v) in d.iter() {
+                let key: String = k.extract()?;
+                m.insert(key, value_from_py(v)?);
+            }
+            Ok(Value::Object(m))
+        } else {
+            Err(exceptions::ValueError::py_err("Could not convert object to JSON"))
+        }
+    }
+}
+
+/// A Python object serialized as the JSON value value_from_py would convert
+/// it to, without building the serde_json::Value first.
+struct PyValue<'a>(&'a PyAny);
+
+impl<'a> Serialize for PyValue<'a> {
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        use serde::ser::{Error, SerializeMap, SerializeSeq};
+        let ob = self.0;
+        let ptr = ob.as_ptr();
+        unsafe {
+            if ob.is_none() {
+                serializer.serialize_unit()
+            } else if ffi::PyBool_Check(ptr) != 0 {
+                serializer.serialize_bool(ptr == ffi::Py_True())
+            } else if ffi::PyUnicode_Check(ptr) != 0 {
+                let s = ob.extract::<&PyString>().and_then(|s| s.to_string());
+                serializer.serialize_str(&s.map_err(|_| S::Error::custom("invalid str"))?)
+            } else if ffi::PyLong_Check(ptr) != 0 {
+                match (ob.extract::<i64>(), ob.extract::<u64>()) {
+                    (Ok(i), _) => serializer.serialize_i64(i),
+                    (_, Ok(u)) => serializer.serialize_u64(u),
+                    _ => Err(S::Error::custom("int too large to convert to JSON")),
+                }
+            } else if ffi::PyFloat_Check(ptr) != 0 {
+                let f = ffi::PyFloat_AsDouble(ptr);
+                if !f.is_finite() {
+                    return Err(S::Error::custom("Cannot convert NaN or inf to JSON"));
+                }
+                serializer.serialize_f64(f)
+            } else if ffi::PyList_Check(ptr) != 0 || ffi::PyTuple_Check(ptr) != 0 {
+                let items: Vec<&PyAny> = match ob.downcast::<PyList>() {
+                    Ok(list) => list.iter().collect(),
+                    Err(_) => ob.downcast::<PyTuple>()
+                        .map_err(|_| S::Error::custom("expected a tuple"))?
+                        .iter()
+                        .collect(),
+                };
+                let mut seq = serializer.serialize_seq(Some(items.len()))?;
+                for item in items {
+                    seq.serialize_element(&PyValue(item))?;
+                }
+                seq.end()
+            } else if ffi::PyDict_Check(ptr) != 0 {
+                let d = ob.downcast::<PyDict>().map_err(|_| S::Error::custom("expected a dict"))?;
+                let mut map = serializer.serialize_map(Some(d.len()))?;
+                for (k, v) in d.iter() {
+                    let key = k.extract::<&str>()
+                        .map_err(|_| S::Error::custom("JSON object keys must be str"))?;
+                    map.serialize_entry(key, &PyValue(v))?;
+                }
+                map.end()
+            } else {
+                Err(S::Error::custom("Could not convert object to JSON"))
+            }
+        }
+    }
+}
+
+/// A Dict[str, T] field. Values are decoded as T, keys keep the order they
+/// had in the document, and the dict is built when the field is first read
+/// (fields holding a Map are Shared).
+#[derive(Serialize, Deserialize, Clone, PartialEq)]
+#[serde(transparent)]
+pub struct Map<T>(IndexMap<String, T>);
+
+impl<T: fmt::Debug> fmt::Debug for Map<T> {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        f.debug_map().entries(self.0.iter()).finish()
+    }
+}
+
+impl<T: IntoPy<PyObject>> IntoPy<PyObject> for Map<T> {
+    fn into_py(self, py: Python) -> PyObject {
+        let d = PyDict::new(py);
+        for (k, v) in self.0 {
+            d.set_item(k, v.into_py(py)).expect("str keys are always hashable");
+        }
+        d.to_object(py)
+    }
+}
+
+impl<'source, T: FromPyObject<'source>> FromPyObject<'source> for Map<T> {
+    fn extract(ob: &'source PyAny) -> PyResult<Map<T>> {
+        let d = ob.extract::<&PyDict>()?;
+        let mut m = IndexMap::with_capacity(d.len());
+        for (k, v) in d.iter() {
+            m.insert(k.extract::<String>()?, v.extract::<T>()?);
+        }
+        Ok(Map(m))
+    }
+}
+
+/// The interned Python str for s, created once per process. Used for the
+/// values of Literal and Enum fields, which are compiled to Rust enums.
+pub fn intern_static(py: Python, s: &'static str) -> PyObject {
+    static TABLE: OnceCell<Mutex<HashMap<&'static str, PyObject>>> = OnceCell::new();
+    let mut table = TABLE.get_or_init(Default::default).lock().unwrap();
+    table.entry(s).or_insert_with(|| new_interned(py, s)).clone_ref(py)
+}
+
+fn new_interned(py: Python, s: &str) -> PyObject {
+    let mut ptr = PyString::new(py, s).to_object(py).into_ptr();
+    unsafe {
+        ffi::PyUnicode_InternInPlace(&mut ptr);
+        PyObject::from_owned_ptr(py, ptr)
+    }
+}
+
+struct InternEntry {
+    text: Box<str>,
+    object: OnceCell<PyObject>,
+}
+
+/// A string field annotated Interned. Equal values share one allocation,
+/// found through a process-wide table, so each instance holds one pointer
+/// instead of its own String. They are given to Python as one interned str.
+///
+/// The table is never emptied, so Interned is meant for fields with a small
+/// set of distinct values.
+#[derive(Clone)]
+pub struct Interned(Arc<InternEntry>);
+
+/// The table is split into shards by hash, each behind its own RwLock, so
+/// loads_many workers looking up values that are already interned (the
+/// common case) neither wait on each other nor contend on one lock.
+const INTERN_SHARDS: usize = 64;
+
+type InternShard = RwLock<HashMap<Box<str>, Arc<InternEntry>>>;
+
+fn intern_shard(text: &str) -> &'static InternShard {
+    static TABLE: OnceCell<Vec<InternShard>> = OnceCell::new();
+    let table = TABLE.get_or_init(|| (0..INTERN_SHARDS).map(|_| Default::default()).collect());
+    let mut hasher = DefaultHasher::new();
+    text.hash(&mut hasher);
+    &table[hasher.finish() as usize % INTERN_SHARDS]
+}
+
+impl Interned {
+    pub fn new(text: &str) -> Self {
+        let shard = intern_shard(text);
+        if let Some(entry) = shard.read().unwrap_or_else(|e| e.into_inner()).get(text) {
+            return Interned(entry.clone());
+        }
+        let mut table = shard.write().unwrap_or_else(|e| e.into_inner());
+        // another thread may have added it since the read lock was released
+        let entry = table
+            .entry(text.into())
+            .or_insert_with(|| Arc::new(InternEntry { text: text.into(), object: OnceCell::new() }));
+        Interned(entry.clone())
+    }
+
+    pub fn as_str(&self) -> &str {
+        &self.0.text
+    }
+}
+
+impl PartialEq for Interned {
+    fn eq(&self, other: &Self) -> bool {
+        Arc::ptr_eq(&self.0, &other.0)
+    }
+}
+
+impl fmt::Debug for Interned {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        write!(f, "{:?}", self.as_str())
+    }
+}
+
+impl IntoPy<PyObject> for Interned {
+    fn into_py(self, py: Python) -> PyObject {
+        let text = self.as_str();
+        self.0.object.get_or_init(|| new_interned(py, text)).clone_ref(py)
+    }
+}
+
+impl<'source> FromPyObject<'source> for Interned {
+    fn extract(ob: &'source PyAny) -> PyResult<Interned> {
+        Ok(Interned::new(ob.extract::<&str>()?))
+    }
+}
+
+impl Serialize for Interned {
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        serializer.serialize_str(self.as_str())
+    }
+}
+
+impl<'de> Deserialize<'de> for Interned {
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        struct InternedVisitor;
+
+        impl<'de> serde::de::Visitor<'de> for InternedVisitor {
+            type Value = Interned;
+
+            fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+                write!(f, "a string")
+            }
+
+            fn visit_str<E>(self, s: &str) -> Result<Interned, E>
+            where E: serde::de::Error
+            {
+                Ok(Interned::new(s))
+            }
+        }
+
+        deserializer.deserialize_str(InternedVisitor)
+    }
+}
+
+/// Reads the str value of a Literal or Enum field as its variant. The enums
+/// are written as a str in every format, where MessagePack and packed CBOR
+/// would otherwise write a variant index.
+struct LiteralVisitor<T: 'static> {
+    values: &'static [&'static str],
+    variants: &'static [T],
+}
+
+impl<'de, T: Copy> serde::de::Visitor<'de> for LiteralVisitor<T> {
+    type Value = T;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "one of {:?}", self.values)
+    }
+
+    fn visit_str<E>(self, value: &str) -> Result<T, E>
+    where E: serde::de::Error
+    {
+        match self.values.iter().position(|v| *v == value) {
+            Some(i) => Ok(self.variants[i]),
+            None => Err(E::unknown_variant(value, self.values)),
+        }
+    }
+}
+
+/// Deserialize a Literal or Enum field, where variants[i] is written as values[i].
+pub fn deserialize_literal<'de, D, T>(
+    deserializer: D,
+    values: &'static [&'static str],
+    variants: &'static [T],
+) -> Result<T, D::Error>
+where
+    D: serde::Deserializer<'de>,
+    T: Copy,
+{
+    deserializer.deserialize_str(LiteralVisitor { values, variants })
+}
+
+/// An int field of any size, annotated BigInt. Values that fit in an i64 are
+/// stored and converted as one; larger values keep their decimal digits and
+/// are handed to Python's int parser.
+#[derive(Clone, PartialEq)]
+pub enum BigInt {
+    Small(i64),
+    Big(Box<str>),
+}
+
+impl BigInt {
+    fn from_digits(digits: &str) -> Option<BigInt> {
+        let unsigned = digits.strip_prefix('-').unwrap_or(digits);
+        if unsigned.is_empty() || !unsigned.bytes().all(|b| b.is_ascii_digit()) {
+            return None;
+        }
+        Some(match digits.parse::<i64>() {
+            Ok(small) => BigInt::Small(small),
+            Err(_) => BigInt::Big(digits.into()),
+        })
+    }
+}
+
+impl fmt::Debug for BigInt {
+    fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
+        match self {
+            BigInt::Small(small) => write!(f, "{}", small),
+            BigInt::Big(digits) => write!(f, "{}", digits),
+        }
+    }
+}
+
+impl IntoPy<PyObject> for BigInt {
+    fn into_py(self, py: Python) -> PyObject {
+        match self {
+            BigInt::Small(small) => small.into_py(py),
+            BigInt::Big(digits) => {
+                // digits were checked when the value was created
+                let digits = std::ffi::CString::new(digits.as_bytes()).unwrap();
+                unsafe {
+                    PyObject::from_owned_ptr(
+                        py,
+                        ffi::PyLong_FromString(digits.as_ptr(), std::ptr::null_mut(), 10),
+                    )
+                }
+            }
+        }
+    }
+}
+
+impl<'source> FromPyObject<'source> for BigInt {
+    fn extract(ob: &'source PyAny) -> PyResult<BigInt> {
+        if let Ok(small) = ob.extract::<i64>() {
+            return Ok(BigInt::Small(small));
+        }
+        if unsafe { ffi::PyLong_Check(ob.as_ptr()) } == 0 {
+            return Err(exceptions::TypeError::py_err("expected an int"));
+        }
+        Ok(BigInt::Big(ob.str()?.to_string()?.into()))
+    }
+}
+
+impl Serialize for BigInt {
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        match self {
+            BigInt::Small(small) => serializer.serialize_i64(*small),
+            BigInt::Big(digits) if !serializer.is_human_readable() => {
+                if let Ok(large) = digits.parse::<u64>() {
+                    return serializer.serialize_u64(large);
+                }
+                if !WRITING_CBOR.with(|w| w.get()) {
+                    return Err(serde::ser::Error::custom(format!(
+                        "{} does not fit in 64 bits, the widest integer MessagePack can hold",
+                        digits
+                    )));
+                }
+                // a CBOR bignum: tag 2 holds n, tag 3 holds -1 - n
+                let (tag, bytes) = match digits.strip_prefix('-') {
+                    Some(unsigned) => (3, decrement(digits_to_bytes(unsigned))),
+                    None => (2, digits_to_bytes(digits)),
+                };
+                serde_cbor::tags::Tagged::new(Some(tag), ByteSlice(&bytes)).serialize(serializer)
+            }
+            BigInt::Big(digits) => {
+                let raw = RawValue::from_string(digits.to_string())
+                    .map_err(serde::ser::Error::custom)?;
+                raw.serialize(serializer)
+            }
+        }
+    }
+}
+
+/// Writes a byte string, where a &[u8] would be written as a list of ints.
+struct ByteSlice<'a>(&'a [u8]);
+
+impl Serialize for ByteSlice<'_> {
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where S: serde::Serializer
+    {
+        serializer.serialize_bytes(self.0)
+    }
+}
+
+struct ByteBufVisitor;
+
+impl<'de> serde::de::Visitor<'de> for ByteBufVisitor {
+    type Value = Vec<u8>;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "a byte string")
+    }
+
+    fn visit_bytes<E>(self, v: &[u8]) -> Result<Vec<u8>, E> {
+        Ok(v.to_vec())
+    }
+
+    fn visit_byte_buf<E>(self, v: Vec<u8>) -> Result<Vec<u8>, E> {
+        Ok(v)
+    }
+}
+
+/// The big-endian bytes of an unsigned decimal number.
+fn digits_to_bytes(digits: &str) -> Vec<u8> {
+    // little-endian while digits are added
+    let mut bytes: Vec<u8> = Vec::new();
+    for digit in digits.bytes() {
+        let mut carry = u32::from(digit - b'0');
+        for byte in bytes.iter_mut() {
+            let v = u32::from(*byte) * 10 + carry;
+            *byte = v as u8;
+            carry = v >> 8;
+        }
+        while carry > 0 {
+            bytes.push(carry as u8);
+            carry >>= 8;
+        }
+    }
+    bytes.reverse();
+    bytes
+}
+
+/// The decimal digits of an unsigned big-endian number.
+fn bytes_to_digits(bytes: &[u8]) -> String {
+    // little-endian while bytes are added
+    let mut digits: Vec<u8> = Vec::new();
+    for &byte in bytes {
+        let mut carry = u32::from(byte);
+        for digit in digits.iter_mut() {
+            let v = u32::from(*digit) * 256 + carry;
+            *digit = (v % 10) as u8;
+            carry = v / 10;
+        }
+        while carry > 0 {
+            digits.push((carry % 10) as u8);
+            carry /= 10;
+        }
+    }
+    if digits.is_empty() {
+        digits.push(0);
+    }
+    digits.iter().rev().map(|d| char::from(b'0' + d)).collect()
+}
+
+/// Subtract one from a non-zero big-endian number.
+fn decrement(mut bytes: Vec<u8>) -> Vec<u8> {
+    for byte in bytes.iter_mut().rev() {
+        let (v, borrow) = byte.overflowing_sub(1);
+        *byte = v;
+        if !borrow {
+            break;
+        }
+    }
+    bytes
+}
+
+/// Add one to a big-endian number.
+fn increment(mut bytes: Vec<u8>) -> Vec<u8> {
+    for byte in bytes.iter_mut().rev() {
+        let (v, carry) = byte.overflowing_add(1);
+        *byte = v;
+        if !carry {
+            return bytes;
+        }
+    }
+    bytes.insert(0, 1);
+    bytes
+}
+
+/// Reads a BigInt written by a binary format: an integer, or a CBOR bignum
+/// for one wider than 64 bits.
+struct BigIntVisitor;
+
+impl<'de> serde::de::Visitor<'de> for BigIntVisitor {
+    type Value = BigInt;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "an integer")
+    }
+
+    fn visit_i64<E>(self, v: i64) -> Result<BigInt, E> {
+        Ok(BigInt::Small(v))
+    }
+
+    fn visit_u64<E>(self, v: u64) -> Result<BigInt, E> {
+        Ok(BigInt::from_digits(&v.to_string()).expect("u64 digits are an integer"))
+    }
+
+    fn visit_newtype_struct<D>(self, deserializer: D) -> Result<BigInt, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        // read the tag before the bytes, which may be tagged themselves
+        let tag = serde_cbor::tags::current_cbor_tag();
+        let bytes = deserializer.deserialize_bytes(ByteBufVisitor)?;
+        let digits = match tag {
+            Some(2) => bytes_to_digits(&bytes),
+            Some(3) => format!("-{}", bytes_to_digits(&increment(bytes))),
+            _ => return Err(serde::de::Error::custom("expected an integer or a bignum")),
+        };
+        Ok(BigInt::from_digits(&digits).expect("bignum digits are an integer"))
+    }
+
+    fn visit_str<E>(self, digits: &str) -> Result<BigInt, E>
+    where E: serde::de::Error
+    {
+        // the digit strings to_binary wrote before bignums were supported
+        BigInt::from_digits(digits).ok_or_else(|| E::custom("expected an integer"))
+    }
+}
+
+/// serde_json hands the JSON text of a value to a visitor that asks for a
+/// newtype struct of this name, which is how it deserializes RawValue.
+const RAW_VALUE_TOKEN: &str = "$serde_json::private::RawValue";
+
+/// Reads a BigInt from JSON. serde_json would round integers beyond u64 to an
+/// f64, so the number is read as its text, borrowed from the input where it
+/// can be, which keeps every digit. Only numbers that do not fit in an i64
+/// are copied, into BigInt::Big.
+struct JsonBigIntVisitor;
+
+impl<'de> serde::de::Visitor<'de> for JsonBigIntVisitor {
+    type Value = BigInt;
+
+    fn expecting(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        write!(f, "an integer")
+    }
+
+    // deserializers other than serde_json's give numbers as they are
+    fn visit_i64<E>(self, v: i64) -> Result<BigInt, E> {
+        Ok(BigInt::Small(v))
+    }
+
+    fn visit_u64<E>(self, v: u64) -> Result<BigInt, E> {
+        Ok(BigInt::from_digits(&v.to_string()).expect("u64 digits are an integer"))
+    }
+
+    fn visit_newtype_struct<D>(self, deserializer: D) -> Result<BigInt, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        deserializer.deserialize_any(self)
+    }
+
+    /// serde_json's raw value: a map with one entry holding the text.
+    fn visit_map<A>(self, mut map: A) -> Result<BigInt, A::Error>
+    where A: serde::de::MapAccess<'de>
+    {
+        map.next_key::<serde::de::IgnoredAny>()?;
+        map.next_value_seed(self)
+    }
+
+    fn visit_str<E>(self, text: &str) -> Result<BigInt, E>
+    where E: serde::de::Error
+    {
+        BigInt::from_digits(text)
+            .ok_or_else(|| E::custom(format!("expected an integer, got {}", text)))
+    }
+}
+
+impl<'de> serde::de::DeserializeSeed<'de> for JsonBigIntVisitor {
+    type Value = BigInt;
+
+    fn deserialize<D>(self, deserializer: D) -> Result<BigInt, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        deserializer.deserialize_str(self)
+    }
+}
+
+impl<'de> Deserialize<'de> for BigInt {
+    fn deserialize<D>(deserializer: D) -> Result<Self, D::Error>
+    where D: serde::Deserializer<'de>
+    {
+        if !deserializer.is_human_readable() {
+            return deserializer.deserialize_any(BigIntVisitor);
+        }
+        deserializer.deserialize_newtype_struct(RAW_VALUE_TOKEN, JsonBigIntVisitor)
+    }
+}
+
+/// The global allocator of modules built with --stats. It counts the
+/// allocations made on every thread, so a Timer also sees those made by the
+/// rayon workers and reader threads of the call it measures. The count is
+/// process wide: allocations by other calls running at the same time are
+/// included too.
+pub struct CountingAlloc;
+
+/// Allocations are counted in these, one per thread (round robin), each on
+/// its own cache line so that threads do not contend, and summed when read.
+const ALLOCATION_SHARDS: usize = 64;
+
+#[repr(align(64))]
+struct AllocationShard(AtomicU64);
+
+const EMPTY_SHARD: AllocationShard = AllocationShard(AtomicU64::new(0));
+static ALLOCATIONS: [AllocationShard; ALLOCATION_SHARDS] = [EMPTY_SHARD; ALLOCATION_SHARDS];
+static NEXT_SHARD: AtomicUsize = AtomicUsize::new(0);
+
+thread_local! {
+    static SHARD: usize = NEXT_SHARD.fetch_add(1, Ordering::Relaxed) % ALLOCATION_SHARDS;
+}
+
+fn count_allocation() {
+    // try_with, since the allocator can run while thread locals are torn down
+    let shard = SHARD.try_with(|shard| *shard).unwrap_or(0);
+    ALLOCATIONS[shard].0.fetch_add(1, Ordering::Relaxed);
+}
+
+fn allocations() -> u64 {
+    ALLOCATIONS.iter().map(|shard| shard.0.load(Ordering::Relaxed)).sum()
+}
+
+unsafe impl GlobalAlloc for CountingAlloc {
+    unsafe fn alloc(&self, layout: Layout) -> *mut u8 {
+        count_allocation();
+        System.alloc(layout)
+    }
+
+    unsafe fn alloc_zeroed(&self, layout: Layout) -> *mut u8 {
+        count_allocation();
+        System.alloc_zeroed(layout)
+    }
+
+    unsafe fn realloc(&self, ptr: *mut u8, layout: Layout, new_size: usize) -> *mut u8 {
+        count_allocation();
+        System.realloc(ptr, layout, new_size)
+    }
+
+    unsafe fn dealloc(&self, ptr: *mut u8, layout: Layout) {
+        System.dealloc(ptr, layout)
+    }
+}
+
+const HISTOGRAM_BUCKETS: usize = 32;
+
+/// Counters for one kind of call: loads or dumps of a class, one of its
+/// batch or streaming loads, or reading one of its fields. Bucket i of the
+/// histogram counts calls that took less than 2^i nanoseconds, and the last
+/// bucket everything slower.
+#[derive(Default)]
+pub struct OpStats {
+    calls: AtomicU64,
+    errors: AtomicU64,
+    bytes: AtomicU64,
+    nanos: AtomicU64,
+    allocations: AtomicU64,
+    histogram: [AtomicU64; HISTOGRAM_BUCKETS],
+}
+
+impl OpStats {
+    pub fn timer(&self) -> Timer {
+        Timer { op: self, start: Instant::now(), allocations: allocations(), bytes: 0, ok: true }
+    }
+
+    fn to_dict(&self, py: Python) -> PyResult<PyObject> {
+        let d = PyDict::new(py);
+        d.set_item("calls", self.calls.load(Ordering::Relaxed))?;
+        d.set_item("errors", self.errors.load(Ordering::Relaxed))?;
+        d.set_item("bytes", self.bytes.load(Ordering::Relaxed))?;
+        d.set_item("seconds", self.nanos.load(Ordering::Relaxed) as f64 / 1e9)?;
+        d.set_item("allocations", self.allocations.load(Ordering::Relaxed))?;
+        let histogram = PyDict::new(py);
+        for (i, bucket) in self.histogram.iter().enumerate() {
+            let count = bucket.load(Ordering::Relaxed);
+            if count > 0 {
+                histogram.set_item(1u64 << i, count)?;
+            }
+        }
+        d.set_item("histogram_ns", histogram)?;
+        Ok(d.to_object(py))
+    }
+
+    fn reset(&self) {
+        let counters = [&self.calls, &self.errors, &self.bytes, &self.nanos, &self.allocations];
+        for counter in counters.iter().copied().chain(self.histogram.iter()) {
+            counter.store(0, Ordering::Relaxed);
+        }
+    }
+}
+
+/// Records a call in its OpStats when dropped.
+pub struct Timer<'a> {
+    op: &'a OpStats,
+    start: Instant,
+    allocations: u64,
+    bytes: usize,
+    ok: bool,
+}
+
+impl<'a> Timer<'a> {
+    /// Record the bytes read or written by the call, and whether it failed.
+    pub fn finish(mut self, bytes: usize, ok: bool) {
+        self.bytes = bytes;
+        self.ok = ok;
+    }
+}
+
+/// Finish the timer of a runtime function that times itself, if it has one.
+fn finish_timer(timer: Option<Timer>, bytes: usize, ok: bool) {
+    if let Some(timer) = timer {
+        timer.finish(bytes, ok);
+    }
+}
+
+impl<'a> Drop for Timer<'a> {
+    fn drop(&mut self) {
+        let nanos = self.start.elapsed().as_nanos() as u64;
+        let op = self.op;
+        op.calls.fetch_add(1, Ordering::Relaxed);
+        op.errors.fetch_add(!self.ok as u64, Ordering::Relaxed);
+        op.bytes.fetch_add(self.bytes as u64, Ordering::Relaxed);
+        op.nanos.fetch_add(nanos, Ordering::Relaxed);
+        op.allocations.fetch_add(allocations() - self.allocations, Ordering::Relaxed);
+        let bucket = (64 - nanos.leading_zeros() as usize).min(HISTOGRAM_BUCKETS - 1);
+        op.histogram[bucket].fetch_add(1, Ordering::Relaxed);
+    }
+}
+
+struct ClassCounters {
+    loads: OpStats,
+    dumps: OpStats,
+    loads_many: OpStats,
+    loads_columns: OpStats,
+    iter_lines: OpStats,
+    iter_array: OpStats,
+    fields: Vec<OpStats>,
+}
+
+/// The counters of one class, declared as a static by modules built with
+/// --stats and read by their stats() function.
+pub struct ClassStats {
+    name: &'static str,
+    fields: &'static [&'static str],
+    counters: OnceCell<ClassCounters>,
+}
+
+impl ClassStats {
+    pub const fn new(name: &'static str, fields: &'static [&'static str]) -> Self {
+        ClassStats { name, fields, counters: OnceCell::new() }
+    }
+
+    fn counters(&self) -> &ClassCounters {
+        self.counters.get_or_init(|| ClassCounters {
+            loads: OpStats::default(),
+            dumps: OpStats::default(),
+            loads_many: OpStats::default(),
+            loads_columns: OpStats::default(),
+            iter_lines: OpStats::default(),
+            iter_array: OpStats::default(),
+            fields: self.fields.iter().map(|_| OpStats::default()).collect(),
+        })
+    }
+
+    pub fn loads(&self) -> &OpStats {
+        &self.counters().loads
+    }
+
+    pub fn dumps(&self) -> &OpStats {
+        &self.counters().dumps
+    }
+
+    pub fn loads_many(&self) -> &OpStats {
+        &self.counters().loads_many
+    }
+
+    pub fn loads_columns(&self) -> &OpStats {
+        &self.counters().loads_columns
+    }
+
+    pub fn iter_lines(&self) -> &OpStats {
+        &self.counters().iter_lines
+    }
+
+    pub fn iter_array(&self) -> &OpStats {
+        &self.counters().iter_array
+    }
+
+    fn ops(&self) -> [(&'static str, &OpStats); 6] {
+        let c = self.counters();
+        [
+            ("loads", &c.loads),
+            ("dumps", &c.dumps),
+            ("loads_many", &c.loads_many),
+            ("loads_columns", &c.loads_columns),
+            ("iter_lines", &c.iter_lines),
+            ("iter_array", &c.iter_array),
+        ]
+    }
+
+    /// The field at index i of the class.
+    pub fn field(&self, i: usize) -> &OpStats {
+        &self.counters().fields[i]
+    }
+
+    pub fn name(&self) -> &'static str {
+        self.name
+    }
+
+    pub fn to_dict(&self, py: Python) -> PyResult<PyObject> {
+        let counters = self.counters();
+        let d = PyDict::new(py);
+        for (name, op) in self.ops().iter() {
+            d.set_item(name, op.to_dict(py)?)?;
+        }
+        let fields = PyDict::new(py);
+        for (name, op) in self.fields.iter().zip(&counters.fields) {
+            fields.set_item(name, op.to_dict(py)?)?;
+        }
+        d.set_item("fields", fields)?;
+        Ok(d.to_object(py))
+    }
+
+    pub fn reset(&self) {
+        for (_, op) in self.ops().iter() {
+            op.reset();
+        }
+        for op in &self.counters().fields {
+            op.reset();
+        }
+    }
+}
+
+/// The size of a loads input in bytes, for stats.
+pub fn input_len(s: &PyAny) -> usize {
+    with_input_bytes(s, |bytes, _| Ok(bytes.len())).unwrap_or(0)
+}
+
+/// The size of a bytes object returned by dumps_bytes, for stats.
+pub fn output_len(py: Python, bytes: &PyObject) -> usize {
+    bytes.as_ref(py).len().unwrap_or(0)
+}
@@ -1,7 +1,8 @@
-from abserde import abserde
-from typing import Any
+from abserde import abserde, BigInt, Interned, f32, i16, u8, u32, u64
+from enum import Enum
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
-@abserde
+@abserde(compact=True)
 class Test:
     room: int
     floor: int
@@ -12,3 +13,62 @@ class Test2:
     name: Any
     age: int
     foo: Test
+
+
+@abserde(lazy=True)
+class Record:
+    id: int
+    tags: List[str]
+    location: Test
+    note: Optional[str]
+
+
+class Kind(Enum):
+    office = "office"
+    lab = "lab"
+
+
+@abserde
+class Booking:
+    kind: Kind
+    size: Literal["small", "large"]
+    owner: Interned
+
+
+@abserde
+class Reading:
+    id: u64
+    count: u32
+    delta: i16
+    ratio: f32
+    total: BigInt
+    level: Optional[u8]
+
+
+@abserde
+class Catalog:
+    prices: Dict[str, float]
+    rooms: Dict[str, Test]
+    aliases: Optional[Dict[str, List[str]]]
+
+
+@abserde
+class Segment:
+    span: Tuple[int, int]
+    label: Optional[Tuple[str, float, List[int]]]
+
+
+@abserde(skip_defaults=True)
+class Profile:
+    name: str
+    age: int = 0
+    score: float = 1.5
+    nick: Optional[str] = None
+    tags: List[str] = []
+    status: Literal["active", "away"] = "active"
+    bio: Optional[str] = None
+
+
+@abserde
+class Label:
+    text: Literal["café", "a{b}", 'say "hi"']
@@ -1,31 +1,31 @@
-from typing import List, Optional, Any, Union
-from abserde import abserde
+from typing import List, Literal, Optional, Any, Tuple, Union
+from abserde import abserde, Interned, u32, u64
 
 
 @abserde
 class SearchMetadata:
     completed_in: float
-    max_id: float
+    max_id: u64
     max_id_str: str
     next_results: str
     query: str
     refresh_url: str
     count: int
-    since_id: int
+    since_id: u64
     since_id_str: str
 
 
 @abserde
 class Hashtag:
     text: str
-    indices: List[int]
+    indices: Tuple[int, int]
 
 
 @abserde
 class Size:
     w: int
     h: int
-    resize: str
+    resize: Literal["fit", "crop"]
 
 
 @abserde
@@ -38,9 +38,9 @@ class Sizes:
 
 @abserde
 class Media:
-    id: float
+    id: u64
     id_str: str
-    indices: List[int]
+    indices: Tuple[int, int]
     media_url: str
     media_url_https: str
     url: str
@@ -48,7 +48,7 @@ class Media:
     expanded_url: str
     typ: str
     sizes: Sizes
-    source_status_id: Optional[float]
+    source_status_id: Optional[u64]
     source_status_id_str: Optional[str]
 
 
@@ -57,7 +57,7 @@ class URL:
     url: str
     expanded_url: str
     display_url: str
-    indices: List[int]
+    indices: Tuple[int, int]
 
 
 @abserde
@@ -66,7 +66,7 @@ class UserMention:
     name: str
     id: int
     id_str: str
-    indices: List[int]
+    indices: Tuple[int, int]
 
 
 @abserde
@@ -80,8 +80,8 @@ class StatusEntities:
 
 @abserde
 class Metadata:
-    result_type: str
-    iso_language_code: str
+    result_type: Literal["recent", "popular", "mixed"]
+    iso_language_code: Interned
 
 
 @abserde
@@ -105,28 +105,28 @@ class User:
     description: str
     entities: UserEntities
     protected: bool
-    followers_count: int
-    friends_count: int
-    listed_count: int
+    followers_count: u32
+    friends_count: u32
+    listed_count: u32
     created_at: str
-    favourites_count: int
+    favourites_count: u32
     geo_enabled: bool
     verified: bool
-    statuses_count: int
-    lang: str
+    statuses_count: u32
+    lang: Interned
     contributors_enabled: bool
     is_translator: bool
     is_translation_enabled: bool
-    profile_background_color: str
+    profile_background_color: Interned
     profile_background_image_url: str
     profile_background_image_url_https: str
     profile_background_tile: bool
     profile_image_url: str
     profile_image_url_https: str
-    profile_link_color: str
-    profile_sidebar_border_color: str
-    profile_sidebar_fill_color: str
-    profile_text_color: str
+    profile_link_color: Interned
+    profile_sidebar_border_color: Interned
+    profile_sidebar_fill_color: Interned
+    profile_text_color: Interned
     profile_use_background_image: bool
     default_profile: bool
     default_profile_image: bool
@@ -142,7 +142,7 @@ class User:
 class InnerStatus:
     metadata: Metadata
     created_at: str
-    id: float
+    id: u64
     id_str: str
     text: str
     source: str
@@ -152,13 +152,13 @@ class InnerStatus:
     coordinates: Optional[Any]
     place: Optional[Any]
     contributors: Optional[Any]
-    retweet_count: int
-    favorite_count: int
+    retweet_count: u32
+    favorite_count: u32
     entities: StatusEntities
     favorited: bool
     retweeted: bool
-    lang: str
-    in_reply_to_status_id: Optional[float]
+    lang: Interned
+    in_reply_to_status_id: Optional[u64]
     in_reply_to_status_id_str: Optional[str]
     in_reply_to_user_id: Optional[int]
     in_reply_to_user_id_str: Optional[str]
@@ -169,7 +169,7 @@ class InnerStatus:
 class Status:
     metadata: Metadata
     created_at: str
-    id: float
+    id: u64
     id_str: str
     text: str
     source: str
@@ -179,13 +179,13 @@ class Status:
     coordinates: Optional[Any]
     place: Optional[Any]
     contributors: Optional[Any]
-    retweet_count: int
-    favorite_count: int
+    retweet_count: u32
+    favorite_count: u32
     entities: StatusEntities
     favorited: bool
     retweeted: bool
-    lang: str
-    in_reply_to_status_id: Optional[float]
+    lang: Interned
+    in_reply_to_status_id: Optional[u64]
     in_reply_to_status_id_str: Optional[str]
     in_reply_to_user_id: Optional[int]
     in_reply_to_user_id_str: Optional[str]
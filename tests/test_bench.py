@@ -0,0 +1,48 @@
+import json
+import sys
+
+from abserde.bench import bench
+from abserde.bench import compare
+from abserde.bench import PayloadGenerator
+from abserde.bench import SHAPES
+
+try:
+    import twitter
+except ImportError as e:
+    print("You must run the tests from the environment with all of the examples built.")
+    raise e
+
+
+def test_generated_documents_load():
+    with open('examples/twitter.pyi') as f:
+        src = f.read()
+    for shape in SHAPES.values():
+        generator = PayloadGenerator(src, shape)
+        assert generator.root() == 'File'
+        doc = json.dumps(generator.document('File'))
+        assert json.loads(twitter.File.loads(doc).dumps()) == json.loads(doc)
+
+
+def test_sparse_shape():
+    with open('examples/multiclass.pyi') as f:
+        generator = PayloadGenerator(f.read(), SHAPES['sparse'], seed=1)
+    notes = [generator.document('Record')['note'] for _ in range(100)]
+    assert notes.count(None) > 50
+
+
+def test_bench_report():
+    report = bench('examples/multiclass.pyi', 'Test', count=50)
+    results = report['results']
+    assert set(results) == {'loads', 'dumps', 'access', 'batch', 'batch_parallel', 'memory'}
+    assert 'json' in results['loads'] and 'abserde' in results['loads']
+    # every library loads the batch one document at a time; only loads_many is parallel
+    assert 'json' in results['batch'] and 'abserde' in results['batch']
+    assert set(results['batch_parallel']) == {'abserde'}
+    if sys.platform == 'linux':
+        assert results['memory']['abserde']['rss_bytes_per_doc'] > 0
+        assert results['memory']['json']['rss_bytes_per_doc'] > 0
+    json.dumps(report)
+    assert not any(regressed for _, _, regressed in compare(report, report, 0.1))
+    slower = json.loads(json.dumps(report))
+    slower['results']['loads']['abserde']['median_us'] *= 2
+    assert compare(report, slower, 0.1)[0] == ('loads.median_us', -0.5, True)
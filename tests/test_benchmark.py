@@ -120,3 +120,43 @@ def test_ujson_twitter_dumps_speed(benchmark):
         j = f.read()
     data = ujson.loads(j)
     benchmark(ujson.dumps, data)
+
+
+def any_heavy_document():
+    with open('tests/twitter.json', encoding='utf-8') as f:
+        statuses = json.load(f)['statuses']
+    # the statuses nested as an Any field, so the whole tree goes through JsonValue
+    return json.dumps({'name': statuses, 'age': 1, 'foo': {'room': 1, 'floor': 2}})
+
+
+@pytest.mark.benchmark(
+    group="any_loads", max_time=5.0, timer=time.perf_counter, disable_gc=True, warmup=False,
+)
+def test_abserde_any_loads_speed(benchmark):
+    s = any_heavy_document()
+    benchmark(lambda: multiclass.Test2.loads(s).name)
+
+
+@pytest.mark.benchmark(
+    group="any_loads", max_time=5.0, timer=time.perf_counter, disable_gc=True, warmup=False,
+)
+def test_orjson_any_loads_speed(benchmark):
+    s = any_heavy_document()
+    benchmark(orjson.loads, s)
+
+
+@pytest.mark.benchmark(
+    group="any_dumps", max_time=5.0, timer=time.perf_counter, disable_gc=True, warmup=False,
+)
+def test_abserde_any_dumps_speed(benchmark):
+    d = json.loads(any_heavy_document())
+    t = multiclass.Test2(d['name'], 1, multiclass.Test(1, 2))
+    benchmark(lambda: multiclass.Test2(d['name'], 1, t.foo).dumps())
+
+
+@pytest.mark.benchmark(
+    group="any_dumps", max_time=5.0, timer=time.perf_counter, disable_gc=True, warmup=False,
+)
+def test_orjson_any_dumps_speed(benchmark):
+    d = json.loads(any_heavy_document())
+    benchmark(orjson.dumps, d)
@@ -0,0 +1,132 @@
+import re
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+
+import abserde.main
+from abserde.config import Config
+from abserde.gen_lib import gen_bindings
+from abserde.gen_lib import InvalidTypeError
+from abserde.main import main
+
+STUB = '''from abserde import abserde
+
+@abserde
+class Example:
+    a: int
+'''
+
+
+def fake_builds(monkeypatch, status='built'):
+    """Record the builds main would run instead of running maturin"""
+    builds = []
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def generate_crate(mod, config, slot=0):
+        with lock:
+            builds.append((config.filename, slot))
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return status
+
+    monkeypatch.setattr(abserde.main, 'generate_crate', generate_crate)
+    return builds, running
+
+
+def test_builds_every_stub_in_a_directory(tmp_path, monkeypatch):
+    builds, _ = fake_builds(monkeypatch)
+    for name in ('one', 'two', 'three'):
+        (tmp_path / f'{name}.pyi').write_text(STUB)
+    (tmp_path / 'notes.txt').write_text('not a stub')
+    result = CliRunner().invoke(main, [str(tmp_path), str(tmp_path / 'one.pyi')])
+    assert result.exit_code == 0, result.output
+    # one.pyi is given twice but built once
+    assert sorted(name for name, _ in builds) == ['one', 'three', 'two']
+    assert 'built' in result.output
+
+
+def test_jobs_build_at_once_in_their_own_slots(tmp_path, monkeypatch):
+    builds, running = fake_builds(monkeypatch)
+    for i in range(4):
+        (tmp_path / f'stub{i}.pyi').write_text(STUB)
+    result = CliRunner().invoke(main, ['-j', '2', str(tmp_path)])
+    assert result.exit_code == 0, result.output
+    assert len(builds) == 4
+    assert running[1] == 2
+    assert {slot for _, slot in builds} == {0, 1}
+    result = CliRunner().invoke(main, ['-j', '0', str(tmp_path)])
+    assert result.exit_code != 0
+
+
+def test_failures_are_summarized(tmp_path, monkeypatch):
+    builds, _ = fake_builds(monkeypatch)
+    (tmp_path / 'good.pyi').write_text(STUB)
+    (tmp_path / 'bad.pyi').write_text(STUB.replace('int', 'Dict[str]'))
+    result = CliRunner().invoke(main, [str(tmp_path)])
+    assert result.exit_code == 1
+    assert [name for name, _ in builds] == ['good']
+    assert 'Failed to build' in result.output and 'bad.pyi' in result.output
+
+
+def test_single_failed_build_fails(tmp_path, monkeypatch):
+    fake_builds(monkeypatch, status='failed')
+    (tmp_path / 'one.pyi').write_text(STUB)
+    result = CliRunner().invoke(main, [str(tmp_path / 'one.pyi')])
+    assert result.exit_code == 1
+    assert 'Failed to build' in result.output
+
+
+def test_stubs_with_the_same_name(tmp_path, monkeypatch):
+    builds, _ = fake_builds(monkeypatch)
+    for d in ('a', 'b'):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / 'one.pyi').write_text(STUB)
+    result = CliRunner().invoke(main, [str(tmp_path / 'a'), str(tmp_path / 'b')])
+    assert result.exit_code == 1
+    assert 'would both build one' in result.output
+    assert builds == []
+
+
+def test_literal_enums_do_not_clash_with_classes():
+    stub = '''from typing import Literal
+from abserde import abserde
+
+@abserde
+class Foo:
+    bar_baz: Literal["a", "b"]
+
+@abserde
+class FooBar:
+    baz: Literal["c", "d"]
+
+@abserde
+class Foo_bar:
+    baz: Literal["e", "f"]
+
+@abserde
+class FooBarBaz:
+    x: int
+'''
+    lib = gen_bindings(stub, Config('clash', False, 'a', 'b'))
+    names = re.findall(r"^pub (?:enum|struct) (\w+)", lib, re.MULTILINE)
+    assert len(names) == len(set(names))
+    assert 'FooBarBaz' in names
+    with pytest.raises(InvalidTypeError):
+        gen_bindings(stub.replace('FooBarBaz', 'AbserdeFoo'), Config('clash', False, 'a', 'b'))
+    with pytest.raises(InvalidTypeError):
+        gen_bindings(
+            'from enum import Enum\n\nclass AbserdeKind(Enum):\n    a = "a"\n',
+            Config('clash', False, 'a', 'b'),
+        )
+
+
+def test_fields_without_defaults_come_first():
+    stub = STUB + '    b: int = 0\n    c: str\n'
+    with pytest.raises(InvalidTypeError, match='Example.c'):
+        gen_bindings(stub, Config('order', False, 'a', 'b'))
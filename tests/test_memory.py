@@ -0,0 +1,106 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from abserde.bench import PayloadGenerator
+from abserde.bench import rss
+from abserde.bench import SHAPES
+
+try:
+    import forward  # noqa: F401
+    import multiclass
+    import nested  # noqa: F401
+    import simple  # noqa: F401
+    import twitter  # noqa: F401
+    import union  # noqa: F401
+except ImportError as e:
+    print("You must run the tests from the environment with all of the examples built.")
+    raise e
+
+STUBS = sorted(Path('examples').glob('*.pyi'))
+
+KINDS = ("abserde", "dict", "dataclass", "dataclass, slots")
+
+# at most this many documents, or bytes of them, are loaded for each measurement
+MAX_DOCS = 20_000
+MAX_BYTES = 20_000_000
+
+# Loads the documents of a job read from stdin as one kind of object, and
+# prints how much the RSS grew per object. Each measurement runs in a fresh
+# interpreter, so memory freed by the previous one is not reused.
+CHILD = '''
+import gc, importlib, json, sys
+from dataclasses import make_dataclass
+from abserde.bench import rss
+job = json.load(sys.stdin)
+cls = getattr(importlib.import_module(job["module"]), job["class"])
+fields = job["fields"]
+if job["kind"] == "abserde":
+    load = cls.loads
+elif job["kind"] == "dict":
+    load = json.loads
+else:
+    namespace = {"__slots__": tuple(fields)} if job["kind"] == "dataclass, slots" else {}
+    dc = make_dataclass(job["class"], fields, namespace=namespace)
+    load = lambda s: dc(**json.loads(s))
+docs = job["docs"]
+gc.collect()
+before = rss()
+objects = [load(s) for s in docs]
+gc.collect()
+after = rss()
+# the list itself holds one pointer per object
+print((after - before) / len(objects) - 8)
+'''
+
+
+def bytes_per_instance(module, cls, fields, kind, docs):
+    """Growth of the RSS per object when docs are loaded as kind.
+
+    Unlike tracemalloc, this counts the memory a class keeps on the Rust heap.
+    """
+    job = {"module": module, "class": cls, "fields": fields, "kind": kind, "docs": docs}
+    child = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        input=json.dumps(job).encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return float(child.stdout)
+
+
+def report(name, sizes):
+    print(f"\n{name} bytes per instance:")
+    for kind, size in sizes.items():
+        print(f"  {kind:<20} {size:8.1f}")
+
+
+def measure(stub, cls):
+    generator = PayloadGenerator(stub.read_text(), SHAPES['default'])
+    fields = [name for name, _ in generator.fields[cls]]
+    doc_bytes = len(json.dumps(generator.document(cls)))
+    docs = [json.dumps(generator.document(cls)) for _ in range(
+        max(100, min(MAX_DOCS, MAX_BYTES // doc_bytes))
+    )]
+    return {
+        kind: bytes_per_instance(stub.stem, cls, fields, kind, docs) for kind in KINDS
+    }
+
+
+@pytest.mark.skipif(rss() is None, reason="needs psutil or /proc to read the RSS")
+@pytest.mark.parametrize('stub', STUBS, ids=[stub.stem for stub in STUBS])
+def test_memory(stub):
+    generator = PayloadGenerator(stub.read_text(), SHAPES['default'])
+    for cls in generator.fields:
+        report(f"{stub.stem}.{cls}", measure(stub, cls))
+
+
+@pytest.mark.skipif(rss() is None, reason="needs psutil or /proc to read the RSS")
+def test_compact_class_is_smallest():
+    assert not hasattr(multiclass.Test(1, 2), "__dict__")
+    sizes = measure(Path('examples/multiclass.pyi'), 'Test')
+    assert sizes["abserde"] < sizes["dict"]
+    assert sizes["abserde"] < sizes["dataclass, slots"]
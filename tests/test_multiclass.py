@@ -1,3 +1,10 @@
+import gc
+import io
+import json
+import pickle
+import weakref
+from pathlib import Path
+
 import pytest
 
 try:
@@ -7,6 +14,10 @@ except ImportError as e:
     raise e
 
 
+class Sentinel:
+    pass
+
+
 def test_init():
     t = multiclass.Test(5, 2)
     assert t.room == 5
@@ -37,6 +48,145 @@ def test_loads():
         tt2 = multiclass.Test2.loads('{"age": 4, "name": 5, "foo": {"room": None, "floor": 10}}')
 
 
+def test_parse_error_pickles():
+    assert multiclass.JSONParseError.__module__ == 'multiclass'
+    with pytest.raises(multiclass.JSONParseError) as info:
+        multiclass.Test.loads_many(['{"room": 1, "floor": 2}', '{"invalid":'])
+    # so errors raised in a worker process reach the parent
+    e = pickle.loads(pickle.dumps(info.value))
+    assert type(e) is multiclass.JSONParseError
+    assert e.args == info.value.args
+
+
+def test_loads_buffers():
+    expected = multiclass.Test(4, 10)
+    s = '{"room": 4, "floor": 10}'
+    assert multiclass.Test.loads(s.encode()) == expected
+    assert multiclass.Test.loads(bytearray(s.encode())) == expected
+    assert multiclass.Test.loads(memoryview(s.encode())) == expected
+    assert multiclass.loads(bytearray(s.encode())) == expected
+    assert multiclass.loads(memoryview(s.encode())) == expected
+    with pytest.raises(TypeError):
+        multiclass.Test.loads(5)
+    with pytest.raises(TypeError):
+        multiclass.loads(5)
+
+
+def test_module_loads_dispatch():
+    t = multiclass.loads('{"floor": 10, "room": 4}')
+    assert isinstance(t, multiclass.Test)
+    assert t == multiclass.Test(4, 10)
+    t2 = multiclass.loads('{"foo": {"room": 4, "floor": 10}, "age": 4, "name": "Will"}')
+    assert isinstance(t2, multiclass.Test2)
+    assert t2.foo == t
+    with pytest.raises(multiclass.JSONParseError):
+        multiclass.loads('{"room": 4}')
+    with pytest.raises(multiclass.JSONParseError):
+        multiclass.loads('[1, 2]')
+    # a repeated key only counts once towards a class's required keys
+    with pytest.raises(multiclass.JSONParseError, match='does not match any of'):
+        multiclass.loads('{"room": 4, "room": 5}')
+    # Test2's keys are all present but it fails to parse, so the next candidate is tried
+    p = multiclass.loads('{"name": "Will", "age": 4, "foo": "not a Test"}')
+    assert isinstance(p, multiclass.Profile)
+    assert p.name == 'Will' and p.age == 4
+
+
+def test_loads_many():
+    payloads = [f'{{"room": {i}, "floor": 1}}' for i in range(100)]
+    payloads.append(b'{"room": 100, "floor": 1}')
+    expected = [multiclass.Test(i, 1) for i in range(101)]
+    assert multiclass.Test.loads_many(payloads) == expected
+    assert multiclass.Test.loads_many(payloads, threads=2) == expected
+    # the pool is reused
+    assert multiclass.Test.loads_many(payloads, threads=2) == expected
+    # one pool serves every count, more threads than payloads included
+    tasks = Path('/proc/self/task')
+    before = len(list(tasks.iterdir())) if tasks.exists() else 0
+    for n in range(1, 41):
+        assert multiclass.Test.loads_many(payloads, threads=n) == expected
+    assert multiclass.Test.loads_many(payloads, threads=200) == expected
+    if tasks.exists():
+        # a pool per count would have started 1 + 2 + ... + 40 + 200 threads
+        assert len(list(tasks.iterdir())) - before < 300
+    with pytest.raises(multiclass.JSONParseError, match='payload 7'):
+        multiclass.Test.loads_many(payloads[:7] + ['{"room":'], threads=3)
+    views = [memoryview(bytearray(p, 'utf-8') if isinstance(p, str) else bytearray(p))
+             for p in payloads]
+    assert multiclass.Test.loads_many(views, threads=3) == expected
+    assert multiclass.Test.loads_many([]) == []
+    with pytest.raises(multiclass.JSONParseError):
+        multiclass.Test.loads_many(['{"room": 1, "floor": 1}', '{"room":'])
+
+
+def test_iter_lines(tmp_path):
+    path = tmp_path / 'rooms.jsonl'
+    lines = [f'{{"room": {i}, "floor": {i * 2}}}' for i in range(10)]
+    path.write_text('\n'.join(lines[:5]) + '\n\n' + '\n'.join(lines[5:]) + '\n')
+    expected = [multiclass.Test(i, i * 2) for i in range(10)]
+    assert list(multiclass.Test.iter_lines(path)) == expected
+    assert list(multiclass.Test.iter_lines(str(path))) == expected
+    with open(path, 'rb') as f:
+        assert list(multiclass.Test.iter_lines(f)) == expected
+    with open(path) as f:
+        batches = list(multiclass.Test.iter_lines(f, batch_size=4))
+    assert [len(b) for b in batches] == [4, 4, 2]
+    assert [t for b in batches for t in b] == expected
+    path.write_text(lines[0] + '\n{"room":\n')
+    with pytest.raises(multiclass.JSONParseError, match='line 2'):
+        list(multiclass.Test.iter_lines(path))
+
+
+def test_iter_array(tmp_path):
+    rooms = [{'room': i, 'floor': i * 2} for i in range(1000)]
+    expected = [multiclass.Test(i, i * 2) for i in range(1000)]
+    data = json.dumps(rooms).encode()
+    assert list(multiclass.Test.iter_array(data)) == expected
+    assert list(multiclass.Test.iter_array(bytearray(data))) == expected
+    doc = tmp_path / 'rooms.json'
+    doc.write_text(json.dumps({'count': 1000, 'data': {'rooms': rooms}}))
+    assert list(multiclass.Test.iter_array(path=doc, keys='data.rooms')) == expected
+    assert list(multiclass.Test.iter_array(path=str(doc), keys='data.rooms')) == expected
+    with open(doc, 'rb') as f:
+        assert list(multiclass.Test.iter_array(f, keys='data.rooms')) == expected
+    # a str is a document, never a filename
+    with pytest.raises(TypeError, match='path='):
+        multiclass.Test.iter_array(str(doc))
+    with pytest.raises(TypeError):
+        multiclass.Test.iter_array(data, path=doc)
+    # buffers are read a chunk at a time, not copied whole
+    big = json.dumps(rooms * 100).encode()
+    assert sum(1 for _ in multiclass.Test.iter_array(memoryview(bytearray(big)))) == 100000
+    # an iterator dropped part way through stops its parsing thread
+    it = multiclass.Test.iter_array(big)
+    next(it)
+    del it
+    it = multiclass.Test.iter_array(b'[{"room": 1, "floor": 2}, {"room": "x"}]')
+    with pytest.raises(multiclass.JSONParseError):
+        list(it)
+    with pytest.raises(multiclass.JSONParseError):
+        list(multiclass.Test.iter_array(data, keys='missing'))
+
+
+def test_loads_columns():
+    np = pytest.importorskip('numpy')
+    payloads = [f'{{"room": {i}, "floor": {i * 2}}}' for i in range(100)]
+    columns = multiclass.Test.loads_columns(payloads)
+    assert sorted(columns) == ['floor', 'room']
+    assert columns['room'].dtype == np.int64
+    assert np.array_equal(columns['room'], np.arange(100))
+    assert np.array_equal(columns['floor'], np.arange(100) * 2)
+    lines = '\n'.join(payloads) + '\n\n'
+    assert np.array_equal(multiclass.Test.loads_columns(lines)['room'], np.arange(100))
+    assert np.array_equal(multiclass.Test.loads_columns(lines.encode())['floor'],
+                          np.arange(100) * 2)
+    columns = multiclass.Test2.loads_columns([])
+    assert list(columns) == ['age']
+    assert len(columns['age']) == 0
+    with pytest.raises(multiclass.JSONParseError, match='line 2'):
+        multiclass.Test.loads_columns('{"room": 1, "floor": 1}\n{"room": 1}')
+
+
 def test_dumps():
     t = multiclass.Test(5, 2)
     assert t.dumps() == '{"room":5,"floor":2}'
@@ -44,6 +194,23 @@ def test_dumps():
     assert t2.dumps() == '{"name":8.8,"age":30,"foo":{"room":5,"floor":2}}'
 
 
+def test_dumps_bytes(tmp_path):
+    t2 = multiclass.Test2('x' * 1000, 30, multiclass.Test(5, 2))
+    expected = t2.dumps().encode()
+    assert t2.dumps_bytes() == expected
+    assert bytes(t2) == expected
+    buf = io.BytesIO()
+    t2.dump(buf)
+    assert buf.getvalue() == expected
+    path = tmp_path / 'out.json'
+    t2.dump_to_path(path)
+    assert path.read_bytes() == expected
+    t2.dump_to_path(str(path))
+    assert multiclass.Test2.loads(path.read_bytes()) == t2
+    with pytest.raises(TypeError):
+        t2.dump(io.StringIO())
+
+
 def test_access():
     t = multiclass.Test(5, 2)
     assert t['room'] == 5
@@ -53,9 +220,261 @@ def test_access():
     assert t['room'] == 100
 
 
+def test_nested_access_is_shared():
+    t = multiclass.Test(5, 2)
+    t2 = multiclass.Test2(8.8, 30, t)
+    assert t2.foo is t
+    t2 = multiclass.Test2.loads('{"age": 4, "name": "Will", "foo": {"room": 4, "floor": 10}}')
+    foo = t2.foo
+    assert t2.foo is foo
+    assert t2['foo'] is foo
+    foo.room = 7
+    assert t2.dumps() == '{"name":"Will","age":4,"foo":{"room":7,"floor":10}}'
+    t2.foo = multiclass.Test(1, 1)
+    assert t2.foo == multiclass.Test(1, 1)
+    with pytest.raises(TypeError):
+        t2.foo = 5
+
+
+def test_shared_fields_are_traversed():
+    t2 = multiclass.Test2.loads('{"age": 4, "name": "Will", "foo": {"room": 4, "floor": 10}}')
+    foo = t2.foo
+    assert gc.is_tracked(t2)
+    assert any(r is foo for r in gc.get_referents(t2))
+    # a cycle through a handed out field is collected
+    t2.name = {}
+    t2.name['self'] = t2
+    sentinel = Sentinel()
+    t2.sentinel = sentinel
+    collected = weakref.ref(sentinel)
+    del t2, foo, sentinel
+    gc.collect()
+    assert collected() is None
+
+
+def test_lazy_fields():
+    s = '{"id": 1, "tags": ["a", "b"], "location": {"room": 4, "floor": 10}, "extra": [1, 2]}'
+    r = multiclass.Record.loads(s)
+    assert r.dumps() == s
+    assert r.id == 1
+    assert r.note is None
+    assert r.dumps() == s
+    assert r['location'] == multiclass.Test(4, 10)
+    r.tags.append('c')
+    expected = '{"id":1,"tags":["a","b","c"],"location":{"room":4,"floor":10},"note":null}'
+    assert r.dumps() == expected
+    r = multiclass.Record.loads(s)
+    r.id = 2
+    assert r == multiclass.Record(2, ['a', 'b'], multiclass.Test(4, 10), None)
+    r = multiclass.Record.loads('{"id": "bad", "tags": [], "location": {"room": 1, "floor": 1}}')
+    with pytest.raises(multiclass.JSONParseError):
+        r.id
+    # fields that fail to decode are only equal if their text is
+    assert r == multiclass.Record.loads(
+        '{"id": "bad", "tags": [], "location": {"room": 1, "floor": 1}}'
+    )
+    assert r != multiclass.Record.loads(
+        '{"id": "worse", "tags": [], "location": {"room": 1, "floor": 1}}'
+    )
+    with pytest.raises(multiclass.JSONParseError):
+        multiclass.Record.loads('{"id": 1, "tags": []}')
+
+
+def test_loads_only():
+    s = '{"id": 1, "tags": ["a"], "location": {"room": 4, "floor": 10}, "note": "hi"}'
+    r = multiclass.Record.loads(s, only=['id', 'note'])
+    assert r.id == 1
+    assert r['note'] == 'hi'
+    with pytest.raises(AttributeError):
+        r.tags
+    assert r.dumps() == '{"id":1,"note":"hi"}'
+    r.tags = ['b']
+    assert r.dumps() == '{"id":1,"tags":["b"],"note":"hi"}'
+    r = multiclass.Record.loads('{"id": 1, "location": "not checked"}', only=['id'])
+    assert r.id == 1
+    with pytest.raises(AttributeError):
+        multiclass.Record.loads(s, only=['missing'])
+    with pytest.raises(TypeError):
+        multiclass.Test.loads('{"room": 4, "floor": 10}', only=['room'])
+
+
+def test_low_cardinality_strings():
+    s = '{"kind":"lab","size":"small","owner":"ada"}'
+    a = multiclass.Booking.loads(s)
+    b = multiclass.Booking.loads(s)
+    assert (a.kind, a.size, a.owner) == ('lab', 'small', 'ada')
+    assert type(a.kind) is str
+    assert a.kind is b.kind
+    assert a.owner is b.owner
+    assert a.dumps() == s
+    a.size = 'large'
+    assert a.size == 'large'
+    with pytest.raises(ValueError):
+        a.size = 'medium'
+    with pytest.raises(ValueError):
+        multiclass.Booking('home', 'small', 'ada')
+    with pytest.raises(ValueError):
+        multiclass.Booking.loads('{"kind":"home","size":"small","owner":"ada"}')
+    # values that need escaping in Rust
+    for text in ("café", "a{b}", 'say "hi"'):
+        label = multiclass.Label.loads(json.dumps({"text": text}))
+        assert label.text == text
+        assert multiclass.Label.loads(label.dumps()) == label
+    with pytest.raises(ValueError, match="is not one of café, a{b}"):
+        multiclass.Label("{}")
+
+
+def test_numbers():
+    s = '{"id":18446744073709551615,"count":7,"delta":-3,"ratio":0.5,"total":-12,"level":null}'
+    r = multiclass.Reading.loads(s)
+    assert r.id == 2 ** 64 - 1
+    assert (r.count, r.delta, r.ratio, r.total, r.level) == (7, -3, 0.5, -12, None)
+    assert r.dumps() == s
+    r.total = 10 ** 30
+    assert r.total == 10 ** 30
+    r = multiclass.Reading.loads(r.dumps())
+    assert r.total == 10 ** 30
+    r.ratio = 0.1
+    assert r.ratio != 0.1
+    assert abs(r.ratio - 0.1) < 1e-7
+    with pytest.raises(OverflowError):
+        r.count = -1
+    with pytest.raises(OverflowError):
+        r.delta = 2 ** 15
+    with pytest.raises(ValueError):
+        multiclass.Reading.loads(s.replace('"level":null', '"level":256'))
+    with pytest.raises(ValueError):
+        multiclass.Reading.loads(s.replace('"total":-12', '"total":1.5'))
+    with pytest.raises(ValueError):
+        multiclass.Reading.loads(s.replace('"total":-12', '"total":"-12"'))
+    # streamed from a file object, where the text of a number is not borrowed
+    big = s.replace('"total":-12', f'"total":{-10 ** 30}')
+    with_big = multiclass.Reading.iter_array(io.BytesIO(f'[{s},{big}]'.encode()))
+    assert [r.total for r in with_big] == [-12, -10 ** 30]
+
+
+def test_dict_fields():
+    s = ('{"prices":{"b":1.5,"a":2.0},"rooms":{"x":{"room":1,"floor":2}},'
+         '"aliases":{"x":["y","z"]}}')
+    c = multiclass.Catalog.loads(s)
+    assert c.prices == {"b": 1.5, "a": 2.0}
+    assert list(c.prices) == ["b", "a"]
+    assert c.rooms["x"].floor == 2
+    assert c.aliases == {"x": ["y", "z"]}
+    assert c.dumps() == s
+    c.prices["c"] = 3.0
+    c.aliases = None
+    assert c.dumps().startswith('{"prices":{"b":1.5,"a":2.0,"c":3.0}')
+    assert c.dumps().endswith('"aliases":null}')
+    with pytest.raises(ValueError):
+        multiclass.Catalog.loads('{"prices":{"a":"x"},"rooms":{}}')
+    with pytest.raises(TypeError):
+        c.prices = {1: 2.0}
+
+
+def test_tuple_fields():
+    s = '{"span":[3,9],"label":["x",0.5,[1,2]]}'
+    seg = multiclass.Segment.loads(s)
+    assert seg.span == (3, 9)
+    assert seg.label == ("x", 0.5, [1, 2])
+    assert seg.dumps() == s
+    seg.span = (1, 2)
+    assert seg.dumps() == '{"span":[1,2],"label":["x",0.5,[1,2]]}'
+    with pytest.raises(ValueError):
+        multiclass.Segment.loads('{"span":[3]}')
+    with pytest.raises(ValueError):
+        multiclass.Segment.loads('{"span":[3,9,27]}')
+    with pytest.raises(ValueError):
+        seg.span = (1, 2, 3)
+
+
+def test_defaults():
+    p = multiclass.Profile("ada")
+    assert (p.age, p.score, p.nick, p.tags, p.status, p.bio) == (0, 1.5, None, [], "active", None)
+    assert p.dumps() == '{"name":"ada"}'
+    p = multiclass.Profile.loads('{"name":"ada","bio":null}')
+    assert (p.age, p.score, p.tags, p.status) == (0, 1.5, [], "active")
+    assert p.dumps() == '{"name":"ada"}'
+    p.age = 36
+    p.tags.append("x")
+    p.bio = "hi"
+    assert p.dumps() == '{"name":"ada","age":36,"tags":["x"],"bio":"hi"}'
+    p = multiclass.Profile("ada", 1, 2.0, "a", ["y"], "away", "b")
+    assert p == multiclass.Profile.loads(p.dumps())
+
+
+def test_binary_and_pickle():
+    t2 = multiclass.Test2({'a': [1, None, 2.5]}, 30, multiclass.Test(5, 2))
+    data = t2.to_binary()
+    assert isinstance(data, bytes)
+    assert len(data) < len(t2.dumps())
+    assert multiclass.Test2.from_binary(data) == t2
+    assert multiclass.Test2.from_binary(memoryview(data)) == t2
+    r = multiclass.Reading.loads(
+        '{"id":1,"count":7,"delta":-3,"ratio":0.5,"total":1000000000000000000000,"level":3}'
+    )
+    assert multiclass.Reading.from_binary(r.to_binary()).total == 10 ** 21
+    record = multiclass.Record.loads('{"id":1,"tags":[],"location":{"room":1,"floor":2}}')
+    for obj in (t2, r, record, multiclass.Profile("ada")):
+        copy = pickle.loads(pickle.dumps(obj))
+        assert type(copy) is type(obj)
+        assert copy.dumps() == obj.dumps()
+    with pytest.raises(ValueError):
+        multiclass.Test.from_binary(b'not cbor')
+
+
+def test_msgpack_and_cbor():
+    t = multiclass.Test(1, 2)
+    assert t.dumps_msgpack() == b'\x82\xa4room\x01\xa5floor\x02'
+    assert t.dumps_cbor() == b'\xa2\x64room\x01\x65floor\x02'
+    t2 = multiclass.Test2({'a': [1, None, 2.5]}, 30, multiclass.Test(5, 2))
+    assert multiclass.Test2.loads_msgpack(t2.dumps_msgpack()) == t2
+    assert multiclass.Test2.loads_cbor(memoryview(t2.dumps_cbor())) == t2
+    b = multiclass.Booking.loads('{"kind":"lab","size":"small","owner":"ada"}')
+    assert b'\xa5small' in b.dumps_msgpack()
+    assert multiclass.Booking.loads_msgpack(b.dumps_msgpack()) == b
+    assert multiclass.loads_msgpack(multiclass.dumps_msgpack(t2)) == t2
+    assert multiclass.loads_cbor(multiclass.dumps_cbor(b)) == b
+    with pytest.raises(ValueError):
+        multiclass.Test.loads_msgpack(b'\x82\xa4room\x01')
+    # lazy classes are written field by field, not as JSON text
+    record = multiclass.Record.loads('{"id":1,"tags":["a"],"location":{"room":1,"floor":2}}')
+    data = record.dumps_msgpack()
+    assert data == (
+        b'\x84\xa2id\x01\xa4tags\x91\xa1a'
+        b'\xa8location\x82\xa4room\x01\xa5floor\x02\xa4note\xc0'
+    )
+    assert multiclass.Record.loads_msgpack(data) == record
+    assert multiclass.Record.loads_msgpack(b'\x83\xa2id\x02\xa4tags\x90\xa8location\x82'
+                                           b'\xa4room\x01\xa5floor\x02').note is None
+    assert multiclass.Record.loads_cbor(record.dumps_cbor()) == record
+    assert multiclass.loads_msgpack(data) == record
+    with pytest.raises(ValueError):
+        multiclass.Record.loads_msgpack(b'\x81\xa2id\x01')
+    # integers are written as integers, which needs a serializer that is not
+    # human readable
+    r = multiclass.Reading.loads(
+        '{"id":18446744073709551615,"count":7,"delta":-3,"ratio":0.5,"total":-12,"level":null}'
+    )
+    assert b'\xa2id\xcf\xff\xff\xff\xff\xff\xff\xff\xff' in r.dumps_msgpack()
+    r.total = 2 ** 64 - 1
+    assert b'\xa5total\xcf\xff\xff\xff\xff\xff\xff\xff\xff' in r.dumps_msgpack()
+    assert multiclass.Reading.loads_msgpack(r.dumps_msgpack()) == r
+    # wider integers are CBOR bignums, and MessagePack cannot hold them
+    r.total = 2 ** 70
+    assert b'\x65total\xc2\x49\x40' + bytes(8) in r.dumps_cbor()
+    assert multiclass.Reading.loads_cbor(r.dumps_cbor()).total == 2 ** 70
+    r.total = -2 ** 70
+    assert b'\x65total\xc3\x49\x3f' + b'\xff' * 8 in r.dumps_cbor()
+    assert multiclass.Reading.loads_cbor(r.dumps_cbor()).total == -2 ** 70
+    with pytest.raises(ValueError, match='does not fit in 64 bits'):
+        r.dumps_msgpack()
+
+
 def test_str():
     t = multiclass.Test(5, 2)
     assert(str(t) == t.dumps())
+    assert(bytes(t) == t.dumps().encode())
 
 
 def test_any_mutation():
@@ -67,3 +486,21 @@ def test_any_mutation():
     lst = [1, '']
     t2.name = lst
     assert t2.name == lst
+    d = {'a': [True, 1, 2.5, None, ('x', 'y')], 'b': {'c': 2 ** 63}}
+    t2.name = d
+    assert t2.name is t2.name
+    name = '{"a":[true,1,2.5,null,["x","y"]],"b":{"c":9223372036854775808}}'
+    assert t2.dumps() == '{"name":' + name + ',"age":30,"foo":{"room":5,"floor":2}}'
+    t2 = multiclass.Test2.loads(t2.dumps())
+    assert t2.name == {'a': [True, 1, 2.5, None, ['x', 'y']], 'b': {'c': 2 ** 63}}
+    assert type(t2.name['a'][0]) is bool
+    with pytest.raises(ValueError):
+        t2.name = float('nan')
+    with pytest.raises(ValueError):
+        t2.name = object()
+    # changes made through a handed out Any value are dumped
+    t2.name['c'] = [1, {'d': None}]
+    assert json.loads(t2.dumps())['name']['c'] == [1, {'d': None}]
+    t2.name['e'] = object()
+    with pytest.raises(ValueError):
+        t2.dumps()
@@ -0,0 +1,85 @@
+import io
+
+import pytest
+
+try:
+    import simple
+except ImportError as e:
+    print("You must run the tests from the environment with all of the examples built.")
+    raise e
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    simple.reset_stats()
+    yield
+
+
+def test_loads_and_dumps():
+    s = '{"a": 1, "b": "x"}'
+    e = simple.Example.loads(s)
+    with pytest.raises(simple.JSONParseError):
+        simple.Example.loads('{"a": 1}')
+    e.dumps()
+    e.dumps_bytes()
+    loads = simple.stats()['Example']['loads']
+    assert loads['calls'] == 2
+    assert loads['errors'] == 1
+    assert loads['bytes'] == len(s) + len('{"a": 1}')
+    assert loads['allocations'] > 0
+    assert sum(loads['histogram_ns'].values()) == 2
+    dumps = simple.stats()['Example']['dumps']
+    assert dumps['calls'] == 2
+    assert dumps['bytes'] == 2 * len(e.dumps().encode())
+
+
+def test_other_entry_points():
+    e = simple.Example(1, 'x')
+    simple.Example.from_binary(e.to_binary())
+    e.dump(io.BytesIO())
+    stats = simple.stats()['Example']
+    assert stats['loads']['calls'] == 1
+    assert stats['dumps']['calls'] == 2
+    assert stats['dumps']['bytes'] == len(e.to_binary()) + len(e.dumps())
+    payloads = [e.dumps()] * 10
+    simple.Example.loads_many(payloads, threads=2)
+    simple.Example.loads_columns(payloads)
+    assert list(simple.Example.iter_lines(io.BytesIO('\n'.join(payloads).encode()))) == [e] * 10
+    array = ('[' + ','.join(payloads) + ']').encode()
+    assert list(simple.Example.iter_array(array)) == [e] * 10
+    stats = simple.stats()['Example']
+    assert stats['loads_many']['calls'] == 1
+    assert stats['loads_many']['bytes'] == sum(map(len, payloads))
+    # allocations made by the worker threads are counted
+    assert stats['loads_many']['allocations'] > 0
+    assert stats['loads_columns']['calls'] == 1
+    # one call per element, and one more that finds the end of the input
+    assert stats['iter_lines']['calls'] == 11
+    assert stats['iter_array']['calls'] == 11
+    assert stats['loads']['calls'] == 1
+
+
+def test_module_functions():
+    e = simple.loads('{"a": 1, "b": "x"}')
+    simple.dumps(e)
+    stats = simple.stats()
+    assert stats['<module>']['loads']['calls'] == 1
+    assert stats['<module>']['dumps']['calls'] == 1
+    assert stats['Example']['loads']['calls'] == 0
+
+
+def test_fields_and_reset():
+    e = simple.Example(1, 'x')
+    e.a
+    e.b
+    e.b
+    fields = simple.stats()['Example']['fields']
+    assert fields['a']['calls'] == 1
+    assert fields['b']['calls'] == 2
+    simple.reset_stats()
+    stats = simple.stats()['Example']
+    assert stats['fields']['b']['calls'] == 0
+    assert stats['loads'] == {
+        'calls': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0, 'allocations': 0,
+        'histogram_ns': {},
+    }